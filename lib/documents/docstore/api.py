@@ -0,0 +1,186 @@
+'''
+Support for the JSON API for scripted clients: documents serialized with a
+subset of FIELDS, and metadata changes and deletion of many documents in a
+single request. apply() makes the database changes in the caller's
+transaction; finish() updates what can't be rolled back (the full text
+index, the store, the tag statistics and the page cache) after the
+commit.
+'''
+
+from documents.docstore import fulltext, pagecache, tagstats
+from documents.docstore.backends import get_storage
+from documents.docstore.models import Document, prefetch_tags
+
+from tagging.models import Tag
+from tagging.utils import edit_string_for_tags
+
+from django.core.urlresolvers import reverse
+from django.utils import datetime_safe
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def _format_time(t):
+    # strftime() of datetime fails for years before 1900.
+    return datetime_safe.new_datetime(t).strftime(TIME_FORMAT)
+
+# The fields of documents in the API, with the columns they need besides
+# id and creation_time (which paging needs anyway) and a function that
+# returns their value.
+FIELDS = {
+    'id': ((), lambda document: document.id),
+    'title': (('title',), lambda document: document.title),
+    'creation_time': ((), lambda document:
+                      _format_time(document.creation_time)),
+    'archive_numbers': (('archive_numbers_start', 'archive_numbers_length'),
+                        lambda document: document.archive_numbers_string()),
+    'tags': ((), lambda document: edit_string_for_tags(document.tags())),
+    'download_url': ((), lambda document:
+                     reverse('download', args=[document.id])),
+}
+
+# The changes apply() knows, besides deletion.
+CHANGES = ('title', 'creation_time', 'tags', 'add_tags', 'remove_tags')
+
+class Error(Exception):
+    pass
+
+class MissingDocuments(Error):
+    '''
+    Some of the ids are not documents of the user.
+    '''
+    def __init__(self, ids):
+        Error.__init__(self, 'No such documents: %s.'
+                       % ', '.join([str(id) for id in ids]))
+        self.ids = ids
+
+def parse_fields(fields):
+    '''
+    Return the list of field names in the comma separated string fields,
+    all of FIELDS if it is empty. Raises Error on unknown fields.
+    '''
+    if not fields:
+        return sorted(FIELDS.keys())
+    names = fields.split(',')
+    unknown = [name for name in names if name not in FIELDS]
+    if unknown:
+        raise Error('Unknown fields: %s.' % ', '.join(unknown))
+    return names
+
+def columns(fields):
+    '''
+    Return the columns of Document to load for fields.
+    '''
+    names = set(['id', 'creation_time'])
+    for field in fields:
+        names.update(FIELDS[field][0])
+    return sorted(names)
+
+def serialize(documents, fields):
+    '''
+    Return a list of dicts with fields of documents.
+    '''
+    if 'tags' in fields:
+        documents = prefetch_tags(documents)
+    return [dict((field, FIELDS[field][1](document)) for field in fields)
+            for document in documents]
+
+class Result(object):
+    '''
+    What apply() did, for finish(): the (docid, user_id, creation_time,
+    title, tags) tuples to re-index, the (id, store_path) tuples of deleted documents,
+    what the storage released for them and the tagstats.Changes.
+    '''
+    def __init__(self, user, indexed, deleted, released, tag_changes):
+        self.user = user
+        self.indexed = indexed
+        self.deleted = deleted
+        self.released = released
+        self.tag_changes = tag_changes
+
+    def updated_ids(self):
+        return [indexed[0] for indexed in self.indexed]
+
+    def deleted_ids(self):
+        return [id for id, path in self.deleted]
+
+def _tag_string(names):
+    return edit_string_for_tags([Tag(name=name) for name in names])
+
+def _change_tags(documents, values, tag_changes):
+    added = tagstats.tag_names(values.get('add_tags') or '')
+    removed = set(tagstats.tag_names(values.get('remove_tags') or ''))
+    for document in prefetch_tags(documents):
+        if 'tags' in values:
+            names = tagstats.tag_names(values['tags'] or '')
+        else:
+            names = [tag.name for tag in document.tags()]
+        names = ([name for name in names if name not in removed]
+                 + [name for name in added if name not in names])
+        tag_changes.update_tags(document, _tag_string(names))
+
+def apply(user, changes, delete):
+    '''
+    Apply changes, a list of (ids, values) tuples where values is a dict
+    with any of CHANGES, to the documents of user with ids, then delete
+    the documents of user with ids in delete. tags replaces the tags of a
+    document, add_tags and remove_tags (tag strings too) are applied
+    after it. Raises MissingDocuments, before changing anything, if an id
+    is not a document of user. Returns a Result for finish().
+
+    Must be called inside a transaction, which the caller commits.
+    '''
+    ids = set(delete)
+    for change_ids, values in changes:
+        ids.update(change_ids)
+    found = set(Document.objects.filter(user=user, id__in=ids)
+                .values_list('id', flat=True))
+    if found != ids:
+        raise MissingDocuments(sorted(ids - found))
+
+    tag_changes = tagstats.Changes()
+    updated = set()
+    for change_ids, values in changes:
+        documents = Document.objects.filter(user=user, id__in=change_ids)
+        fields = {}
+        if 'title' in values:
+            fields['title'] = values['title'] or None
+        if 'creation_time' in values:
+            fields['creation_time'] = values['creation_time']
+        if fields:
+            documents.update(**fields)
+        if ('tags' in values or 'add_tags' in values
+            or 'remove_tags' in values):
+            _change_tags(documents, values, tag_changes)
+        updated.update(change_ids)
+    updated -= set(delete)
+
+    indexed = [(document.id, user.id, document.creation_time, document.title,
+                edit_string_for_tags(document.tags()))
+               for document in prefetch_tags(
+            Document.objects.filter(id__in=updated))]
+
+    documents = Document.objects.filter(user=user, id__in=delete)
+    deleted = []
+    for document in documents:
+        tag_changes.document_deleted(document)
+        deleted.append((document.id, document.store_path))
+    documents.delete()
+    # Blob references and pack entries are rows too, the files go in
+    # finish().
+    released = get_storage().release([path for id, path in deleted])
+    return Result(user, indexed, deleted, released, tag_changes)
+
+def finish(result):
+    '''
+    Update the full text index, the store, the tag statistics and the
+    page cache after the changes of result were committed. Only files are
+    removed from the store, the database is not changed.
+    '''
+    if result.indexed:
+        fulltext.index_metadata_many(result.indexed)
+    if result.deleted:
+        get_storage().remove(result.released)
+        for id, path in result.deleted:
+            fulltext.remove(id)
+    result.tag_changes.apply()
+    pagecache.bump(result.user.id)
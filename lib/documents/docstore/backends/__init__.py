@@ -0,0 +1,33 @@
+'''
+Storage backends. The views store and read documents through the backend
+named by settings.DOCUMENTSTORE_BACKEND, so backends can be swapped (and
+benchmarked against each other) without touching the views.
+'''
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+_storage = None
+
+def load_storage(path):
+    '''
+    Return an instance of the storage class at the dotted path.
+    '''
+    module_name, class_name = path.rsplit('.', 1)
+    try:
+        module = import_module(module_name)
+        cls = getattr(module, class_name)
+    except (ImportError, AttributeError) as e:
+        raise ImproperlyConfigured('Error loading storage backend %s: %s'
+                                   % (path, e))
+    return cls()
+
+def get_storage():
+    '''
+    Return the configured storage backend.
+    '''
+    global _storage
+    if _storage is None:
+        _storage = load_storage(settings.DOCUMENTSTORE_BACKEND)
+    return _storage
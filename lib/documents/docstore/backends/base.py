@@ -0,0 +1,86 @@
+class BaseStorage(object):
+    '''
+    The interface of storage backends. Documents are identified by the
+    relative path returned by store(), which is kept in
+    Document.store_path.
+    '''
+    def store(self, file, user_name, document_id, creation_time):
+        '''
+        Store document contained in file and return its relative path.
+        Raises docstore.NotAPdf if file doesn't contain a PDF.
+        '''
+        raise NotImplementedError
+
+    def get(self, path):
+        '''
+        Return a file like object containing the document at path or None
+        if there is no such document.
+        '''
+        raise NotImplementedError
+
+    def get_thumb(self, path, n=0, profile=None, render=True):
+        '''
+        Return a file like object containing thumb number n, in the
+        thumbnail profile named profile (see settings.THUMB_PROFILES), of
+        the document at path or None. If render is false only thumbnails
+        that are already rendered are returned.
+        '''
+        raise NotImplementedError
+
+    def get_page(self, path, n, width, format='png', quality=None):
+        '''
+        Return a file like object containing page n of the document at
+        path rendered width pixels wide in the image format format, or
+        None if there is no such document or page.
+        '''
+        raise NotImplementedError
+
+    def get_pages(self, path, first, last):
+        '''
+        Return a file like object containing a PDF of pages first to last
+        (counted from 0, inclusive) of the document at path, or None if
+        there is no such document or range of pages.
+        '''
+        raise NotImplementedError
+
+    def get_sprite(self, paths):
+        '''
+        Return a file like object containing the first thumbnails of the
+        documents at paths side by side. paths may contain None for empty
+        cells.
+        '''
+        raise NotImplementedError
+
+    def delete(self, path):
+        '''
+        Delete the document at path and its thumbnails.
+        '''
+        raise NotImplementedError
+
+    def delete_many(self, paths):
+        '''
+        Delete the documents at paths.
+        '''
+        for path in paths:
+            self.delete(path)
+
+    def release(self, paths):
+        '''
+        Release the documents at paths in the database, in the transaction
+        that deletes their Documents. Returns what remove() needs to delete
+        their files once the transaction is committed.
+        '''
+        return paths
+
+    def remove(self, released):
+        '''
+        Delete the files of the documents that release() released.
+        '''
+        self.delete_many(released)
+
+    def stat(self, path):
+        '''
+        Return the os.stat() result of the document at path or None if
+        there is no such document.
+        '''
+        raise NotImplementedError
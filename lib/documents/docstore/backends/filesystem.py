@@ -0,0 +1,49 @@
+from documents.docstore import docstore
+from documents.docstore.backends.base import BaseStorage
+
+from django.conf import settings
+
+class FileSystemStorage(BaseStorage):
+    '''
+    Documents and thumbnails stored as files below location (by default
+    settings.DOCUMENTSTORE_PATH), see the docstore module.
+    '''
+    def __init__(self, location=None):
+        if location is None:
+            location = settings.DOCUMENTSTORE_PATH
+        self.location = location
+
+    def store(self, file, user_name, document_id, creation_time):
+        return docstore.store(file, user_name, document_id, creation_time,
+                              store_path=self.location)
+
+    def get(self, path):
+        return docstore.get(path, self.location)
+
+    def get_thumb(self, path, n=0, profile=None, render=True):
+        return docstore.get_thumb(path, n, self.location, profile, render)
+
+    def get_page(self, path, n, width, format='png', quality=None):
+        return docstore.get_page(path, n, width, self.location, format,
+                                 quality)
+
+    def get_pages(self, path, first, last):
+        return docstore.get_pages(path, first, last, self.location)
+
+    def get_sprite(self, paths):
+        return docstore.get_sprite(paths, self.location)
+
+    def delete(self, path):
+        docstore.delete(path, self.location)
+
+    def delete_many(self, paths):
+        docstore.delete_many(paths, self.location)
+
+    def release(self, paths):
+        return docstore.release(paths)
+
+    def remove(self, released):
+        docstore.remove_released(released, self.location)
+
+    def stat(self, path):
+        return docstore.stat(path, self.location)
@@ -0,0 +1,80 @@
+from documents.docstore.backends.filesystem import FileSystemStorage
+
+import mmap
+import os
+
+class MappedFile(object):
+    '''
+    A read only file like object backed by a memory map of f. Reads are
+    served straight from the page cache, without read() system calls or
+    the copying done by Python's file buffering: read() returns read only
+    buffers into the map rather than strings (use str() where a copy is
+    needed). They are valid until the file is closed.
+    '''
+    def __init__(self, f):
+        self.name = f.name
+        self._file = f
+        self._size = os.fstat(f.fileno()).st_size
+        if self._size > 0:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped.
+            self._map = None
+        self._pos = 0
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def read(self, size=-1):
+        if self._map is None:
+            return ''
+        if size < 0:
+            end = self._size
+        else:
+            end = min(self._pos + size, self._size)
+        # Slicing the map would copy.
+        data = buffer(self._map, self._pos, max(end - self._pos, 0))
+        self._pos = max(self._pos, end)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise IOError('negative seek offset')
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _mapped(f):
+    if f is None or not hasattr(f, 'fileno'):
+        # Packed files can't be mapped.
+        return f
+    return MappedFile(f)
+
+class MmapStorage(FileSystemStorage):
+    '''
+    The file system layout of FileSystemStorage with documents and
+    thumbnails read through memory maps.
+    '''
+    def get(self, path):
+        return _mapped(super(MmapStorage, self).get(path))
+
+    def get_thumb(self, path, n=0, profile=None, render=True):
+        return _mapped(super(MmapStorage, self).get_thumb(path, n, profile,
+                                                          render))
@@ -0,0 +1,263 @@
+'''
+Benchmarks of the upload, thumbnailing, listing and download paths. They
+run against a test database and a temporary store filled with synthetic
+PDFs and archives, so runs are reproducible and comparable. See the
+benchmark management command.
+'''
+
+from documents.docstore import backends, docstore, pagecache
+from documents.docstore.backends import get_storage
+from documents.docstore.models import Document, NumberSequence
+
+from tagging.models import Tag
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.test.client import Client
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+PASSWORD = 'benchmark'
+
+def synthetic_pdf(pages):
+    '''
+    Return a PDF with pages pages, each with a line of text.
+    '''
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               None, # The page tree, filled in below.
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for i in range(pages):
+        content = 'BT /F1 24 Tf 72 720 Td (Synthetic page %d) Tj ET' % (i + 1)
+        objects.append('<< /Length %d >>\nstream\n%s\nendstream'
+                       % (len(content), content))
+        objects.append('<< /Type /Page /Parent 2 0 R '
+                       '/MediaBox [0 0 612 792] /Contents %d 0 R '
+                       '/Resources << /Font << /F1 3 0 R >> >> >>'
+                       % len(objects))
+        kids.append('%d 0 R' % len(objects))
+    objects[1] = ('<< /Type /Pages /Kids [%s] /Count %d >>'
+                  % (' '.join(kids), pages))
+
+    out = ['%PDF-1.4\n']
+    offset = len(out[0])
+    offsets = []
+    for i, obj in enumerate(objects):
+        chunk = '%d 0 obj\n%s\nendobj\n' % (i + 1, obj)
+        offsets.append(offset)
+        out.append(chunk)
+        offset += len(chunk)
+    out.append('xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    out.extend(['%010d 00000 n \n' % o for o in offsets])
+    out.append('trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+               % (len(objects) + 1, offset))
+    return ''.join(out)
+
+def current_rss():
+    '''
+    Return the current resident set size of this process in kilobytes, or
+    None where /proc isn't available. Unlike ru_maxrss (the peak over the
+    lifetime of the process) it can be compared before and after a
+    benchmark.
+    '''
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        return None
+    try:
+        pages = int(f.read().split()[1])
+    finally:
+        f.close()
+    return pages * resource.getpagesize() // 1024
+
+def summarize(times):
+    times = sorted(times)
+    return dict(runs=len(times),
+                min=times[0],
+                median=times[len(times) // 2],
+                mean=sum(times) / len(times),
+                max=times[-1])
+
+def measure(func, repeat):
+    '''
+    Call func repeat times and return a summary of the wall clock times
+    along with the RSS afterwards and how much it grew. Extra data
+    returned by the last call of func (a dict) is added to the summary.
+    '''
+    times = []
+    extra = None
+    rss_before = current_rss()
+    for i in range(repeat):
+        start = time.time()
+        extra = func()
+        times.append(time.time() - start)
+    result = summarize(times)
+    rss = current_rss()
+    result['rss_kb'] = rss
+    if rss is not None and rss_before is not None:
+        result['rss_delta_kb'] = rss - rss_before
+    else:
+        result['rss_delta_kb'] = None
+    if extra:
+        result.update(extra)
+    return result
+
+def _create_user(name):
+    user = User.objects.create_user(name, '%s@example.com' % name, PASSWORD)
+    NumberSequence(user=user).save()
+    return user
+
+def _store_document(user, pdf, name='synthetic.pdf'):
+    d = Document(user=user, store_path='NOT SET', title=name)
+    d.save()
+    d.store_path = get_storage().store(SimpleUploadedFile(name, pdf),
+                                       user.username, d.id,
+                                       d.creation_time.timetuple())
+    d.save()
+    return d
+
+def bench_store(user, page_counts, repeat):
+    results = {}
+    for pages in page_counts:
+        pdf = synthetic_pdf(pages)
+        def run():
+            _store_document(user, pdf)
+            return dict(bytes=len(pdf))
+        results[str(pages)] = measure(run, repeat)
+    return results
+
+def bench_generate_thumbs(user, page_counts, repeat):
+    results = {}
+    for pages in page_counts:
+        d = _store_document(user, synthetic_pdf(pages))
+        full_path = os.path.join(settings.DOCUMENTSTORE_PATH, d.store_path)
+        def run():
+            docstore.generate_thumbs(full_path, settings.THUMB_WIDTH)
+        results[str(pages)] = measure(run, repeat)
+    return results
+
+def _fill_archive(user, size):
+    '''
+    Create size documents (database rows only) for user, all tagged
+    'common' and every tenth tagged 'tenth'.
+    '''
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        for i in range(size):
+            d = Document(user=user, store_path='%s/synthetic-%d.pdf'
+                         % (user.username, i), title='document %d' % i)
+            d.save()
+            if i % 10 == 0:
+                Tag.objects.update_tags(d, 'common tenth')
+            else:
+                Tag.objects.update_tags(d, 'common')
+        transaction.commit()
+    finally:
+        transaction.leave_transaction_management()
+
+def _get(client, url, data={}):
+    '''
+    GET url and return the response and the number of queries it ran.
+    '''
+    connection.queries = []
+    response = client.get(url, data)
+    # Consume streamed content.
+    response.content
+    assert response.status_code == 200, (url, response.status_code)
+    return response, len(connection.queries)
+
+def bench_listing(archive_sizes, repeat):
+    pages = [('index', '/', {}),
+             ('index_thumbs', '/', {'thumbs': ''}),
+             ('search_tags', '/search/', {'tags': 'tenth'})]
+    results = {}
+    for size in archive_sizes:
+        user = _create_user('archive%d' % size)
+        _fill_archive(user, size)
+        client = Client()
+        client.login(username=user.username, password=PASSWORD)
+        size_results = {}
+        for name, url, data in pages:
+            def run():
+                response, queries = _get(client, url, data)
+                return dict(queries=queries)
+            size_results[name] = measure(run, repeat)
+        results[str(size)] = size_results
+    return results
+
+def bench_download(user, page_counts, repeat):
+    client = Client()
+    client.login(username=user.username, password=PASSWORD)
+    results = {}
+    for pages in page_counts:
+        pdf = synthetic_pdf(pages)
+        d = _store_document(user, pdf)
+        url = reverse('download-named', args=[d.id, 'synthetic.pdf'])
+        def run():
+            response, queries = _get(client, url)
+            return dict(bytes=len(response.content))
+        result = measure(run, repeat)
+        result['bytes_per_second'] = len(pdf) / max(result['median'], 1e-9)
+        results[str(pages)] = result
+    return results
+
+BENCHMARKS = ('store', 'generate_thumbs', 'listing', 'download')
+
+def run(page_counts, archive_sizes, repeat, benchmarks=BENCHMARKS):
+    '''
+    Run benchmarks against a fresh test database and a temporary store and
+    return the results as a dict.
+    '''
+    store_dir = tempfile.mkdtemp(prefix='docstore-benchmark-')
+    saved = dict((name, getattr(settings, name))
+                 for name in ('DOCUMENTSTORE_PATH', 'THUMB_CACHE_PATH',
+                              'FULLTEXT_INDEX_PATH', 'DEBUG'))
+    old_database_name = connection.settings_dict['NAME']
+    try:
+        settings.DOCUMENTSTORE_PATH = os.path.join(store_dir, 'store')
+        settings.THUMB_CACHE_PATH = os.path.join(store_dir, 'thumbcache')
+        settings.FULLTEXT_INDEX_PATH = os.path.join(store_dir, 'fulltext.db')
+        # Needed for query counts.
+        settings.DEBUG = True
+        backends._storage = None
+        # Listings cached by earlier runs in this process would be served
+        # instead of rendered.
+        pagecache.clear()
+        connection.creation.create_test_db(verbosity=0)
+
+        user = _create_user('benchmark')
+        results = {}
+        if 'store' in benchmarks:
+            results['store'] = bench_store(user, page_counts, repeat)
+        if 'generate_thumbs' in benchmarks:
+            results['generate_thumbs'] = bench_generate_thumbs(
+                user, page_counts, repeat)
+        if 'listing' in benchmarks:
+            results['listing'] = bench_listing(archive_sizes, repeat)
+        if 'download' in benchmarks:
+            results['download'] = bench_download(user, page_counts, repeat)
+    finally:
+        connection.creation.destroy_test_db(old_database_name, verbosity=0)
+        for name, value in saved.items():
+            setattr(settings, name, value)
+        backends._storage = None
+        pagecache.clear()
+        shutil.rmtree(store_dir, ignore_errors=True)
+
+    return dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=sys.version.split()[0],
+                backend=settings.DOCUMENTSTORE_BACKEND,
+                deduplicate=settings.DOCUMENTSTORE_DEDUPLICATE,
+                page_counts=page_counts,
+                archive_sizes=archive_sizes,
+                repeat=repeat,
+                results=results)
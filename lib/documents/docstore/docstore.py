@@ -1,15 +1,58 @@
 from __future__ import with_statement
 
-from PythonMagick import Image
+from documents.docstore import (fulltext, instrument, jobs, packs,
+                                 pagecache, thumbcache)
+from documents.docstore.models import Blob, Document, PackEntry
+
+from PythonMagick import Color, CompositeOperator, Geometry, Image
 
 from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.utils import simplejson
 
-import glob
+import contextlib
+import errno
+import hashlib
 import itertools
+import math
+import multiprocessing
 import os
+import shutil
+import subprocess
+import tempfile
 import time
 
-THUMB_NAME_FORMAT = '%s-thumb%03d.png'
+# Thumbnail names are formatted with the document root, the page number,
+# the profile suffix (see _profile_suffix) and the format of the profile.
+THUMB_NAME_FORMAT = '%s-thumb%03d%s.%s'
+# Name of the thumbnail cache entries, relative to the document's cache
+# directory, formatted like THUMB_NAME_FORMAT but without root.
+CACHED_THUMB_NAME_FORMAT = 'thumb%03d%s.%s'
+
+# Name of the cache entries of pages rendered by get_page, formatted with
+# the page number, the width, the quality suffix and the format.
+CACHED_PAGE_NAME_FORMAT = 'page%03d-%d%s.%s'
+# Name of the cache entries of page ranges extracted by get_pages.
+CACHED_PAGES_NAME_FORMAT = 'pages%03d-%03d.pdf'
+
+# get_page rasterizes pages at a density at which a page this many points
+# (1/72 inch) wide, A4, is at least as wide as the requested width.
+PAGE_POINTS = 595
+
+# Sprite sheets are cached in this directory of the thumbnail cache.
+SPRITE_CACHE_DIR = 'sprites'
+
+# The manifest of a document lists its files in the store.
+MANIFEST_EXT = '.manifest'
+
+# Content addressed documents are stored in this directory of the store.
+BLOB_DIR = 'blobs'
+
+# Files on disk are read in blocks of this size.
+BLOCK_SIZE = 64 * 1024
+
+GENERATE_THUMBS_JOB = 'generate_thumbs'
+EXTRACT_TEXT_JOB = 'extract_text'
 
 class Error(Exception):
     pass
@@ -17,6 +60,17 @@ class Error(Exception):
 class NotAPdf(Error):
     pass
 
+class UnsupportedFormat(Error):
+    '''
+    ImageMagick can't write an image format, e.g. for lack of a WebP
+    delegate.
+    '''
+    pass
+
+# The image formats ImageMagick failed to write with UnsupportedFormat in
+# this process.
+unsupported_formats = set()
+
 def _prepare_path(document_id, creation_time, user_name):
     date_str = time.strftime('%Y%m%d', creation_time)
     time_str = time.strftime('%H%M%S', creation_time)
@@ -27,26 +81,203 @@ def _prepare_path(document_id, creation_time, user_name):
     return os.path.join(relative_path, 
                         '%s%s-%d.pdf' % (date_str, time_str, document_id))
 
-def generate_thumbs(pdf, thumb_width):
+def _profile(profile):
+    '''
+    Return the settings of the thumbnail profile named profile (see
+    settings.THUMB_PROFILES). Raises KeyError on unknown profiles.
+    '''
+    if profile is None:
+        profile = settings.THUMB_DEFAULT_PROFILE
+    return settings.THUMB_PROFILES[profile]
+
+def _profile_suffix(profile):
+    # The default profile gets no suffix, which keeps the names of
+    # thumbnails generated before there were profiles.
+    if profile is None or profile == settings.THUMB_DEFAULT_PROFILE:
+        return ''
+    return '-%s' % profile
+
+def _thumb_name(root, n, profile=None):
+    return THUMB_NAME_FORMAT % (root, n, _profile_suffix(profile),
+                                _profile(profile)['format'])
+
+def _manifest_file(pdf):
+    return os.path.splitext(pdf)[0] + MANIFEST_EXT
+
+def _legacy_manifest(pdf):
+    '''
+    Build the manifest of a document stored before manifests were written
+    by looking for the PDF and the thumbnails that generate_thumbs
+    writes.
+    '''
+    root, ext = os.path.splitext(pdf)
+    files = {}
+    try:
+        files[os.path.basename(pdf)] = os.stat(pdf).st_size
+    except OSError:
+        pass
+    for n in itertools.count():
+        name = _thumb_name(root, n)
+        try:
+            files[os.path.basename(name)] = os.stat(name).st_size
+        except OSError:
+            break
+    return files
+
+def _read_manifest(pdf):
+    '''
+    Return a dict that maps the names of the files of the document at the
+    full path pdf to their sizes. The names are relative to the directory
+    of pdf.
+    '''
+    try:
+        with open(_manifest_file(pdf)) as f:
+            return simplejson.load(f)['files']
+    except IOError:
+        return _legacy_manifest(pdf)
+
+def _add_to_manifest(pdf, names):
+    '''
+    Add the files with full paths names to the manifest of the document
+    at the full path pdf.
+    '''
+    files = _read_manifest(pdf)
+    for name in names:
+        files[os.path.basename(name)] = os.stat(name).st_size
+    manifest = _manifest_file(pdf)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest),
+                                    suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        simplejson.dump(dict(files=files), f)
+    os.rename(tmp_path, manifest)
+
+def render_page(pdf, n, thumb_width, out, quality=None, density=None):
+    '''
+    Render page n of pdf as a thumbnail and write it to out, in the format
+    given by the extension of out. Only page n is read from pdf. The page
+    is rasterized at density dots per inch (72 by default) before it is
+    scaled. Raises RuntimeError if pdf has no page n and UnsupportedFormat
+    if the format can't be written (it is added to unsupported_formats).
+    '''
+    root, ext = os.path.splitext(pdf)
+    # If root (wich is unicode) contains any characters that can't
+    # be converted by str() we will crash and burn. This needs to
+    # become more robust.
+    img = Image()
+    if density is not None:
+        img.density('%d' % density)
+    img.read(str('%s.pdf[%d]' % (root, n)))
+    img.scale('%d' % thumb_width)
+    if quality is not None:
+        img.quality(quality)
+    try:
+        img.write(str(out))
+    except RuntimeError as e:
+        # The page was read, so it exists.
+        if 'delegate' not in str(e).lower():
+            raise IOError(str(e))
+        format = os.path.splitext(out)[1][1:].lower()
+        unsupported_formats.add(format)
+        raise UnsupportedFormat(str(e))
+
+def page_count(pdf):
+    '''
+    Return the number of pages in pdf. Ghostscript (which PythonMagick
+    uses to read PDFs) is asked for the count so that no page has to be
+    rendered to find it. It runs with -dSAFER, only allowed to read pdf
+    (which needs Ghostscript 9.50 or later), since pdf is uploaded by
+    users.
+    '''
+    # Escape pdf as a PostScript string.
+    ps_path = (pdf.replace('\\', '\\\\')
+               .replace('(', '\\(').replace(')', '\\)'))
+    p = subprocess.Popen([settings.GHOSTSCRIPT_PATH, '-q', '-dNODISPLAY',
+                          '-dSAFER', '--permit-file-read=%s' % pdf, '-c', 
+                          '(%s) (r) file runpdfbegin pdfpagecount = quit' 
+                          % ps_path],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    try:
+        return int(out.strip())
+    except ValueError:
+        raise Error('Could not count pages of %s: %s' % (pdf, err))
+
+def write_pages(pdf, first, last, out):
+    '''
+    Write pages first to last (counted from 0, inclusive) of pdf as a new
+    PDF to out.
+    '''
+    p = subprocess.Popen([settings.GHOSTSCRIPT_PATH, '-q', '-dNOPAUSE',
+                          '-dBATCH', '-dSAFER', '-sDEVICE=pdfwrite',
+                          '-dFirstPage=%d' % (first + 1),
+                          '-dLastPage=%d' % (last + 1),
+                          '-sOutputFile=%s' % out, pdf],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, err = p.communicate()
+    if p.returncode != 0:
+        raise Error('Could not extract pages of %s: %s' % (pdf, err))
+
+def _render_page_star(args):
+    # Pool.map passes a single argument.
+    render_page(*args)
+
+def generate_thumbs(pdf, thumb_width, workers=None):
     '''
     Genrate thumbnails of pdf and return the number of thumbnails created.
+    The thumbnails are named as the ones of the default profile. The pages
+    are rendered by a pool of workers processes.
     '''
+    if workers is None:
+        workers = settings.THUMB_WORKERS
+
     root, ext = os.path.splitext(pdf)
     if ext != '.pdf':
         return 0
-    try:
-        for i in itertools.count():
-            # If root (wich is unicode) contains any characters that can't
-            # be converted by str() we will crash and burn. This needs to
-            # become more robust.
-            img = Image(str('%s.pdf[%d]' % (root, i)))
-            img.scale('%d' % thumb_width)
-            img.write(str(THUMB_NAME_FORMAT % (root, i)))
-    except RuntimeError:
-        # Assume that we have reached the last page and that therefore
-        # the Image ctor failed.
-        pass
-    return i
+    count = page_count(pdf)
+    pages = [(pdf, i, thumb_width, _thumb_name(root, i))
+             for i in range(count)]
+    # Daemonic processes (e.g. job workers) are not allowed to have
+    # children.
+    if (workers > 1 and count > 1 and
+        not multiprocessing.current_process().daemon):
+        pool = multiprocessing.Pool(min(workers, count))
+        try:
+            pool.map(_render_page_star, pages)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for page in pages:
+            _render_page_star(page)
+    _add_to_manifest(pdf, [page[3] for page in pages])
+    return count
+
+def _prerender_thumb(path, store_path, thumb_width=None):
+    '''
+    Job handler that renders the first thumbnail (in the default profile)
+    of the document at path into the thumbnail cache. Other pages and
+    profiles are rendered on demand. thumb_width is passed by jobs queued
+    before the width became part of the profile and is ignored.
+    '''
+    thumb = get_thumb(path, 0, store_path)
+    if thumb is not None:
+        thumb.close()
+
+jobs.register(GENERATE_THUMBS_JOB, _prerender_thumb)
+
+def _index_text(docid, path, store_path):
+    '''
+    Job handler that adds the text of the document at path to the
+    full-text index.
+    '''
+    text = fulltext.extract_text(os.path.join(store_path, path))
+    fulltext.index_body(docid, text)
+    # The document can now be found by its text.
+    owners = Document.objects.filter(id=docid).values_list('user', flat=True)
+    for user_id in owners:
+        pagecache.bump(user_id)
+
+jobs.register(EXTRACT_TEXT_JOB, _index_text)
 
 def is_pdf(pdf):
     PDF_MAGIC = '%PDF'
@@ -54,66 +285,496 @@ def is_pdf(pdf):
         magic = f.read(len(PDF_MAGIC))
         return magic == PDF_MAGIC
 
-def store(file, user_name, document_id, creation_time, 
-          thumb_width=None, store_path=None):
+def _blob_path(digest):
+    return os.path.join(BLOB_DIR, digest[:2], '%s.pdf' % digest)
+
+def blob_digest(path):
+    '''
+    Return the digest of the blob at path or None if path isn't a blob.
+    '''
+    if not path.startswith(BLOB_DIR + os.sep):
+        return None
+    return os.path.splitext(os.path.basename(path))[0]
+
+def _temporary_file_path(file):
+    '''
+    Return the path of the file on disk backing file (e.g. a large upload)
+    or None.
+    '''
+    if hasattr(file, 'temporary_file_path'):
+        return file.temporary_file_path()
+    return None
+
+def _store_blob(file, store_path):
+    '''
+    Store the content of file under its digest, unless it is already
+    stored. Returns the relative path of the blob and True if it is new.
+    '''
+    blob_dir = os.path.join(store_path, BLOB_DIR)
+    if not os.path.exists(blob_dir):
+        os.makedirs(blob_dir)
+    sha1 = hashlib.sha1()
+    tmp_path = _temporary_file_path(file)
+    try:
+        if tmp_path is not None:
+            # Already on disk, hash it in place and move it into the store.
+            with open(tmp_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(BLOCK_SIZE), ''):
+                    sha1.update(chunk)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir=blob_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in file.chunks():
+                    sha1.update(chunk)
+                    f.write(chunk)
+        if not is_pdf(tmp_path):
+            raise NotAPdf
+
+        relative_path = _blob_path(sha1.hexdigest())
+        full_path = os.path.join(store_path, relative_path)
+        is_new = Blob.objects.acquire(sha1.hexdigest())
+        if is_new or not os.path.exists(full_path):
+            dir = os.path.dirname(full_path)
+            if not os.path.exists(dir):
+                os.makedirs(dir)
+            file_move_safe(tmp_path, full_path, allow_overwrite=True)
+            _add_to_manifest(full_path, [full_path])
+        return relative_path, is_new
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@instrument.timed('storage')
+def store(file, user_name, document_id, creation_time, store_path=None):
     '''
     Store document contained in file and return its relative path. If the 
     document in file is not a PDF this function will raise an error.
+    The first thumbnail is rendered and the text is indexed in the
+    background.
+
+    If settings.DOCUMENTSTORE_DEDUPLICATE is set, documents are stored
+    once per content and thumbnails are only generated for new content.
+
+    Files that are already on disk (that have a temporary_file_path()) are
+    moved into the store instead of being copied.
     '''
-    if thumb_width is None:
-        thumb_width = settings.THUMB_WIDTH
     if store_path is None:
         store_path = settings.DOCUMENTSTORE_PATH
 
-    relative_path = _prepare_path(document_id, creation_time, user_name)
-    full_path = os.path.join(store_path, relative_path)
-    with open(full_path, 'wb') as f:
-        for chunk in file.chunks():
-            f.write(chunk)
+    if settings.DOCUMENTSTORE_DEDUPLICATE:
+        relative_path, is_new = _store_blob(file, store_path)
+    else:
+        relative_path = _prepare_path(document_id, creation_time, user_name)
+        full_path = os.path.join(store_path, relative_path)
+        tmp_path = _temporary_file_path(file)
+        if tmp_path is not None:
+            file_move_safe(tmp_path, full_path)
+        else:
+            try:
+                with open(full_path, 'wb') as f:
+                    for chunk in file.chunks():
+                        f.write(chunk)
+            except:
+                # E.g. an unreadable archive member, leave nothing behind.
+                os.remove(full_path)
+                raise
 
-    if not is_pdf(full_path):
-        os.remove(full_path)
-        raise NotAPdf
+        if not is_pdf(full_path):
+            os.remove(full_path)
+            raise NotAPdf
+        _add_to_manifest(full_path, [full_path])
+        is_new = True
 
-    generate_thumbs(full_path, thumb_width)
+    if is_new:
+        jobs.enqueue(GENERATE_THUMBS_JOB, document_id, path=relative_path,
+                     store_path=store_path)
+    jobs.enqueue(EXTRACT_TEXT_JOB, document_id, docid=document_id,
+                 path=relative_path, store_path=store_path)
 
+    instrument.record('storage', count=0, nbytes=os.path.getsize(
+            os.path.join(store_path, relative_path)))
     return relative_path
 
+def _thumb_cache_dir(path):
+    return os.path.splitext(path)[0]
+
+@instrument.timed('storage')
 def delete(path, store_path=None):
     '''
-    Deletes document at path (and associated thumbs).
+    Deletes document at path (and associated thumbs). Content addressed
+    documents are only deleted when their last reference goes away.
     '''    
+    delete_many([path], store_path)
+
+class Released(object):
+    '''
+    What release() dropped from the database, for remove_released(): the
+    paths of the documents whose files are to be removed and the names of
+    the packs that have no files left.
+    '''
+    def __init__(self, paths, empty_packs):
+        self.paths = paths
+        self.empty_packs = empty_packs
+
+def release(paths):
+    '''
+    Releases the references to the documents at paths and forgets their
+    packed files, which only changes the database. Must be called in the
+    transaction that deletes the Documents; once it is committed,
+    remove_released() removes the files. Returns a Released.
+    '''
+    removed = []
+    for path in paths:
+        digest = blob_digest(path)
+        if digest is not None and not Blob.objects.release(digest):
+            # Still referenced.
+            continue
+        removed.append(path)
+    return Released(removed, packs.forget(removed))
+
+def remove_released(released, store_path=None):
+    '''
+    Removes the files of the documents that release() released.
+    '''
     if store_path is None:
         store_path = settings.DOCUMENTSTORE_PATH
 
-    root, ext = os.path.splitext(path)
-    files = glob.glob(os.path.join(store_path, root + '*'))
-    for file in files:
-        os.remove(file)
+    for path in released.paths:
+        _unlink_files(path, store_path)
+    packs.remove_packs(released.empty_packs, store_path)
+
+def files(path, store_path=None):
+    '''
+    Returns the names of the files in the store that belong to the
+    document at path (the PDF, its thumbnails and its manifest). The names
+    are relative to the directory of path.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+
+    full_path = os.path.join(store_path, path)
+    names = list(_read_manifest(full_path))
+    names.append(os.path.basename(_manifest_file(full_path)))
+    return names
+
+def _unlink_files(path, store_path):
+    dir = os.path.dirname(os.path.join(store_path, path))
+    for name in files(path, store_path):
+        try:
+            os.remove(os.path.join(dir, name))
+        except OSError:
+            pass
+    shutil.rmtree(thumbcache.entry_path(_thumb_cache_dir(path)), 
+                  ignore_errors=True)
+
+def remove_files(path, store_path=None):
+    '''
+    Removes the files of the document at path and its cached thumbnails,
+    regardless of references to it.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+
+    _unlink_files(path, store_path)
+    packs.remove(path, store_path)
+
+def delete_many(paths, store_path=None):
+    '''
+    Deletes the documents at paths.
+    '''
+    remove_released(release(paths), store_path)
+
+def pack_documents(paths, store_path=None, max_bytes=None):
+    '''
+    Moves the documents at paths, with their generated thumbnails, into
+    compressed pack files (see packs). Documents are read from the packs
+    from then on. Documents with a file that disappears while they are
+    packed are left in place. Returns the number of documents packed.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+
+    # Content addressed documents can be listed more than once.
+    paths = [path for path in set(paths)
+             if os.path.exists(os.path.join(store_path, path))]
+    # Left behind by an interrupted run.
+    already_packed = set(PackEntry.objects.filter(document__in=paths)
+                         .values_list('document', flat=True))
+    documents = []
+    for path in sorted(paths):
+        if path in already_packed:
+            continue
+        manifest = _read_manifest(os.path.join(store_path, path))
+        dir = os.path.dirname(path)
+        documents.append((path, [os.path.join(dir, name)
+                                 for name in sorted(manifest)]))
+
+    def remove_originals(packed):
+        for path in packed:
+            full_path = os.path.join(store_path, path)
+            dir = os.path.dirname(full_path)
+            for name in files(path, store_path):
+                try:
+                    os.remove(os.path.join(dir, name))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+    remove_originals(already_packed)
+    done = []
+    def pack_done(paths):
+        remove_originals(paths)
+        done.extend(paths)
+    packs.pack(documents, store_path, max_bytes, packed=pack_done)
+    return len(done)
+
+def size(path, store_path=None):
+    '''
+    Returns the number of bytes used by the document at path and its
+    generated thumbnails, according to its manifest and packs.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+
+    return (sum(_read_manifest(os.path.join(store_path, path)).values())
+            + packs.size(path))
+
+def verify(path, store_path=None):
+    '''
+    Checks the files of the document at path against its manifest and
+    returns a list of problems, which is empty if all is well.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+
+    full_path = os.path.join(store_path, path)
+    if not os.path.exists(full_path) and packs.is_packed(path):
+        return packs.verify(path, store_path)
+    dir = os.path.dirname(full_path)
+    problems = []
+    files = _read_manifest(full_path)
+    if os.path.basename(path) not in files:
+        problems.append('%s: not in manifest' % path)
+    for name, size in sorted(files.items()):
+        try:
+            actual = os.stat(os.path.join(dir, name)).st_size
+        except OSError:
+            problems.append('%s: missing' % name)
+            continue
+        if actual != size:
+            problems.append('%s: size is %d, expected %d' 
+                            % (name, actual, size))
+    return problems
+
+@contextlib.contextmanager
+def _local_pdf(path, store_path):
+    '''
+    Yields the full path of the PDF of the document at path, extracted from
+    its pack into a temporary directory if it is packed, for tools that
+    need a file.
+    '''
+    full_path = os.path.join(store_path, path)
+    if os.path.exists(full_path):
+        yield full_path
+        return
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        pdf = os.path.join(tmp_dir, os.path.basename(path))
+        packs.extract(path, pdf, store_path)
+        yield pdf
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
+@instrument.timed('storage')
 def get(path, store_path=None):
     '''
-    Returns a file like object containing the document at path.
+    Returns a file like object containing the document at path. Packed
+    documents are decompressed while they are read.
     '''    
     if store_path is None:
         store_path = settings.DOCUMENTSTORE_PATH
 
     full_path = os.path.join(store_path, path)
     if not os.path.exists(full_path):
-        return None
-    return open(full_path)
+        return packs.open_file(path, store_path)
+    return open(full_path, 'rb')
+
+def stat(path, store_path=None):
+    '''
+    Returns the os.stat() result of the document at path or None if there
+    is no such document.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+
+    try:
+        return os.stat(os.path.join(store_path, path))
+    except OSError:
+        return packs.stat(path)
 
-def get_thumb(path, n=0, store_path=None):
+@instrument.timed('storage')
+def get_thumb(path, n=0, store_path=None, profile=None, render=True):
     '''
-    Returns a file like object containing thumb number n from document
-    at path.
+    Returns a file like object containing thumb number n, in the thumbnail
+    profile named profile, from document at path. Thumbnails that have not
+    been generated are rendered on demand into the thumbnail cache, unless
+    render is false. Thumbnails of packed documents are read from the pack
+    into the thumbnail cache. Returns None if there is no such document or
+    page.
     '''
     if store_path is None:
         store_path = settings.DOCUMENTSTORE_PATH
+    thumb_profile = _profile(profile)
 
     root, ext = os.path.splitext(path)
-    thumb_path = os.path.join(store_path, 
-                              THUMB_NAME_FORMAT % (root, n))
-    if not os.path.exists(thumb_path):
+    thumb_path = os.path.join(store_path, _thumb_name(root, n, profile))
+    if os.path.exists(thumb_path):
+        # Generated by generate_thumbs.
+        return open(thumb_path, 'rb')
+
+    cache_key = os.path.join(_thumb_cache_dir(path), 
+                             CACHED_THUMB_NAME_FORMAT % 
+                             (n, _profile_suffix(profile), 
+                              thumb_profile['format']))
+    if not render:
+        return thumbcache.lookup(cache_key)
+
+    packed = not os.path.exists(os.path.join(store_path, path))
+    if packed and not packs.is_packed(path):
         return None
-    return open(thumb_path)
+    def render_thumb(out):
+        if packed and packs.extract(_thumb_name(root, n, profile), out,
+                                    store_path):
+            return True
+        start = time.time()
+        try:
+            with _local_pdf(path, store_path) as pdf:
+                render_page(pdf, n, thumb_profile['width'], out,
+                            thumb_profile.get('quality'))
+        except RuntimeError:
+            # No page n.
+            return False
+        finally:
+            instrument.record('render', time.time() - start)
+        return True
+    return thumbcache.get(cache_key, render_thumb)
+
+def _exists(path, store_path):
+    return (os.path.exists(os.path.join(store_path, path))
+            or packs.is_packed(path))
+
+def page_density(width):
+    '''
+    Return the density (in dots per inch) at which to rasterize pages that
+    are scaled to width.
+    '''
+    return max(72, int(math.ceil(72.0 * width / PAGE_POINTS)))
+
+@instrument.timed('storage')
+def get_page(path, n, width, store_path=None, format='png', quality=None):
+    '''
+    Returns a file like object containing page n of the document at path,
+    rendered width pixels wide in format. Pages are rendered on demand
+    into the thumbnail cache. Returns None if there is no such document or
+    page.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+    if n < 0 or not _exists(path, store_path):
+        return None
+
+    if quality is None:
+        quality_suffix = ''
+    else:
+        quality_suffix = '-q%d' % quality
+    cache_key = os.path.join(_thumb_cache_dir(path),
+                             CACHED_PAGE_NAME_FORMAT %
+                             (n, width, quality_suffix, format))
+    def render(out):
+        start = time.time()
+        try:
+            with _local_pdf(path, store_path) as pdf:
+                render_page(pdf, n, width, out, quality, page_density(width))
+        except RuntimeError:
+            # No page n.
+            return False
+        finally:
+            instrument.record('render', time.time() - start)
+        return True
+    return thumbcache.get(cache_key, render)
+
+@instrument.timed('storage')
+def get_pages(path, first, last, store_path=None):
+    '''
+    Returns a file like object containing a PDF of pages first to last
+    (counted from 0, inclusive) of the document at path. The PDFs are
+    extracted on demand into the thumbnail cache. Returns None if there is
+    no such document or range of pages.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+    if first < 0 or last < first or not _exists(path, store_path):
+        return None
+
+    cache_key = os.path.join(_thumb_cache_dir(path),
+                             CACHED_PAGES_NAME_FORMAT % (first, last))
+    def extract(out):
+        start = time.time()
+        try:
+            with _local_pdf(path, store_path) as pdf:
+                if last >= page_count(pdf):
+                    return False
+                write_pages(pdf, first, last, out)
+        finally:
+            instrument.record('render', time.time() - start)
+        return True
+    return thumbcache.get(cache_key, extract)
+
+def _compose_sprite(thumbs, thumb_width, height, out):
+    '''
+    Write an image with thumbs (paths of images, or None for empty cells)
+    side by side in cells that are thumb_width wide and height high.
+    '''
+    sprite = Image(Geometry(thumb_width * max(len(thumbs), 1), height),
+                   Color('white'))
+    for i, thumb in enumerate(thumbs):
+        if thumb is not None:
+            sprite.composite(Image(str(thumb)), i * thumb_width, 0,
+                             CompositeOperator.OverCompositeOp)
+    sprite.write(str(out))
+
+@instrument.timed('storage')
+def get_sprite(paths, store_path=None, thumb_width=None, height=None):
+    '''
+    Returns a file like object containing a sprite sheet of the first
+    thumbnails of the documents at paths, side by side. paths may contain
+    None for empty cells. Sprites are cached and keyed by the names, sizes
+    and inodes of their thumbnails, which stay the same while the
+    thumbnails are looked up, so a sprite is only rebuilt when one of its
+    thumbnails is rendered again.
+    '''
+    if thumb_width is None:
+        thumb_width = settings.THUMB_WIDTH
+    if height is None:
+        height = settings.THUMB_SPRITE_HEIGHT
+
+    thumbs = []
+    key = hashlib.sha1('%d:%d' % (thumb_width, height))
+    for path in paths:
+        thumb = None
+        if path is not None:
+            thumb = get_thumb(path, 0, store_path)
+        if thumb is None:
+            thumbs.append(None)
+            key.update(':')
+            continue
+        st = os.fstat(thumb.fileno())
+        thumbs.append(thumb.name)
+        thumb.close()
+        key.update(':%s:%d:%d' % (thumb.name, st.st_size, st.st_ino))
+
+    def render_sprite(out):
+        _compose_sprite(thumbs, thumb_width, height, out)
+        return True
+    return thumbcache.get(os.path.join(SPRITE_CACHE_DIR, 
+                                       '%s.png' % key.hexdigest()),
+                          render_sprite)
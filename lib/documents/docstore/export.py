@@ -0,0 +1,96 @@
+'''
+Export of a set of documents as a zip archive that is streamed while it
+is built (see zipstream). Documents are read a page at a time and their
+PDFs are copied into the archive in chunks, so memory use doesn't grow
+with the size of the archive.
+'''
+
+from __future__ import with_statement
+
+from documents.docstore import paging, streaming, zipstream
+from documents.docstore.models import prefetch_tags
+
+from tagging.utils import edit_string_for_tags
+
+from django.utils import datetime_safe
+
+import csv
+import os
+import tempfile
+
+BATCH_SIZE = 100
+
+MANIFEST_NAME = u'manifest.csv'
+MANIFEST_FIELDS = ('file', 'title', 'tags', 'archive numbers',
+                   'creation time')
+
+def _unique_name(name, used):
+    '''
+    Return name, made unique among the names in used by a number, and add
+    it to used.
+    '''
+    # Slashes would make directories in the archive.
+    name = name.replace('/', '_').replace('\\', '_')
+    root, ext = os.path.splitext(name)
+    n = 1
+    while name.lower() in used:
+        n += 1
+        name = u'%s-%d%s' % (root, n, ext)
+    used.add(name.lower())
+    return name
+
+def _pages(documents):
+    page = paging.page(documents, BATCH_SIZE)
+    while True:
+        yield page.object_list
+        if not page.has_next():
+            break
+        page = paging.page(documents, BATCH_SIZE, after=page.next_cursor)
+
+def _encode(value):
+    return unicode(value).encode('utf-8')
+
+def archive(documents, storage, manifest=False):
+    '''
+    Yield the strings of a zip archive with the PDFs of documents, named
+    like document_download names them. If manifest is true the archive
+    ends with a CSV file with the title, tags and archive numbers of every
+    document.
+    '''
+    zip_stream = zipstream.ZipStream()
+    used = set()
+    with tempfile.TemporaryFile() as manifest_file:
+        writer = csv.writer(manifest_file)
+        writer.writerow(MANIFEST_FIELDS)
+        for page in _pages(documents):
+            if manifest:
+                page = prefetch_tags(page)
+            for document in page:
+                f = storage.get(document.store_path)
+                if f is None:
+                    continue
+                st = storage.stat(document.store_path)
+                name = _unique_name(document.download_name(), used)
+                for data in zip_stream.add(name, streaming.FileIterator(f),
+                                           st.st_mtime, st.st_size):
+                    yield data
+                if manifest:
+                    writer.writerow([
+                            _encode(name), _encode(document.title or ''),
+                            _encode(edit_string_for_tags(document.tags())),
+                            document.archive_numbers_string(),
+                            # strftime() of datetime fails for years
+                            # before 1900.
+                            datetime_safe.new_datetime(
+                                document.creation_time).strftime(
+                                '%Y-%m-%d %H:%M:%S')])
+
+        if manifest:
+            manifest_file.flush()
+            manifest_size = manifest_file.tell()
+            for data in zip_stream.add(
+                _unique_name(MANIFEST_NAME, used),
+                streaming.FileIterator(manifest_file), size=manifest_size):
+                yield data
+    for data in zip_stream.close():
+        yield data
@@ -0,0 +1,203 @@
+'''
+Full-text index of document contents, titles and tags. The index is a
+SQLite FTS4 table in settings.FULLTEXT_INDEX_PATH with one row per
+document, keyed by Document.id. Text is extracted from the PDFs with
+Ghostscript's txtwrite device. The owner and creation time of every
+document are kept alongside, so that searches return the matches a page
+at a time in the order of paging.
+'''
+
+from documents.docstore import paging
+
+from django.conf import settings
+
+import re
+import sqlite3
+import subprocess
+import threading
+
+_local = threading.local()
+
+SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS document_text
+    USING fts4(title, tags, body);
+CREATE TABLE IF NOT EXISTS document_owner (
+    docid INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    creation_time TEXT NOT NULL DEFAULT '' -- paging.time_key()
+);
+'''
+
+# Created after _migrate(), older indexes lack creation_time.
+INDEXES = '''
+DROP INDEX IF EXISTS document_owner_user;
+CREATE INDEX IF NOT EXISTS document_owner_time
+    ON document_owner (user_id, creation_time, docid);
+'''
+
+# Rows of indexes without creation times are filled in this many at a
+# time.
+MIGRATE_CHUNK_SIZE = 500
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+def _connection():
+    path = settings.FULLTEXT_INDEX_PATH
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != path:
+        conn = sqlite3.connect(path, timeout=30)
+        conn.executescript(SCHEMA)
+        _migrate(conn)
+        conn.executescript(INDEXES)
+        _local.conn = conn
+        _local.path = path
+    return conn
+
+def _migrate(conn):
+    # Add the creation times to an index made before they were kept,
+    # dropping the rows of documents that no longer exist.
+    columns = [row[1] for row in
+               conn.execute('PRAGMA table_info(document_owner)')]
+    if 'creation_time' in columns:
+        return
+    from documents.docstore.models import Document
+    try:
+        conn.execute("ALTER TABLE document_owner "
+                     "ADD COLUMN creation_time TEXT NOT NULL DEFAULT ''")
+        docids = [docid for (docid,) in
+                  conn.execute('SELECT docid FROM document_owner')]
+        for i in range(0, len(docids), MIGRATE_CHUNK_SIZE):
+            times = Document.objects.filter(
+                id__in=docids[i:i + MIGRATE_CHUNK_SIZE]).values_list(
+                'id', 'creation_time')
+            conn.executemany('UPDATE document_owner SET creation_time = ? '
+                             'WHERE docid = ?',
+                             [(paging.time_key(creation_time), id)
+                              for id, creation_time in times])
+        conn.execute("DELETE FROM document_text WHERE docid IN "
+                     "(SELECT docid FROM document_owner "
+                     "WHERE creation_time = '')")
+        conn.execute("DELETE FROM document_owner WHERE creation_time = ''")
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def extract_text(pdf):
+    '''
+    Return the text of pdf as a unicode string.
+    '''
+    p = subprocess.Popen([settings.GHOSTSCRIPT_PATH, '-q', '-dNOPAUSE',
+                          '-dBATCH', '-dSAFER', '-sDEVICE=txtwrite',
+                          '-sOutputFile=-', str(pdf)],
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return out.decode('utf-8', 'replace')
+
+def _update(docid, **columns):
+    conn = _connection()
+    row = conn.execute('SELECT title, tags, body FROM document_text '
+                       'WHERE docid = ?', (docid,)).fetchone()
+    if row is None:
+        row = ('', '', '')
+    values = dict(zip(('title', 'tags', 'body'), row))
+    values.update(columns)
+    # FTS tables can't be upserted, replace the whole row.
+    conn.execute('DELETE FROM document_text WHERE docid = ?', (docid,))
+    conn.execute('INSERT INTO document_text (docid, title, tags, body) '
+                 'VALUES (?, ?, ?, ?)',
+                 (docid, values['title'], values['tags'], values['body']))
+
+def index_metadata(docid, user_id, creation_time, title, tags):
+    '''
+    Index (or re-index) the creation time, title and tags of a document.
+    tags is a tag string. The body of an already indexed document is kept.
+    '''
+    index_metadata_many([(docid, user_id, creation_time, title, tags)])
+
+def index_metadata_many(documents):
+    '''
+    Like index_metadata() for a list of (docid, user_id, creation_time,
+    title, tags) tuples, in a single transaction.
+    '''
+    conn = _connection()
+    try:
+        for docid, user_id, creation_time, title, tags in documents:
+            conn.execute('INSERT OR REPLACE INTO document_owner '
+                         '(docid, user_id, creation_time) VALUES (?, ?, ?)',
+                         (docid, user_id, paging.time_key(creation_time)))
+            _update(docid, title=title or '', tags=tags or '')
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def index_body(docid, body):
+    '''
+    Index (or re-index) the text of a document.
+    '''
+    conn = _connection()
+    try:
+        _update(docid, body=body)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def remove(docid):
+    conn = _connection()
+    try:
+        conn.execute('DELETE FROM document_text WHERE docid = ?', (docid,))
+        conn.execute('DELETE FROM document_owner WHERE docid = ?', (docid,))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def search_keys(user_id, query, limit=None, after=None, before=None):
+    '''
+    Return the (creation_time, id) keys of documents owned by user_id that
+    contain all words in query (as prefixes), in the order of paging: the
+    ones following the key after newest first, or the ones preceding the
+    key before oldest first. At most limit keys are returned, all of them
+    if limit is None.
+    '''
+    if limit is None:
+        # No limit in SQLite.
+        limit = -1
+    terms = TERM_RE.findall(query)
+    if not terms:
+        return []
+    # Lower case keeps terms from being read as operators (AND, OR, NOT).
+    match = ' '.join(['%s*' % term.lower() for term in terms])
+    # The owners are walked in order along document_owner_time and only
+    # until limit matches are found.
+    sql = ('SELECT creation_time, docid FROM document_owner '
+           'WHERE user_id = ? AND docid IN (SELECT docid FROM document_text '
+           'WHERE document_text MATCH ?)')
+    params = [user_id, match]
+    if before is not None:
+        time_str = paging.time_key(before[0])
+        sql += (' AND (creation_time > ? OR (creation_time = ? '
+                'AND docid > ?)) ORDER BY creation_time, docid')
+        params.extend([time_str, time_str, before[1]])
+    else:
+        if after is not None:
+            time_str = paging.time_key(after[0])
+            sql += (' AND (creation_time < ? OR (creation_time = ? '
+                    'AND docid < ?))')
+            params.extend([time_str, time_str, after[1]])
+        sql += ' ORDER BY creation_time DESC, docid DESC'
+    sql += ' LIMIT ?'
+    params.append(limit)
+    return [(paging.parse_time_key(time_str), docid)
+            for time_str, docid in _connection().execute(sql, params)]
+
+def search(user_id, query, limit=None):
+    '''
+    Return the ids of documents owned by user_id that contain all words
+    in query (as prefixes), newest first. At most limit ids are returned,
+    all of them if limit is None.
+    '''
+    return [docid for creation_time, docid in
+            search_keys(user_id, query, limit)]
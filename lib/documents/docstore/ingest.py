@@ -0,0 +1,235 @@
+'''
+Batch ingestion of many documents, from multiple uploaded files and from
+zip archives, in a single request.
+'''
+
+from documents.docstore import docstore, fulltext, tagstats
+from documents.docstore.backends import get_storage
+from documents.docstore.models import Document
+
+from tagging.models import Tag, TaggedItem
+
+from django.conf import settings
+
+import os
+import zipfile
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+
+PDF_MAGIC = '%PDF'
+
+# What zipfile raises for corrupt, encrypted (RuntimeError) or unsupported
+# members.
+ZIP_ERRORS = (zipfile.BadZipfile, RuntimeError, NotImplementedError,
+              zlib.error, IOError, EOFError)
+
+MEMBER_TOO_LARGE = 'Larger than %d bytes when extracted.'
+ARCHIVE_TOO_LARGE = 'The archive is larger than %d bytes when extracted.'
+
+class UnreadableMember(Exception):
+    '''
+    A member of a zip archive can't be read, or is too large.
+    '''
+    pass
+
+class ArchiveSize(object):
+    '''
+    The number of bytes that may still be extracted from an archive.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.remaining = max_bytes
+
+    def extract(self, n):
+        self.remaining -= n
+        if self.remaining < 0:
+            raise UnreadableMember(ARCHIVE_TOO_LARGE % self.max_bytes)
+
+class ArchiveMember(object):
+    '''
+    A PDF in a zip archive, with the name and chunks() of an uploaded file
+    so that it can be passed to the store() of a storage backend. Reading
+    raises UnreadableMember if the member is corrupt or encrypted, or once
+    more than settings.INGEST_MAX_MEMBER_BYTES bytes are extracted from it
+    or the ArchiveSize size of its archive is exceeded.
+    '''
+    def __init__(self, archive, info, size):
+        self.archive = archive
+        self.info = info
+        self.size = size
+        self.name = os.path.basename(info.filename)
+
+    def read_magic(self):
+        try:
+            f = self.archive.open(self.info)
+            try:
+                return f.read(len(PDF_MAGIC))
+            finally:
+                f.close()
+        except ZIP_ERRORS as e:
+            raise UnreadableMember('Unreadable archive member: %s' % e)
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        extracted = 0
+        try:
+            f = self.archive.open(self.info)
+            try:
+                while True:
+                    chunk = f.read(chunk_size)
+                    if not chunk:
+                        break
+                    # Declared sizes can't be trusted, count.
+                    extracted += len(chunk)
+                    if extracted > settings.INGEST_MAX_MEMBER_BYTES:
+                        raise UnreadableMember(
+                            MEMBER_TOO_LARGE
+                            % settings.INGEST_MAX_MEMBER_BYTES)
+                    self.size.extract(len(chunk))
+                    yield chunk
+            finally:
+                f.close()
+        except ZIP_ERRORS as e:
+            raise UnreadableMember('Unreadable archive member: %s' % e)
+
+class UploadedPdf(object):
+    '''
+    Wraps an uploaded file so that its magic can be checked up front.
+    '''
+    def __init__(self, uploaded_file):
+        self.uploaded_file = uploaded_file
+        self.name = uploaded_file.name
+
+    def read_magic(self):
+        self.uploaded_file.seek(0)
+        magic = self.uploaded_file.read(len(PDF_MAGIC))
+        self.uploaded_file.seek(0)
+        return magic
+
+    def chunks(self):
+        return self.uploaded_file.chunks()
+
+class Result(object):
+    '''
+    The outcome of ingesting one file, document is None on failure.
+    '''
+    def __init__(self, name, document=None, error=None):
+        self.name = name
+        self.document = document
+        self.error = error
+
+def expand(uploaded_files, uploaded_archives):
+    '''
+    Return a list of files to ingest and a list of failed Results for
+    archives that could not be read and for archive members that are
+    declared too large.
+    '''
+    files = [UploadedPdf(f) for f in uploaded_files]
+    failures = []
+    for uploaded_archive in uploaded_archives:
+        try:
+            archive = zipfile.ZipFile(uploaded_archive)
+        except zipfile.BadZipfile:
+            failures.append(Result(uploaded_archive.name,
+                                   error='Not a zip archive.'))
+            continue
+        size = ArchiveSize(settings.INGEST_MAX_ARCHIVE_BYTES)
+        declared = 0
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                # A directory.
+                continue
+            # Fail early on what is declared too large, chunks() checks
+            # the actual sizes.
+            name = os.path.basename(info.filename)
+            if info.file_size > settings.INGEST_MAX_MEMBER_BYTES:
+                failures.append(Result(name, error=MEMBER_TOO_LARGE %
+                                       settings.INGEST_MAX_MEMBER_BYTES))
+                continue
+            declared += info.file_size
+            if declared > settings.INGEST_MAX_ARCHIVE_BYTES:
+                failures.append(Result(name, error=ARCHIVE_TOO_LARGE %
+                                       settings.INGEST_MAX_ARCHIVE_BYTES))
+                continue
+            files.append(ArchiveMember(archive, info, size))
+    return files, failures
+
+def _tag_documents(user, documents, tags, tag_changes):
+    '''
+    Tag all documents with the tag string tags, looking up each tag once.
+    '''
+    tag_objects = [Tag.objects.get_or_create(name=name)[0]
+                   for name in tagstats.tag_names(tags)]
+    for document in documents:
+        for tag in tag_objects:
+            TaggedItem.objects.create(tag=tag, object=document)
+    if documents:
+        tag_changes.tags_added(user.id, tags, len(documents))
+
+def create_documents(user, files, tags, archive_numbers,
+                     title_from_file_name, tag_changes):
+    '''
+    Create and store a document for each file in files. Files that are not
+    PDFs or can't be read are skipped. Archive numbers for all stored
+    documents are reserved with a single NumberSequence.reserve() call.
+    Returns a list of Results. The tags are recorded in the
+    tagstats.Changes tag_changes.
+
+    Must be called inside a transaction, which the caller commits before
+    applying tag_changes.
+    '''
+    results = []
+    pdfs = []
+    for f in files:
+        try:
+            magic = f.read_magic()
+        except UnreadableMember as e:
+            results.append(Result(f.name, error=str(e)))
+            continue
+        if magic == PDF_MAGIC:
+            pdfs.append(f)
+        else:
+            results.append(Result(f.name, error='Not a PDF document.'))
+
+    storage = get_storage()
+    documents = []
+    for f in pdfs:
+        if title_from_file_name:
+            title = os.path.splitext(f.name)[0]
+        else:
+            title = None
+        d = Document(user=user, store_path='NOT SET',
+                     archive_numbers_length=archive_numbers,
+                     title=title)
+        d.save()
+        try:
+            d.store_path = storage.store(f, user.username, d.id,
+                                         d.creation_time.timetuple())
+        except docstore.NotAPdf:
+            d.delete()
+            results.append(Result(f.name, error='Not a PDF document.'))
+            continue
+        except UnreadableMember as e:
+            d.delete()
+            results.append(Result(f.name, error=str(e)))
+            continue
+        documents.append(d)
+        results.append(Result(f.name, document=d))
+
+    # Reserved last, the sequence is locked until the caller commits.
+    if archive_numbers is not None and documents:
+        next_number = user.numbersequence.reserve(
+            archive_numbers * len(documents))
+    else:
+        next_number = None
+    for d in documents:
+        if next_number is not None:
+            d.archive_numbers_start = next_number
+            next_number += archive_numbers
+        d.save()
+
+    _tag_documents(user, documents, tags, tag_changes)
+    fulltext.index_metadata_many([(d.id, user.id, d.creation_time, d.title,
+                                   tags)
+                                  for d in documents])
+    return results
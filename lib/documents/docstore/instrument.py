@@ -0,0 +1,188 @@
+'''
+Per-request timing instrumentation. While a request is being handled
+(see middleware.TimingMiddleware) the time spent on database queries,
+storage I/O and template rendering is recorded per category, and finished
+requests are aggregated per URL pattern for the stats view. Outside of
+requests (e.g. in job workers) recording is a no-op.
+'''
+
+from django.conf import settings
+from django.db import connection
+from django.template import loader
+
+import functools
+import math
+import os
+import threading
+import time
+
+_local = threading.local()
+
+_stats_lock = threading.Lock()
+# URL pattern -> list of the timings of the latest requests.
+_stats = {}
+
+class Timing(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+
+def start_request():
+    _local.timings = {}
+
+def finish_request():
+    '''
+    Stop recording and return the timings of the request, a dict that
+    maps categories to Timings.
+    '''
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings or {}
+
+def record(category, seconds=0.0, nbytes=0, count=1):
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return
+    timing = timings.setdefault(category, Timing())
+    timing.count += count
+    timing.seconds += seconds
+    timing.bytes += nbytes
+
+def timed(category):
+    '''
+    Decorator that records the time spent in the decorated function under
+    category. If the function returns a file its size is recorded too.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            result = func(*args, **kwargs)
+            nbytes = 0
+            if hasattr(result, 'fileno'):
+                nbytes = os.fstat(result.fileno()).st_size
+            record(category, time.time() - start, nbytes)
+            return result
+        return wrapper
+    return decorator
+
+class CursorWrapper(object):
+    '''
+    Records the time spent executing queries under 'db'.
+    '''
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            record('db', time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            record('db', time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def instrument_connection():
+    '''
+    Make the database connection of this thread hand out CursorWrappers.
+    Database wrappers are thread local, so this is done once per thread.
+    '''
+    if getattr(connection, '_instrumented', False):
+        return
+    cursor = connection.cursor
+    connection.cursor = lambda: CursorWrapper(cursor())
+    connection._instrumented = True
+
+def _timed_render_to_string(render_to_string):
+    @functools.wraps(render_to_string)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return render_to_string(*args, **kwargs)
+        finally:
+            record('template', time.time() - start)
+    return wrapper
+
+# render_to_response() looks up render_to_string in loader when called.
+if not getattr(loader.render_to_string, '_instrumented', False):
+    loader.render_to_string = _timed_render_to_string(loader.render_to_string)
+    loader.render_to_string._instrumented = True
+
+def server_timing(timings, total):
+    '''
+    Return the value of a Server-Timing header for timings.
+    '''
+    metrics = []
+    for category in sorted(timings):
+        timing = timings[category]
+        desc = '%d calls' % timing.count
+        if timing.bytes:
+            desc += ', %d bytes' % timing.bytes
+        metrics.append('%s;dur=%.1f;desc="%s"'
+                       % (category, timing.seconds * 1000, desc))
+    metrics.append('total;dur=%.1f' % (total * 1000))
+    return ', '.join(metrics)
+
+def add_sample(pattern, timings, total):
+    '''
+    Add the timings of a finished request to the stats of pattern. Only
+    the latest settings.TIMING_SAMPLES requests per pattern are kept.
+    '''
+    sample = dict(total=total)
+    for category, timing in timings.items():
+        sample[category] = timing.seconds
+        sample['%s_count' % category] = timing.count
+        sample['%s_bytes' % category] = timing.bytes
+    _stats_lock.acquire()
+    try:
+        samples = _stats.setdefault(pattern, [])
+        samples.append(sample)
+        del samples[:-settings.TIMING_SAMPLES]
+    finally:
+        _stats_lock.release()
+
+def percentile(values, p):
+    '''
+    Return the p:th percentile (nearest rank) of the sorted list values.
+    '''
+    if not values:
+        return 0
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+METRICS = ('total', 'db', 'db_count', 'template', 'storage', 'storage_bytes',
+           'render')
+
+def stats():
+    '''
+    Return a list of (pattern, number of samples, {metric: (p50, p90,
+    p99)}) tuples aggregated over the requests handled by this process.
+    '''
+    _stats_lock.acquire()
+    try:
+        snapshot = dict((pattern, list(samples))
+                        for pattern, samples in _stats.items())
+    finally:
+        _stats_lock.release()
+    result = []
+    for pattern in sorted(snapshot):
+        samples = snapshot[pattern]
+        metrics = {}
+        for metric in METRICS:
+            values = sorted([sample.get(metric, 0) for sample in samples])
+            metrics[metric] = tuple([percentile(values, p)
+                                     for p in (50, 90, 99)])
+        result.append((pattern, len(samples), metrics))
+    return result
@@ -0,0 +1,156 @@
+'''
+A small persistent job queue. Jobs are rows in the Job table, handlers are
+plain functions registered per job kind and a pool of local worker
+processes carries them out (see the process_jobs management command).
+'''
+
+from documents.docstore.models import Job
+
+from django.db import connection
+from django.utils import simplejson
+
+import datetime
+import errno
+import multiprocessing
+import os
+import socket
+import time
+import traceback
+
+_handlers = {}
+
+def register(kind, handler):
+    '''
+    Register handler as the function that carries out jobs of kind. The
+    handler is called with the keyword arguments given to enqueue().
+    '''
+    _handlers[kind] = handler
+
+def enqueue(kind, document_id=None, **kwargs):
+    '''
+    Queue a job of kind and return it. The job is saved in the current
+    transaction, so it will only be seen by workers if that transaction
+    is committed.
+    '''
+    job = Job(kind=kind, document_id=document_id,
+              payload=simplejson.dumps(kwargs))
+    job.save()
+    return job
+
+def status(document_id, kind):
+    '''
+    Return the status of the latest job of kind for a document or None if
+    no such job has been queued.
+    '''
+    jobs = (Job.objects.filter(document=document_id, kind=kind)
+            .order_by('-id').values_list('status', flat=True)[:1])
+    if not jobs:
+        return None
+    return jobs[0]
+
+def is_pending(document_id, kind):
+    return status(document_id, kind) in (Job.PENDING, Job.RUNNING)
+
+def _claim(limit):
+    '''
+    Mark up to limit pending jobs as running and return them. A job is
+    only returned to the worker that managed to change its status.
+    '''
+    claimed = []
+    worker = worker_id()
+    for job in Job.objects.filter(status=Job.PENDING)[:limit]:
+        if Job.objects.filter(id=job.id,
+                              status=Job.PENDING).update(status=Job.RUNNING,
+                                                         worker=worker):
+            claimed.append(job)
+    return claimed
+
+def _execute(kind, payload):
+    '''
+    Run a job in a worker process. Returns None on success and a
+    formatted traceback on failure.
+    '''
+    try:
+        kwargs = dict((str(k), v)
+                      for k, v in simplejson.loads(payload or '{}').items())
+        _handlers[kind](**kwargs)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+def _finish(job, error):
+    if error is None:
+        status = Job.DONE
+    else:
+        status = Job.FAILED
+    Job.objects.filter(id=job.id).update(status=status, error=error or '',
+                                         finished_time=datetime.datetime.now())
+
+def worker_id(pid=None):
+    if pid is None:
+        pid = os.getpid()
+    return '%s:%d' % (socket.gethostname(), pid)
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def reset_running():
+    '''
+    Put jobs left running by process_jobs instances on this host that
+    died back in the queue. Jobs of live instances, and of instances on
+    other hosts, are left alone.
+    '''
+    host = socket.gethostname()
+    dead = []
+    workers = (Job.objects.filter(status=Job.RUNNING)
+               .values_list('worker', flat=True).distinct())
+    for worker in workers:
+        worker_host, sep, pid = worker.rpartition(':')
+        if worker and worker_host != host:
+            continue
+        try:
+            if _is_alive(int(pid)):
+                continue
+        except ValueError:
+            pass
+        dead.append(worker)
+    if not dead:
+        return 0
+    return (Job.objects.filter(status=Job.RUNNING, worker__in=dead)
+            .update(status=Job.PENDING, worker=''))
+
+def _init_worker():
+    # The pool was forked from a process that may have used the database
+    # since. Drop an inherited connection without closing it, closing
+    # would end the session of the parent.
+    connection.connection = None
+
+def work(workers, poll_interval=2, once=False):
+    '''
+    Carry out queued jobs using a pool of workers processes. Polls the job
+    table every poll_interval seconds when the queue is empty. If once is
+    true, return as soon as the queue is empty.
+    '''
+    # Workers must not share the database connection of this process.
+    connection.close()
+    pool = multiprocessing.Pool(workers, _init_worker)
+    try:
+        while True:
+            jobs = _claim(workers)
+            if not jobs:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+            results = [(job, pool.apply_async(_execute,
+                                              (job.kind, job.payload)))
+                       for job in jobs]
+            for job, result in results:
+                _finish(job, result.get())
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,254 @@
+'''
+Offline maintenance of the store: verifying documents against their
+manifests, rebuilding missing thumbnails and finding (and removing)
+orphaned files, i.e. files that no Document refers to. Document rows are
+read in id order and the store is walked in sorted order, a batch or a
+directory at a time, and the position in both is checkpointed so that an
+interrupted run over a large store resumes where it stopped. See the
+maintain_store management command.
+'''
+
+from __future__ import with_statement
+
+from documents.docstore import docstore, packs
+from documents.docstore.models import Blob, Document
+
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+
+import multiprocessing
+import os
+import tempfile
+import time
+
+BATCH_SIZE = 500
+
+# The checkpoint is saved after this many directories.
+DIRECTORIES_PER_CHECKPOINT = 100
+
+class Checkpoint(object):
+    '''
+    The progress of a run, a dict saved as JSON to path. A path of None
+    disables checkpointing.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.state = simplejson.load(f)
+
+    def get(self, name, default=None):
+        return self.state.get(name, default)
+
+    def set(self, name, value):
+        self.state[name] = value
+
+    def save(self):
+        if self.path is None:
+            return
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            simplejson.dump(self.state, f)
+        os.rename(tmp_path, self.path)
+
+    def clear(self):
+        self.state = {}
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+def documents(after=0, batch_size=BATCH_SIZE):
+    '''
+    Yield lists of (id, store_path) of the documents with ids greater than
+    after, in id order.
+    '''
+    while True:
+        batch = list(Document.objects.filter(id__gt=after).order_by('id')
+                     .values_list('id', 'store_path')[:batch_size])
+        if not batch:
+            return
+        yield batch
+        after = batch[-1][0]
+
+def _parts(relative_dir):
+    if relative_dir == os.curdir:
+        return ()
+    return tuple(relative_dir.split(os.sep))
+
+def directories(store_path, after=None):
+    '''
+    Yield (relative path, sorted file names) of the directories in
+    store_path, in sorted order. Directories up to and including after (a
+    relative path yielded before) are skipped without being walked.
+    '''
+    if after is not None:
+        after = _parts(after)
+    for dir, dir_names, file_names in os.walk(store_path):
+        relative_dir = os.path.relpath(dir, store_path)
+        parts = _parts(relative_dir)
+        dir_names.sort()
+        if after is not None:
+            # Walk only subdirectories that contain directories after
+            # after.
+            dir_names[:] = [name for name in dir_names
+                            if parts + (name,) >= after[:len(parts) + 1]]
+            if parts <= after:
+                continue
+        yield relative_dir, sorted(file_names)
+
+def _relative_path(relative_dir, name):
+    if relative_dir == os.curdir:
+        return name
+    return os.path.join(relative_dir, name)
+
+def find_orphans(relative_dir, names, store_path, min_age):
+    '''
+    Return the relative paths and sizes of the files among names in
+    relative_dir that belong to no document. Files modified less than
+    min_age seconds ago are left alone, they may belong to documents that
+    are being stored.
+    '''
+    pdfs = [_relative_path(relative_dir, name) for name in names
+            if name.endswith('.pdf')]
+    owned = set()
+    for i in range(0, len(pdfs), BATCH_SIZE):
+        referenced = Document.objects.filter(
+            store_path__in=pdfs[i:i + BATCH_SIZE])
+        for path in referenced.values_list('store_path', flat=True):
+            owned.update(docstore.files(path, store_path))
+
+    limit = time.time() - min_age
+    orphans = []
+    for name in names:
+        if name in owned:
+            continue
+        path = _relative_path(relative_dir, name)
+        try:
+            st = os.stat(os.path.join(store_path, path))
+        except OSError:
+            continue
+        if st.st_mtime > limit:
+            continue
+        orphans.append((path, st.st_size))
+    return orphans
+
+def remove_orphan(path, store_path):
+    '''
+    Remove the orphaned file at path, along with the files of the document
+    if it is a PDF.
+    '''
+    if path.endswith('.pdf'):
+        digest = docstore.blob_digest(path)
+        if digest is not None:
+            Blob.objects.filter(digest=digest).delete()
+        docstore.remove_files(path, store_path)
+    try:
+        os.remove(os.path.join(store_path, path))
+    except OSError:
+        pass
+
+def missing_thumbs(path, store_path):
+    '''
+    Return whether thumbnails that the manifest of the document at path
+    lists are missing from the store. Thumbnails that are rendered on
+    demand into the thumbnail cache are not expected to exist, and packed
+    documents keep theirs in the pack.
+    '''
+    full_path = os.path.join(store_path, path)
+    if not os.path.exists(full_path):
+        return False
+    dir = os.path.dirname(full_path)
+    for name in docstore.files(path, store_path):
+        if (name != os.path.basename(path)
+            and not name.endswith(docstore.MANIFEST_EXT)
+            and not os.path.exists(os.path.join(dir, name))):
+            return True
+    return False
+
+def _rebuild_thumbs(args):
+    path, store_path = args
+    try:
+        docstore.generate_thumbs(os.path.join(store_path, path),
+                                 settings.THUMB_WIDTH, workers=1)
+    except Exception as e:
+        return path, str(e)
+    return path, None
+
+def run(out, store_path=None, verify=True, thumbs=True, orphans=True,
+        delete=False, workers=None, min_age=24 * 60 * 60,
+        checkpoint=None):
+    '''
+    Run the maintenance tasks, writing a line per finding to the file out,
+    and return a dict of totals. checkpoint is a Checkpoint, the run
+    resumes from it and clears it when done.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+    if workers is None:
+        workers = settings.THUMB_WORKERS
+    if checkpoint is None:
+        checkpoint = Checkpoint(None)
+    totals = dict(documents=0, problems=0, thumbs=0, thumb_errors=0,
+                  orphans=0, orphan_bytes=0, removed=0)
+
+    pool = None
+    if thumbs and workers > 1:
+        # Children must not share the database connection.
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+    try:
+        if verify or thumbs:
+            for batch in documents(checkpoint.get('documents', 0)):
+                rebuild = []
+                for id, path in batch:
+                    totals['documents'] += 1
+                    if verify:
+                        for problem in docstore.verify(path, store_path):
+                            totals['problems'] += 1
+                            out.write('verify: document %d: %s\n'
+                                      % (id, problem))
+                    if thumbs and missing_thumbs(path, store_path):
+                        rebuild.append((path, store_path))
+                if pool is not None:
+                    results = pool.map(_rebuild_thumbs, rebuild)
+                else:
+                    results = map(_rebuild_thumbs, rebuild)
+                for path, error in results:
+                    if error is None:
+                        totals['thumbs'] += 1
+                        out.write('thumbs: %s: rebuilt\n' % path)
+                    else:
+                        totals['thumb_errors'] += 1
+                        out.write('thumbs: %s: %s\n' % (path, error))
+                checkpoint.set('documents', batch[-1][0])
+                checkpoint.save()
+
+        if orphans:
+            count = 0
+            for relative_dir, names in directories(
+                store_path, checkpoint.get('directories')):
+                if _parts(relative_dir)[:1] == (packs.PACK_DIR,):
+                    continue
+                for path, size in find_orphans(relative_dir, names,
+                                               store_path, min_age):
+                    totals['orphans'] += 1
+                    totals['orphan_bytes'] += size
+                    if delete:
+                        remove_orphan(path, store_path)
+                        totals['removed'] += 1
+                        out.write('orphan: %s (%d bytes): removed\n'
+                                  % (path, size))
+                    else:
+                        out.write('orphan: %s (%d bytes)\n' % (path, size))
+                count += 1
+                if count % DIRECTORIES_PER_CHECKPOINT == 0:
+                    checkpoint.set('directories', relative_dir)
+                    checkpoint.save()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    checkpoint.clear()
+    return totals
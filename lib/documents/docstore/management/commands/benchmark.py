@@ -0,0 +1,48 @@
+from __future__ import with_statement
+
+from documents.docstore import benchmark
+
+from django.core.management.base import CommandError, NoArgsCommand
+from django.utils import simplejson
+
+from optparse import make_option
+import sys
+
+def _int_list(value):
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise CommandError('Expected a comma separated list of integers: %s'
+                           % value)
+
+class Command(NoArgsCommand):
+    help = ('Benchmark storing, thumbnailing, listing and downloading '
+            'synthetic documents and write the results as JSON.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--pages', dest='pages', default='1,10,50',
+                    help='Page counts of the synthetic PDFs.'),
+        make_option('--archives', dest='archives', default='100,1000',
+                    help='Number of documents in the synthetic archives.'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Number of runs of each measurement.'),
+        make_option('--only', dest='only', default=','.join(benchmark.BENCHMARKS),
+                    help='Benchmarks to run, out of %s.' 
+                    % ', '.join(benchmark.BENCHMARKS)),
+        make_option('--output', dest='output', default=None,
+                    help='Write the results to this file instead of stdout.'),
+    )
+
+    def handle_noargs(self, **options):
+        only = options['only'].split(',')
+        for name in only:
+            if name not in benchmark.BENCHMARKS:
+                raise CommandError('Unknown benchmark: %s' % name)
+        results = benchmark.run(_int_list(options['pages']),
+                                _int_list(options['archives']),
+                                options['repeat'], only)
+        output = simplejson.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output)
+        else:
+            sys.stdout.write(output + '\n')
@@ -0,0 +1,56 @@
+from documents.docstore import maintenance
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from optparse import make_option
+import sys
+
+class Command(NoArgsCommand):
+    help = ('Verify stored documents, rebuild missing thumbnails and find '
+            'orphaned files. Without task options all tasks are run, '
+            'orphans are only reported unless --delete is given.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--verify', action='store_true', dest='verify',
+                    default=False,
+                    help='Check documents against their manifests.'),
+        make_option('--thumbs', action='store_true', dest='thumbs',
+                    default=False,
+                    help='Rebuild missing thumbnails.'),
+        make_option('--orphans', action='store_true', dest='orphans',
+                    default=False,
+                    help='Find files that belong to no document.'),
+        make_option('--delete', action='store_true', dest='delete',
+                    default=False,
+                    help='Remove the orphaned files.'),
+        make_option('--workers', type='int', dest='workers',
+                    default=settings.THUMB_WORKERS,
+                    help='Number of processes rebuilding thumbnails.'),
+        make_option('--min-age', type='float', dest='min_age', default=24,
+                    help='Only files older than this many hours can be '
+                    'orphans.'),
+        make_option('--checkpoint', dest='checkpoint',
+                    default=settings.MAINTENANCE_CHECKPOINT_PATH,
+                    help='Resume from and save progress to this file.'),
+        make_option('--restart', action='store_true', dest='restart',
+                    default=False,
+                    help='Ignore the saved progress.'),
+    )
+
+    def handle_noargs(self, **options):
+        tasks = dict((task, options[task])
+                     for task in ('verify', 'thumbs', 'orphans'))
+        if not any(tasks.values()):
+            tasks = dict((task, True) for task in tasks)
+        checkpoint = maintenance.Checkpoint(options['checkpoint'])
+        if options['restart']:
+            checkpoint.clear()
+        totals = maintenance.run(sys.stdout, delete=options['delete'],
+                                 workers=options['workers'],
+                                 min_age=options['min_age'] * 60 * 60,
+                                 checkpoint=checkpoint, **tasks)
+        sys.stdout.write(
+            '%(documents)d documents, %(problems)d problems, '
+            '%(thumbs)d thumbnails rebuilt (%(thumb_errors)d failed), '
+            '%(orphans)d orphans of %(orphan_bytes)d bytes '
+            '(%(removed)d removed)\n' % totals)
@@ -0,0 +1,39 @@
+from documents.docstore import docstore
+from documents.docstore.models import Document
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from optparse import make_option
+import datetime
+import sys
+
+BATCH_SIZE = 500
+
+class Command(NoArgsCommand):
+    help = ('Move documents older than --min-age days, with their '
+            'thumbnails, into compressed pack files.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--min-age', type='int', dest='min_age',
+                    default=settings.PACK_MIN_AGE_DAYS,
+                    help='Age in days of the documents to pack.'),
+        make_option('--max-bytes', type='int', dest='max_bytes',
+                    default=settings.PACK_MAX_BYTES,
+                    help='Size of the pack files.'),
+    )
+
+    def handle_noargs(self, **options):
+        limit = (datetime.datetime.now()
+                 - datetime.timedelta(days=options['min_age']))
+        documents = Document.objects.filter(creation_time__lt=limit)
+        last = 0
+        total = 0
+        while True:
+            batch = list(documents.filter(id__gt=last).order_by('id')
+                         .values_list('id', 'store_path')[:BATCH_SIZE])
+            if not batch:
+                break
+            last = batch[-1][0]
+            total += docstore.pack_documents([path for id, path in batch],
+                                             max_bytes=options['max_bytes'])
+        sys.stdout.write('%d documents packed\n' % total)
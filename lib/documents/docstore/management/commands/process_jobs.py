@@ -0,0 +1,23 @@
+# docstore is imported for its side effect of registering job handlers.
+from documents.docstore import docstore, jobs
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from optparse import make_option
+
+class Command(NoArgsCommand):
+    help = 'Carry out queued background jobs, e.g. thumbnail generation.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers',
+                    default=settings.JOB_WORKERS,
+                    help='Number of worker processes.'),
+        make_option('--once', action='store_true', dest='once', 
+                    default=False,
+                    help='Exit when the queue is empty.'),
+    )
+
+    def handle_noargs(self, **options):
+        jobs.reset_running()
+        jobs.work(options['workers'], settings.JOB_POLL_INTERVAL,
+                  once=options['once'])
@@ -0,0 +1,33 @@
+from documents.docstore import instrument, urls
+
+import time
+
+def _url_pattern(request):
+    path = request.path_info.lstrip('/')
+    for pattern in urls.urlpatterns:
+        if pattern.regex.search(path):
+            return pattern.regex.pattern
+    return 'other'
+
+class TimingMiddleware(object):
+    '''
+    Records the time each request spends on queries, storage I/O and
+    template rendering (see the instrument module), reports it in a
+    Server-Timing header and adds it to the stats of the request's URL
+    pattern in docstore/urls.py. Should be the first middleware.
+    '''
+    def process_request(self, request):
+        instrument.instrument_connection()
+        instrument.start_request()
+        request._timing_start = time.time()
+
+    def process_response(self, request, response):
+        start = getattr(request, '_timing_start', None)
+        if start is None:
+            # An earlier middleware returned a response.
+            return response
+        total = time.time() - start
+        timings = instrument.finish_request()
+        response['Server-Timing'] = instrument.server_timing(timings, total)
+        instrument.add_sample(_url_pattern(request), timings, total)
+        return response
@@ -1,7 +1,8 @@
-from tagging.models import Tag
+from tagging.models import Tag, TaggedItem
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 
 import os
 
@@ -14,9 +15,12 @@ class Document(models.Model):
     title = models.CharField(max_length=200, null=True, blank=True)
 
     class Meta:
-        ordering = ('-creation_time',)
+        # (creation_time, id) is also the key of docstore.paging.
+        ordering = ('-creation_time', '-id')
 
     def tags(self):
+        if hasattr(self, '_prefetched_tags'):
+            return self._prefetched_tags
         return Tag.objects.get_for_object(self)
 
     def archive_numbers_string(self):
@@ -30,21 +34,193 @@ class Document(models.Model):
                               self.archive_numbers_start + 
                               self.archive_numbers_length - 1)
 
+    def download_name(self):
+        if self.title is None:
+            return os.path.basename(self.store_path)
+        # Translate document title to a safe(?) file name.
+        # This need more thought. How can we derive a portable file
+        # name from the document title?
+        table = {ord(' ') : u'_', ord("'") : u'_'}
+        return '%s.pdf' % self.title.translate(table).lower()
+
     def __unicode__(self):
         if self.title:
             return self.title
         else:
             return os.path.basename(self.store_path)
 
+def prefetch_tags(documents):
+    '''
+    Load the tags of all documents with a single query and attach them to
+    the documents, so that Document.tags() doesn't have to query the
+    database for each document. Returns the documents as a list.
+    '''
+    documents = list(documents)
+    by_id = {}
+    for document in documents:
+        document._prefetched_tags = []
+        by_id[document.id] = document
+    if not documents:
+        return documents
+    content_type = ContentType.objects.get_for_model(Document)
+    items = (TaggedItem.objects
+             .filter(content_type=content_type, object_id__in=by_id.keys())
+             .select_related('tag').order_by('tag__name'))
+    for item in items:
+        by_id[item.object_id]._prefetched_tags.append(item.tag)
+    return documents
+
 class NumberSequence(models.Model):
     user = models.OneToOneField(User)
     next_free_number = models.IntegerField(default=1)
 
     def reserve(self, n):
-        next = self.next_free_number
-        self.next_free_number += n
-        self.save()
-        return next
+        '''
+        Reserve n consecutive numbers and return the first one. The
+        counter is incremented by the database, so concurrent reservations
+        (also through stale instances) never overlap. The row stays locked
+        until the transaction commits; reserve as late as possible in long
+        transactions.
+        '''
+        managed = transaction.is_managed()
+        if not managed:
+            # Keep the increment and the read back in one transaction.
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+        try:
+            sequences = NumberSequence.objects.filter(id=self.id)
+            sequences.update(next_free_number=models.F('next_free_number') + n)
+            self.next_free_number = sequences.values_list(
+                'next_free_number', flat=True).get()
+            if not managed:
+                transaction.commit()
+        except:
+            if not managed:
+                transaction.rollback()
+            raise
+        finally:
+            if not managed:
+                transaction.leave_transaction_management()
+        return self.next_free_number - n
 
     def __unicode__(self):
         return 'next: %d' % self.next_free_number
+
+class BlobManager(models.Manager):
+    def acquire(self, digest):
+        '''
+        Add a reference to the blob with digest, creating it if needed.
+        Returns True if the blob is new.
+        '''
+        while True:
+            if self.filter(digest=digest).update(
+                references=models.F('references') + 1):
+                return False
+            # The savepoint keeps the transaction usable (on PostgreSQL)
+            # if the insert fails.
+            sid = transaction.savepoint()
+            try:
+                self.create(digest=digest, references=1)
+            except IntegrityError:
+                # Created meanwhile by a concurrent upload of the same
+                # content, add the reference to it instead.
+                transaction.savepoint_rollback(sid)
+                continue
+            transaction.savepoint_commit(sid)
+            return True
+
+    def release(self, digest):
+        '''
+        Remove a reference to the blob with digest. Returns True if that
+        was the last reference, in which case the blob is deleted.
+        '''
+        self.filter(digest=digest).update(
+            references=models.F('references') - 1)
+        references = self.filter(digest=digest).values_list('references',
+                                                            flat=True)
+        if references and references[0] > 0:
+            return False
+        self.filter(digest=digest).delete()
+        return True
+
+class Blob(models.Model):
+    '''
+    Content stored once under its digest and shared by all documents with
+    that content (see docstore.store).
+    '''
+    digest = models.CharField(max_length=40, unique=True)
+    references = models.IntegerField(default=0)
+
+    objects = BlobManager()
+
+    def __unicode__(self):
+        return '%s (%d)' % (self.digest, self.references)
+
+class Job(models.Model):
+    '''
+    A unit of background work, e.g. generating the thumbnails of a newly
+    stored document. Jobs are queued by docstore and carried out by the
+    process_jobs management command.
+    '''
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'),
+                      (RUNNING, 'Running'),
+                      (DONE, 'Done'),
+                      (FAILED, 'Failed'))
+
+    kind = models.CharField(max_length=50)
+    document = models.ForeignKey(Document, null=True, blank=True)
+    payload = models.TextField(blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    finished_time = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    # host:pid of the process_jobs instance running the job.
+    worker = models.CharField(max_length=100, blank=True)
+
+    class Meta:
+        ordering = ('id',)
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.kind, self.status)
+
+class Upload(models.Model):
+    '''
+    A chunked upload in progress (see docstore.uploads). The data received
+    so far is kept in a temporary file until the upload is finalized.
+    '''
+    user = models.ForeignKey(User)
+    name = models.CharField(max_length=200)
+    # The expected size in bytes, if the client told us.
+    size = models.BigIntegerField(null=True, blank=True)
+    received = models.BigIntegerField(default=0)
+    title = models.CharField(max_length=200, null=True, blank=True)
+    tags = models.CharField(max_length=255, blank=True)
+    archive_numbers = models.IntegerField(null=True, blank=True)
+    created_time = models.DateTimeField(auto_now_add=True)
+    updated_time = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __unicode__(self):
+        return '%s (%d bytes)' % (self.name, self.received)
+
+class PackEntry(models.Model):
+    '''
+    A file of a document that was moved from the store into a compressed
+    pack file (see docstore.packs).
+    '''
+    # Relative paths in the store, of the file and of the document's PDF.
+    path = models.CharField(max_length=200, unique=True)
+    document = models.CharField(max_length=200, db_index=True)
+    pack = models.CharField(max_length=100, db_index=True)
+    offset = models.BigIntegerField()
+    # The compressed and the original size in bytes.
+    length = models.BigIntegerField()
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+
+    def __unicode__(self):
+        return '%s (%s)' % (self.path, self.pack)
@@ -0,0 +1,326 @@
+'''
+Compressed pack files for documents that are rarely read. Many files (the
+PDFs and thumbnails of many documents) are compressed one by one with zlib
+and appended to a pack file in the directory PACK_DIR of the store. The
+offset and length of every file in its pack are kept in PackEntry rows, so
+a file is read back by seeking to its offset and decompressing as it is
+streamed. See docstore.pack_documents() and the pack_documents management
+command.
+'''
+
+from __future__ import with_statement
+
+from documents.docstore.models import PackEntry
+
+from django.conf import settings
+from django.db import transaction
+
+import errno
+import os
+import tempfile
+import zlib
+
+PACK_DIR = 'packs'
+PACK_EXT = '.pack'
+
+BLOCK_SIZE = 64 * 1024
+
+class PackedStat(object):
+    '''
+    The st_size and st_mtime of a packed file, as os.stat() would return
+    them for the original.
+    '''
+    def __init__(self, entry):
+        self.st_size = entry.size
+        self.st_mtime = entry.mtime
+
+class PackedFile(object):
+    '''
+    A read only file like object with the content of a packed file. The
+    content is decompressed as it is read; seeking backwards starts over.
+    It has no name or fileno(), since there is no file to hand to the web
+    server or to map.
+    '''
+    def __init__(self, pack_path, entry):
+        self._file = open(pack_path, 'rb')
+        self._offset = entry.offset
+        self._length = entry.length
+        self._size = entry.size
+        self._rewind()
+
+    def _rewind(self):
+        self._file.seek(self._offset)
+        self._remaining = self._length
+        self._decompressor = zlib.decompressobj()
+        self._buffer = ''
+        self._pos = 0
+
+    def _decompress(self):
+        while True:
+            data = self._decompressor.unconsumed_tail
+            if not data and self._remaining:
+                data = self._file.read(min(BLOCK_SIZE, self._remaining))
+                if not data:
+                    raise IOError('truncated pack file')
+                self._remaining -= len(data)
+            if not data:
+                return self._decompressor.flush()
+            out = self._decompressor.decompress(data, BLOCK_SIZE)
+            if out:
+                return out
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._size - self._pos
+        size = min(size, self._size - self._pos)
+        chunks = [self._buffer]
+        available = len(self._buffer)
+        while available < size:
+            chunk = self._decompress()
+            if not chunk:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+        data = ''.join(chunks)
+        self._buffer = data[size:]
+        data = data[:size]
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise IOError('negative seek offset')
+        if offset < self._pos:
+            self._rewind()
+        while self._pos < offset and self._pos < self._size:
+            self.read(min(BLOCK_SIZE, offset - self._pos))
+        # Like files, allow seeking beyond the end.
+        self._pos = max(self._pos, offset)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _pack_path(store_path, pack):
+    return os.path.join(store_path, PACK_DIR, pack)
+
+def lookup(path):
+    '''
+    Return the PackEntry of the file at path or None if it isn't packed.
+    '''
+    try:
+        return PackEntry.objects.get(path=path)
+    except PackEntry.DoesNotExist:
+        return None
+
+def is_packed(document):
+    return PackEntry.objects.filter(document=document).exists()
+
+def open_file(path, store_path=None):
+    '''
+    Return a PackedFile with the content of the packed file at path or
+    None if it isn't packed.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+    entry = lookup(path)
+    if entry is None:
+        return None
+    return PackedFile(_pack_path(store_path, entry.pack), entry)
+
+def stat(path):
+    entry = lookup(path)
+    if entry is None:
+        return None
+    return PackedStat(entry)
+
+def extract(path, out, store_path=None):
+    '''
+    Write the content of the packed file at path to the file out. Returns
+    False if it isn't packed.
+    '''
+    f = open_file(path, store_path)
+    if f is None:
+        return False
+    with f:
+        with open(out, 'wb') as o:
+            while True:
+                data = f.read(BLOCK_SIZE)
+                if not data:
+                    break
+                o.write(data)
+    return True
+
+def size(document):
+    '''
+    Return the number of bytes the files of document take in packs.
+    '''
+    return sum(PackEntry.objects.filter(document=document)
+               .values_list('length', flat=True))
+
+def verify(document, store_path=None):
+    '''
+    Check that the packed files of document are within their packs and
+    return a list of problems.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+    problems = []
+    for entry in PackEntry.objects.filter(document=document):
+        try:
+            pack_size = os.stat(_pack_path(store_path, entry.pack)).st_size
+        except OSError:
+            problems.append('%s: pack %s missing' % (entry.path, entry.pack))
+            continue
+        if entry.offset + entry.length > pack_size:
+            problems.append('%s: beyond the end of pack %s'
+                            % (entry.path, entry.pack))
+    return problems
+
+def forget(documents):
+    '''
+    Delete the PackEntry rows of the packed files of documents and return
+    the names of the packs that have no files left, for remove_packs().
+    '''
+    entries = PackEntry.objects.filter(document__in=documents)
+    names = set(entries.values_list('pack', flat=True))
+    entries.delete()
+    return [name for name in names
+            if not PackEntry.objects.filter(pack=name).exists()]
+
+def remove_packs(names, store_path=None):
+    '''
+    Delete the packs with names, which forget() returned.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+    for name in names:
+        try:
+            os.remove(_pack_path(store_path, name))
+        except OSError:
+            pass
+
+def remove(document, store_path=None):
+    '''
+    Forget the packed files of document. Packs are deleted when none of
+    their files are left.
+    '''
+    remove_packs(forget([document]), store_path)
+
+def _append(pack, full_path, level):
+    '''
+    Append the compressed content of the file at full_path to the open
+    file pack and return its length in the pack.
+    '''
+    compressor = zlib.compressobj(level)
+    length = 0
+    with open(full_path, 'rb') as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            out = compressor.compress(data)
+            pack.write(out)
+            length += len(out)
+    out = compressor.flush()
+    pack.write(out)
+    return length + len(out)
+
+@transaction.commit_on_success
+def _add_entries(entries):
+    for entry in entries:
+        entry.save()
+
+def _write_pack(documents, store_path, max_bytes, level):
+    '''
+    Write the files of documents (a list of (document, files) tuples of
+    relative paths) to a new pack until it holds max_bytes. Returns the
+    number of documents that were consumed and the list of those that
+    were packed. Documents with a file that was deleted meanwhile are
+    consumed but not packed, none of their files are.
+    '''
+    # Packs are only read through the entries added below, so they can
+    # be written in place.
+    fd, pack_path = tempfile.mkstemp(dir=os.path.join(store_path, PACK_DIR),
+                                     prefix='pack-', suffix=PACK_EXT)
+    name = os.path.basename(pack_path)
+    entries = []
+    packed = []
+    consumed = 0
+    committed = False
+    try:
+        with os.fdopen(fd, 'wb') as pack:
+            offset = 0
+            for document, files in documents:
+                if offset >= max_bytes:
+                    break
+                consumed += 1
+                document_offset = offset
+                document_entries = []
+                for path in files:
+                    full_path = os.path.join(store_path, path)
+                    try:
+                        st = os.stat(full_path)
+                        length = _append(pack, full_path, level)
+                    except (IOError, OSError) as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        # Deleted meanwhile, leave the document alone.
+                        pack.seek(document_offset)
+                        pack.truncate()
+                        offset = document_offset
+                        document_entries = None
+                        break
+                    document_entries.append(
+                        PackEntry(path=path, document=document, pack=name,
+                                  offset=offset, length=length,
+                                  size=st.st_size, mtime=st.st_mtime))
+                    offset += length
+                if document_entries:
+                    entries.extend(document_entries)
+                    packed.append(document)
+            pack.flush()
+            os.fsync(pack.fileno())
+        if not entries:
+            return consumed, []
+        _add_entries(entries)
+        committed = True
+    finally:
+        if not committed:
+            os.remove(pack_path)
+    return consumed, packed
+
+def pack(documents, store_path=None, max_bytes=None, level=None,
+         packed=None):
+    '''
+    Compress the files of documents (a list of (document, files) tuples
+    of relative paths) into as many packs of about max_bytes as needed.
+    Whenever a pack is complete packed(documents) is called with the
+    documents in it, which can then be removed from the store.
+    '''
+    if store_path is None:
+        store_path = settings.DOCUMENTSTORE_PATH
+    if max_bytes is None:
+        max_bytes = settings.PACK_MAX_BYTES
+    if level is None:
+        level = settings.PACK_COMPRESSION_LEVEL
+    pack_dir = os.path.join(store_path, PACK_DIR)
+    if not os.path.exists(pack_dir):
+        os.makedirs(pack_dir)
+    while documents:
+        consumed, done = _write_pack(documents, store_path, max_bytes, level)
+        documents = documents[consumed:]
+        if packed is not None and done:
+            packed(done)
@@ -0,0 +1,143 @@
+'''
+Cache of rendered document listings for the index and search pages.
+
+Every user has a generation number that is bumped (see bump()) whenever
+something shown in the listings of that user changes: uploads, deletes,
+property edits and indexed document text. Fragments are cached under
+keys that include the generation, so bumping it makes all cached
+listings of the user unreachable and they eventually fall out of the
+cache.
+
+The generations are kept in the cache backend so that all processes see
+them; they are initialized from the clock so that a lost generation is
+never reused. The fragments themselves are kept in a least recently used
+cache of settings.PAGE_CACHE_SIZE entries in this process, so a hit costs
+one cache backend lookup and no database or template work. With a cache
+backend that isn't shared between processes (see LOCAL_BACKENDS) the
+bumps of other web server processes and of process_jobs would be missed,
+so nothing is cached then.
+'''
+
+from django.conf import settings
+from django.core.cache import cache
+
+import threading
+import time
+
+# The cache is shrunk to this fraction of its size when full.
+EVICT_TO = 0.9
+
+# Far longer than listings are browsed; a generation that expires is
+# replaced by a larger one anyway.
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+# Schemes of settings.CACHE_BACKEND whose contents are private to a
+# process.
+LOCAL_BACKENDS = ('locmem', 'dummy')
+
+_lock = threading.Lock()
+# key -> [last use, fragment]
+_entries = {}
+_clock = [0]
+
+def _generation_key(user_id):
+    return 'docstore-generation-%d' % user_id
+
+def generation(user_id):
+    '''
+    Return the current generation of the listings of user_id.
+    '''
+    key = _generation_key(user_id)
+    value = cache.get(key)
+    if value is None:
+        value = int(time.time() * 1000)
+        if not cache.add(key, value, GENERATION_TIMEOUT):
+            # Initialized concurrently.
+            value = cache.get(key, value)
+    return value
+
+def bump(user_id):
+    '''
+    Invalidate the cached listings of user_id. Call this after changes
+    are committed, otherwise a listing of the old state can be cached
+    under the new generation.
+    '''
+    key = _generation_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Not set, the next generation() starts from the clock.
+        pass
+
+def _tick():
+    _clock[0] += 1
+    return _clock[0]
+
+def lookup(key):
+    '''
+    Return the fragment cached under key or None.
+    '''
+    _lock.acquire()
+    try:
+        entry = _entries.get(key)
+        if entry is None:
+            return None
+        entry[0] = _tick()
+        return entry[1]
+    finally:
+        _lock.release()
+
+def evict(size):
+    '''
+    Remove the least recently used fragments until at most size are left.
+    '''
+    _lock.acquire()
+    try:
+        if len(_entries) <= size:
+            return
+        keys = sorted(_entries, key=lambda key: _entries[key][0])
+        for key in keys[:len(keys) - size]:
+            del _entries[key]
+    finally:
+        _lock.release()
+
+def store(key, fragment, max_entries=None):
+    if max_entries is None:
+        max_entries = settings.PAGE_CACHE_SIZE
+    _lock.acquire()
+    try:
+        _entries[key] = [_tick(), fragment]
+        full = len(_entries) > max_entries
+    finally:
+        _lock.release()
+    if full:
+        evict(int(max_entries * EVICT_TO))
+
+def enabled():
+    '''
+    Return whether listings are cached, which needs a cache backend that
+    is shared between processes.
+    '''
+    return settings.CACHE_BACKEND.split(':', 1)[0] not in LOCAL_BACKENDS
+
+def get(user_id, params, render, max_entries=None):
+    '''
+    Return the fragment for the listing of user_id described by the
+    hashable params, calling render() to render it on a miss or if the
+    cache isn't enabled().
+    '''
+    if not enabled():
+        return render()
+    key = (user_id, generation(user_id), params)
+    fragment = lookup(key)
+    if fragment is None:
+        fragment = render()
+        store(key, fragment, max_entries)
+    return fragment
+
+def clear():
+    _lock.acquire()
+    try:
+        _entries.clear()
+    finally:
+        _lock.release()
@@ -0,0 +1,153 @@
+'''
+Keyset (cursor) pagination of documents. Pages are found by comparing
+(creation_time, id) with the cursor of the neighbouring page instead of
+counting and offsetting, so a page costs the same no matter how deep into
+the archive it is. The order is the one of Document.Meta.ordering.
+Restricted querysets, limited to the matches of e.g. a full text search,
+are paged by fetching the keys of the matches in page order a chunk at a
+time until a page is filled.
+'''
+
+from django.db.models import Q
+
+import datetime
+
+# The creation time of a cursor, the fields of CURSOR_TIME_FIELDS with
+# these widths. strftime() isn't used, it fails for years before 1900.
+CURSOR_TIME_FIELDS = (('year', 4), ('month', 2), ('day', 2), ('hour', 2),
+                      ('minute', 2), ('second', 2), ('microsecond', 6))
+
+# The keys of restricted querysets are fetched this many at a time, which
+# keeps the IN clauses below SQLite's limit on query parameters.
+ID_CHUNK_SIZE = 500
+
+class Restricted(object):
+    '''
+    The objects of queryset that are among the matches found by
+    find(limit, after, before), which returns up to limit (creation_time,
+    id) keys of matches following the key after, newest first, or
+    preceding the key before, oldest first (see fulltext.search_keys).
+    '''
+    def __init__(self, queryset, find):
+        self.queryset = queryset
+        self.find = find
+
+    def only(self, *fields):
+        return Restricted(self.queryset.only(*fields), self.find)
+
+class CursorPage(object):
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+def time_key(t):
+    '''
+    Return the datetime t as a string of digits that sorts like t.
+    '''
+    return ''.join(['%0*d' % (width, getattr(t, name))
+                    for name, width in CURSOR_TIME_FIELDS])
+
+def parse_time_key(time_str):
+    '''
+    Return the datetime of the time_key() time_str. Raises ValueError if
+    it is malformed.
+    '''
+    if (len(time_str) != sum([width for name, width in CURSOR_TIME_FIELDS])
+        or not time_str.isdigit()):
+        raise ValueError('malformed cursor time')
+    values = []
+    for name, width in CURSOR_TIME_FIELDS:
+        values.append(int(time_str[:width]))
+        time_str = time_str[width:]
+    return datetime.datetime(*values)
+
+def encode_cursor(document):
+    return '%s_%d' % (time_key(document.creation_time), document.id)
+
+def decode_cursor(cursor):
+    '''
+    Return the (creation_time, id) tuple of cursor. Raises ValueError if
+    cursor is malformed.
+    '''
+    time_str, id_str = cursor.split('_')
+    return parse_time_key(time_str), int(id_str)
+
+def page(queryset, per_page, after=None, before=None):
+    '''
+    Return the CursorPage of at most per_page objects from queryset that
+    follow the cursor after or precede the cursor before. If neither is
+    given the first page is returned. Raises ValueError on malformed
+    cursors.
+    '''
+    if isinstance(queryset, Restricted):
+        fetch = _fetch_restricted
+    elif not hasattr(queryset, 'filter'):
+        # E.g. the empty list of an invalid search.
+        return CursorPage(list(queryset)[:per_page])
+    else:
+        fetch = _fetch
+
+    if before is not None:
+        objects = fetch(queryset, per_page + 1, None, decode_cursor(before))
+        has_previous = len(objects) > per_page
+        objects = objects[:per_page]
+        objects.reverse()
+        has_next = True
+    else:
+        if after is not None:
+            after = decode_cursor(after)
+        objects = fetch(queryset, per_page + 1, after, None)
+        has_next = len(objects) > per_page
+        objects = objects[:per_page]
+        has_previous = after is not None
+
+    next_cursor = previous_cursor = None
+    if objects:
+        if has_next:
+            next_cursor = encode_cursor(objects[-1])
+        if has_previous:
+            previous_cursor = encode_cursor(objects[0])
+    return CursorPage(objects, next_cursor, previous_cursor)
+
+def _fetch(queryset, limit, after, before):
+    # Return up to limit objects of queryset following the (creation_time,
+    # id) key after, newest first, or preceding before, oldest first.
+    if before is not None:
+        creation_time, id = before
+        return list(queryset
+                    .filter(Q(creation_time__gt=creation_time) |
+                            Q(creation_time=creation_time, id__gt=id))
+                    .order_by('creation_time', 'id')[:limit])
+    if after is not None:
+        creation_time, id = after
+        queryset = queryset.filter(
+            Q(creation_time__lt=creation_time) |
+            Q(creation_time=creation_time, id__lt=id))
+    return list(queryset.order_by('-creation_time', '-id')[:limit])
+
+def _fetch_restricted(restricted, limit, after, before):
+    # Like _fetch(). The keys of the matches come in page order, so
+    # fetching stops as soon as limit of them pass the queryset's filters.
+    objects = []
+    while len(objects) < limit:
+        keys = restricted.find(ID_CHUNK_SIZE, after, before)
+        if not keys:
+            break
+        ids = [id for creation_time, id in keys]
+        found = dict((o.id, o) for o in
+                     restricted.queryset.filter(id__in=ids))
+        objects.extend([found[id] for id in ids if id in found])
+        if len(keys) < ID_CHUNK_SIZE:
+            break
+        if before is not None:
+            before = keys[-1]
+        else:
+            after = keys[-1]
+    return objects[:limit]
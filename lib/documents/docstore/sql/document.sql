@@ -0,0 +1,4 @@
+-- Supports the keyset pagination in docstore.paging, which filters on
+-- user and orders by (creation_time, id).
+CREATE INDEX docstore_document_user_creation_time
+    ON docstore_document (user_id, creation_time, id);
@@ -0,0 +1,149 @@
+'''
+Serve files as streamed HTTP responses. Responses carry ETag and
+Last-Modified headers, conditional requests get 304 responses and single
+byte ranges are honored. If settings.DOCUMENTSTORE_SENDFILE_HEADER is set
+the file is handed off to the web server (e.g. mod_xsendfile) instead.
+'''
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+import os
+import re
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+class FileIterator(object):
+    '''
+    Iterate over length bytes of f starting at offset start, chunk_size
+    bytes at a time. f is closed when the iteration is done or when the
+    iterator is closed.
+    '''
+    def __init__(self, f, start=0, length=None, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.start = start
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        try:
+            self.f.seek(self.start)
+            remaining = self.length
+            while remaining is None or remaining > 0:
+                if remaining is None:
+                    size = self.chunk_size
+                else:
+                    size = min(self.chunk_size, remaining)
+                chunk = self.f.read(size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self.f.close()
+
+def make_etag(st):
+    return '"%x-%x"' % (int(st.st_mtime), st.st_size)
+
+def _not_modified(request, etag, st):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since is not None:
+        # HTTP dates have whole seconds.
+        return not was_modified_since(if_modified_since,
+                                      int(st.st_mtime), st.st_size)
+    return False
+
+def parse_range(header, size):
+    '''
+    Parse a Range header value for an entity of size bytes. Returns a
+    (start, length) tuple, None if the header should be ignored (it is
+    malformed or asks for several ranges) and raises ValueError if the
+    range is not satisfiable.
+    '''
+    m = RANGE_RE.match(header.strip())
+    if m is None:
+        return None
+    first, last = m.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # Suffix range, the last bytes of the entity.
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError('unsatisfiable range')
+        return size - length, length
+    start = int(first)
+    if start >= size:
+        raise ValueError('unsatisfiable range')
+    if last == '':
+        end = size - 1
+    else:
+        end = min(int(last), size - 1)
+        if end < start:
+            return None
+    return start, end - start + 1
+
+def _use_range(request, etag, st):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is None:
+        return True
+    return if_range == etag or if_range == http_date(st.st_mtime)
+
+def serve(request, f, content_type, st=None):
+    '''
+    Return a response that streams the open file f. st is the stat result
+    of f and is looked up from f if not given.
+    '''
+    if st is None:
+        st = os.fstat(f.fileno())
+    etag = make_etag(st)
+    if _not_modified(request, etag, st):
+        f.close()
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    sendfile_header = settings.DOCUMENTSTORE_SENDFILE_HEADER
+    if sendfile_header and hasattr(f, 'name'):
+        # The web server takes care of ranges and the actual transfer.
+        response = HttpResponse(mimetype=content_type)
+        response[sendfile_header] = f.name
+        f.close()
+    else:
+        status = 200
+        start, length = 0, st.st_size
+        range_header = request.META.get('HTTP_RANGE')
+        if range_header is not None and _use_range(request, etag, st):
+            try:
+                byte_range = parse_range(range_header, st.st_size)
+            except ValueError:
+                f.close()
+                response = HttpResponse(status=416)
+                response['Content-Range'] = 'bytes */%d' % st.st_size
+                return response
+            if byte_range is not None:
+                status = 206
+                start, length = byte_range
+        response = HttpResponse(FileIterator(f, start, length),
+                                mimetype=content_type, status=status)
+        response['Content-Length'] = str(length)
+        if status == 206:
+            response['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, start + length - 1, st.st_size)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(st.st_mtime)
+    response['Cache-Control'] = 'private'
+    return response
@@ -0,0 +1,144 @@
+'''
+Per-user tag statistics (number of documents per tag and when the tag was
+last used) kept in the cache backend. The statistics are built with one
+aggregate query on a cache miss and are then kept up to date
+incrementally through Changes, which must be used instead of
+Tag.objects.update_tags for documents. Entries expire after
+settings.TAGSTATS_TIMEOUT seconds, which bounds the drift caused by
+concurrent updates. With a cache backend that isn't shared between
+processes (see pagecache.LOCAL_BACKENDS) the changes made by other
+processes would be missed, so the statistics are built on every use then.
+'''
+
+from documents.docstore import pagecache
+from documents.docstore.models import Document
+
+from tagging.models import Tag
+from tagging.utils import parse_tag_input
+
+from django.conf import settings
+from django.core.cache import cache
+
+import time
+
+CLOUD_LEVELS = 4
+
+def _key(user_id):
+    return 'docstore-tagstats-%d' % user_id
+
+def _build(user_id):
+    tags = Tag.objects.usage_for_queryset(Document.objects.filter(user=user_id),
+                                          counts=True)
+    return dict((tag.name, [tag.count, 0]) for tag in tags)
+
+def _shared():
+    return (settings.CACHE_BACKEND.split(':', 1)[0]
+            not in pagecache.LOCAL_BACKENDS)
+
+def get(user_id):
+    '''
+    Return a dict that maps the names of the tags of user_id to [number of
+    documents, time of last use] lists. The time is 0 if unknown.
+    '''
+    if not _shared():
+        return _build(user_id)
+    stats = cache.get(_key(user_id))
+    if stats is None:
+        stats = _build(user_id)
+        cache.set(_key(user_id), stats, settings.TAGSTATS_TIMEOUT)
+    return stats
+
+def _adjust(user_id, added, removed, n=1):
+    if not _shared():
+        return
+    stats = cache.get(_key(user_id))
+    if stats is None:
+        # Built from the database on next use.
+        return
+    now = time.time()
+    for name in added:
+        entry = stats.setdefault(name, [0, 0])
+        entry[0] += n
+        entry[1] = now
+    for name in removed:
+        entry = stats.get(name)
+        if entry is None:
+            continue
+        entry[0] -= n
+        if entry[0] <= 0:
+            del stats[name]
+    cache.set(_key(user_id), stats, settings.TAGSTATS_TIMEOUT)
+
+def tag_names(tags):
+    '''
+    Return the names of the tags in the tag string tags, as they will be
+    stored.
+    '''
+    if settings.FORCE_LOWERCASE_TAGS:
+        return [name.lower() for name in parse_tag_input(tags)]
+    return parse_tag_input(tags)
+
+class Changes(object):
+    '''
+    Changes of the tags of documents made inside a transaction. The
+    statistics are only adjusted by apply(), which must be called after
+    the transaction was committed, so that rolled back changes (e.g. of
+    rejected uploads) never show up in them.
+    '''
+    def __init__(self):
+        self.adjustments = []
+
+    def update_tags(self, document, tags):
+        '''
+        Set the tags of document to the tag string tags.
+        '''
+        old = set([tag.name for tag in Tag.objects.get_for_object(document)])
+        Tag.objects.update_tags(document, tags)
+        new = set(tag_names(tags))
+        self.adjustments.append((document.user_id, new - old, old - new, 1))
+
+    def tags_added(self, user_id, tags, n):
+        '''
+        Record that n new documents of user_id were tagged with the tag
+        string tags, without going through update_tags.
+        '''
+        self.adjustments.append((user_id, set(tag_names(tags)), [], n))
+
+    def document_deleted(self, document):
+        '''
+        Remove the tags of document, which is about to be deleted, from
+        the statistics.
+        '''
+        self.adjustments.append(
+            (document.user_id, [],
+             [tag.name for tag in Tag.objects.get_for_object(document)], 1))
+
+    def apply(self):
+        for user_id, added, removed, n in self.adjustments:
+            _adjust(user_id, added, removed, n)
+        self.adjustments = []
+
+def cloud(user_id, size=None):
+    '''
+    Return the size most used tags of user_id sorted by name, as dicts
+    with name, count and a level between 1 and CLOUD_LEVELS.
+    '''
+    if size is None:
+        size = settings.TAG_CLOUD_SIZE
+    stats = get(user_id)
+    top = sorted(stats.items(), key=lambda item: -item[1][0])[:size]
+    if not top:
+        return []
+    max_count = top[0][1][0]
+    return [dict(name=name, count=count,
+                 level=1 + (CLOUD_LEVELS - 1) * count // max(max_count, 1))
+            for name, (count, last_used) in sorted(top)]
+
+def names(user_id):
+    '''
+    Return the tag names of user_id, most recently used first, for
+    autocompletion.
+    '''
+    stats = get(user_id)
+    return [name for name, entry in
+            sorted(stats.items(), key=lambda item: (-item[1][1], item[0]))]
@@ -5,7 +5,35 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from documents.docstore import (api, backends, docstore, fulltext, ingest,
+                                 instrument, jobs, maintenance, packs,
+                                 pagecache, paging, streaming, tagstats,
+                                 thumbcache)
+from documents.docstore.backends.memorymapped import MappedFile
+from documents.docstore.models import (Blob, Document, Job,
+                                       NumberSequence, Upload)
+
+from tagging.models import Tag
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import simplejson
+from django.utils.http import http_date
+
+from StringIO import StringIO
+import csv
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,6 +42,1256 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class StoreTestCase(TestCase):
+    """
+    Runs each test as the logged in user test, with the store, thumbnail
+    cache, full text index and chunked uploads in a temporary directory.
+    Tests can replace further settings with override().
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'test@example.com',
+                                             'secret')
+        self.client.login(username='test', password='secret')
+        self.dir = tempfile.mkdtemp()
+        self.saved_settings = {}
+        self.override(
+            DOCUMENTSTORE_PATH=os.path.join(self.dir, 'store'),
+            THUMB_CACHE_PATH=os.path.join(self.dir, 'thumbcache'),
+            FULLTEXT_INDEX_PATH=os.path.join(self.dir, 'fulltext.db'),
+            UPLOAD_TEMP_PATH=os.path.join(self.dir, 'uploads'),
+            DOCUMENTSTORE_DEDUPLICATE=False)
+
+    def tearDown(self):
+        for name, value in self.saved_settings.items():
+            setattr(settings, name, value)
+        backends._storage = None
+        shutil.rmtree(self.dir)
+
+    def override(self, **values):
+        """
+        Set the settings in values until the end of the test.
+        """
+        for name, value in values.items():
+            self.saved_settings.setdefault(name, getattr(settings, name))
+            setattr(settings, name, value)
+        # The storage backend is configured by the settings.
+        backends._storage = None
+
+class IndexQueryCountTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'test@example.com',
+                                             'secret')
+        self.client.login(username='test', password='secret')
+        # Queries are only recorded when DEBUG is on.
+        self.old_debug = settings.DEBUG
+        settings.DEBUG = True
+
+    def tearDown(self):
+        settings.DEBUG = self.old_debug
+
+    def create_documents(self, n):
+        for i in range(n):
+            d = Document(user=self.user, store_path='test-%d.pdf' % i,
+                         title='document %d' % i)
+            d.save()
+            Tag.objects.update_tags(d, 'tag%d common' % i)
+
+    def count_queries(self, url, data={}):
+        # Measure rendering, not the page cache.
+        pagecache.clear()
+        connection.queries = []
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, 200)
+        return len(connection.queries)
+
+    def assertConstantQueries(self, url, data={}):
+        """
+        Tests that the number of queries does not depend on the number of
+        documents on the page.
+        """
+        self.create_documents(1)
+        # Warm up per process caches (e.g. content types).
+        self.count_queries(url, data)
+        few = self.count_queries(url, data)
+        self.create_documents(settings.THUMB_COLUMNS * settings.THUMB_ROWS - 1)
+        many = self.count_queries(url, data)
+        self.assertEqual(few, many)
+
+    def test_index(self):
+        self.assertConstantQueries('/')
+
+    def test_index_thumbs(self):
+        self.assertConstantQueries('/', {'thumbs': ''})
+
+    def test_search(self):
+        self.assertConstantQueries('/search/', {'tags': 'common'})
+
+class ThumbCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def get(self, key, data, max_bytes):
+        def render(out):
+            f = open(out, 'wb')
+            f.write(data)
+            f.close()
+            return True
+        f = thumbcache.get(key, render, self.dir, max_bytes)
+        content = f.read()
+        f.close()
+        return content
+
+    def total(self):
+        return int(open(os.path.join(self.dir, thumbcache.SIZE_FILE)).read())
+
+    def test_size_tracking(self):
+        for i in range(5):
+            self.assertEqual(self.get('doc/%d.png' % i, 'x' * 100, 1000),
+                             'x' * 100)
+        self.assertEqual(self.total(), 500)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, 'doc'))), 5)
+        # Removed entries are counted until the next eviction.
+        thumbcache.remove('doc/0.png', self.dir)
+        self.assertEqual(self.total(), 500)
+        # The estimate goes over the maximum, the recount doesn't.
+        for i in range(5, 11):
+            self.get('doc/%d.png' % i, 'x' * 100, 1000)
+        self.assertEqual(self.total(), 1000)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, 'doc'))), 10)
+        self.get('doc/11.png', 'x' * 100, 1000)
+        self.assertEqual(self.total(), 900)
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, 'doc'))), 9)
+
+    def test_lookup_keeps_mtime(self):
+        # mtime is the time of rendering, which ETags are made of.
+        self.get('doc/0.png', 'x', 1000)
+        path = thumbcache.entry_path('doc/0.png', self.dir)
+        os.utime(path, (1000000000, 1000000000))
+        thumbcache.lookup('doc/0.png', self.dir).close()
+        st = os.stat(path)
+        self.assertEqual(st.st_mtime, 1000000000)
+        self.assertTrue(st.st_atime > 1000000000)
+
+class SpriteTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = settings.THUMB_CACHE_PATH, docstore._compose_sprite
+        settings.THUMB_CACHE_PATH = os.path.join(self.dir, 'cache')
+        self.composed = 0
+        def compose(thumbs, thumb_width, height, out):
+            self.composed += 1
+            open(out, 'wb').write('sprite')
+        docstore._compose_sprite = compose
+
+    def tearDown(self):
+        settings.THUMB_CACHE_PATH, docstore._compose_sprite = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_cached(self):
+        for name in ('a-thumb000.png', 'b-thumb000.png'):
+            open(os.path.join(self.dir, name), 'wb').write('thumb')
+        paths = ['a.pdf', None, 'b.pdf']
+        first = docstore.get_sprite(paths, self.dir)
+        st = os.fstat(first.fileno())
+        first.close()
+        second = docstore.get_sprite(paths, self.dir)
+        self.assertEqual(self.composed, 1)
+        self.assertEqual(streaming.make_etag(os.fstat(second.fileno())),
+                         streaming.make_etag(st))
+        second.close()
+
+class StreamingTest(TestCase):
+    class Request(object):
+        def __init__(self, **meta):
+            self.META = meta
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, ''.join([chr(ord('a') + i % 26) for i in range(100)]))
+        os.close(fd)
+        self.st = os.stat(self.path)
+        self.etag = streaming.make_etag(self.st)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def serve(self, **meta):
+        return streaming.serve(self.Request(**meta), open(self.path, 'rb'),
+                               'application/pdf')
+
+    def test_parse_range(self):
+        parse_range = streaming.parse_range
+        self.assertEqual(parse_range('bytes=0-9', 100), (0, 10))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 10))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 10))
+        self.assertEqual(parse_range('bytes=95-200', 100), (95, 5))
+        self.assertEqual(parse_range('bytes=-200', 100), (0, 100))
+        for header in ['bytes=0-1,5-6', 'bytes=5-2', 'items=0-1', 'bytes=-']:
+            self.assertEqual(parse_range(header, 100), None)
+        for header in ['bytes=100-', 'bytes=-0']:
+            self.assertRaises(ValueError, parse_range, header, 100)
+
+    def test_conditional(self):
+        response = self.serve()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(len(''.join(response)), 100)
+
+        response = self.serve(HTTP_IF_NONE_MATCH='"other", %s' % self.etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.serve(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+        response = self.serve(
+            HTTP_IF_MODIFIED_SINCE=http_date(self.st.st_mtime))
+        self.assertEqual(response.status_code, 304)
+        response = self.serve(
+            HTTP_IF_MODIFIED_SINCE=http_date(self.st.st_mtime - 60))
+        self.assertEqual(response.status_code, 200)
+
+    def test_ranges(self):
+        response = self.serve(HTTP_RANGE='bytes=26-29')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 26-29/100')
+        self.assertEqual(response['Content-Length'], '4')
+        self.assertEqual(''.join(response), 'abcd')
+
+        response = self.serve(HTTP_RANGE='bytes=200-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100')
+
+        # A stale If-Range gets the whole entity.
+        response = self.serve(HTTP_RANGE='bytes=26-29',
+                              HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response = self.serve(HTTP_RANGE='bytes=26-29',
+                              HTTP_IF_RANGE=self.etag)
+        self.assertEqual(response.status_code, 206)
+
+class PagingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'test@example.com',
+                                             'secret')
+        for i in range(7):
+            Document(user=self.user, store_path='test-%d.pdf' % i).save()
+        self.documents = Document.objects.filter(user=self.user)
+
+    def test_forward_and_back(self):
+        ids = [d.id for d in self.documents]
+        first = paging.page(self.documents, 3)
+        self.assertEqual([d.id for d in first.object_list], ids[0:3])
+        self.failIf(first.has_previous())
+        second = paging.page(self.documents, 3, after=first.next_cursor)
+        self.assertEqual([d.id for d in second.object_list], ids[3:6])
+        third = paging.page(self.documents, 3, after=second.next_cursor)
+        self.assertEqual([d.id for d in third.object_list], ids[6:])
+        self.failIf(third.has_next())
+        back = paging.page(self.documents, 3, before=third.previous_cursor)
+        self.assertEqual([d.id for d in back.object_list], ids[3:6])
+        back = paging.page(self.documents, 3, before=back.previous_cursor)
+        self.assertEqual([d.id for d in back.object_list], ids[0:3])
+        self.failIf(back.has_previous())
+
+    def test_malformed_cursor(self):
+        self.assertRaises(ValueError, paging.page, self.documents, 3,
+                          after='garbage')
+
+    def test_restricted(self):
+        ids = [d.id for d in self.documents]
+        # Matches of e.g. a full text search, one of them isn't in the
+        # queryset.
+        keys = [(d.creation_time, d.id) for d in self.documents
+                if d.id in [ids[i] for i in (6, 0, 5, 2, 3)]]
+        keys.insert(1, (keys[0][0], 0))
+        finds = []
+        def find(limit, after, before):
+            finds.append((after, before))
+            if before is not None:
+                found = [key for key in reversed(keys) if key > before]
+            else:
+                found = [key for key in keys if after is None or key < after]
+            return found[:limit]
+        old_chunk_size = paging.ID_CHUNK_SIZE
+        paging.ID_CHUNK_SIZE = 2
+        try:
+            restricted = paging.Restricted(self.documents, find)
+            first = paging.page(restricted, 2)
+            self.assertEqual([d.id for d in first.object_list],
+                             [ids[0], ids[2]])
+            # Only as many chunks as needed to fill the page (and see that
+            # there is a next one).
+            self.assertEqual(len(finds), 2)
+            second = paging.page(restricted, 2, after=first.next_cursor)
+            self.assertEqual([d.id for d in second.object_list],
+                             [ids[3], ids[5]])
+            third = paging.page(restricted, 2, after=second.next_cursor)
+            self.assertEqual([d.id for d in third.object_list], [ids[6]])
+            self.failIf(third.has_next())
+            back = paging.page(restricted, 2, before=third.previous_cursor)
+            self.assertEqual([d.id for d in back.object_list],
+                             [ids[3], ids[5]])
+        finally:
+            paging.ID_CHUNK_SIZE = old_chunk_size
+
+    def test_old_dates(self):
+        # strftime() fails for years before 1900.
+        document = self.documents[3]
+        document.creation_time = datetime.datetime(1850, 2, 3, 4, 5, 6, 7)
+        document.save()
+        cursor = paging.encode_cursor(document)
+        self.assertEqual(cursor, '18500203040506000007_%d' % document.id)
+        self.assertEqual(paging.decode_cursor(cursor),
+                         (document.creation_time, document.id))
+        self.assertRaises(ValueError, paging.decode_cursor, '1850_1')
+
+class FulltextTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_path = settings.FULLTEXT_INDEX_PATH
+        settings.FULLTEXT_INDEX_PATH = os.path.join(self.dir, 'fulltext.db')
+        self.march = datetime.datetime(2010, 3, 1)
+        self.april = datetime.datetime(2010, 4, 1)
+        fulltext.index_metadata_many(
+            [(1, 1, self.march, u'Invoice March', u'paid'),
+             (2, 1, self.april, u'Invoice April', u''),
+             (3, 2, datetime.datetime(2010, 5, 1), u'Invoice May', u'paid')])
+        fulltext.index_body(2, u'Electricity bill')
+
+    def tearDown(self):
+        settings.FULLTEXT_INDEX_PATH = self.old_path
+        shutil.rmtree(self.dir)
+
+    def test_search(self):
+        self.assertEqual(fulltext.search(1, u'invoice'), [2, 1])
+        # Prefixes of all words, in title, tags and body.
+        self.assertEqual(fulltext.search(1, u'inv paid'), [1])
+        self.assertEqual(fulltext.search(1, u'ELECTR'), [2])
+        self.assertEqual(fulltext.search(2, u'invoice'), [3])
+        self.assertEqual(fulltext.search(1, u'invoice', limit=1), [2])
+        # Operators are words like any other.
+        self.assertEqual(fulltext.search(1, u'invoice OR paid'), [])
+        self.assertEqual(fulltext.search(1, u'*'), [])
+
+    def test_keys(self):
+        # Ordered by creation time, not by id.
+        fulltext.index_metadata(4, 1, datetime.datetime(2010, 2, 1),
+                                u'Invoice February', u'')
+        self.assertEqual(fulltext.search(1, u'invoice'), [2, 1, 4])
+        self.assertEqual(fulltext.search_keys(1, u'invoice', 1,
+                                              after=(self.april, 2)),
+                         [(self.march, 1)])
+        self.assertEqual(fulltext.search_keys(1, u'invoice',
+                                              before=(self.march, 1)),
+                         [(self.april, 2)])
+
+    def test_reindex_and_remove(self):
+        # Re-indexing the metadata keeps the body.
+        fulltext.index_metadata(2, 1, self.april, u'Bill', u'')
+        self.assertEqual(fulltext.search(1, u'electricity'), [2])
+        self.assertEqual(fulltext.search(1, u'april'), [])
+        fulltext.remove(2)
+        self.assertEqual(fulltext.search(1, u'bill'), [])
+
+class BlobTest(TestCase):
+    def test_reference_counting(self):
+        self.failUnless(Blob.objects.acquire('abc'))
+        self.failIf(Blob.objects.acquire('abc'))
+        self.failIf(Blob.objects.release('abc'))
+        self.failUnless(Blob.objects.release('abc'))
+        self.failIf(Blob.objects.filter(digest='abc').exists())
+
+    def test_concurrent_first_acquire(self):
+        # Another upload of the same content creates the blob between the
+        # update and the insert of acquire().
+        manager = Blob.objects
+        def create(**kwargs):
+            del manager.create
+            manager.create(**kwargs)
+            return manager.create(**kwargs)
+        manager.create = create
+        self.failIf(Blob.objects.acquire('abc'))
+        self.assertEqual(Blob.objects.get(digest='abc').references, 2)
+
+class IngestTest(StoreTestCase):
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.override(INGEST_MAX_MEMBER_BYTES=100,
+                      INGEST_MAX_ARCHIVE_BYTES=60)
+
+    def archive(self):
+        data = StringIO()
+        archive = zipfile.ZipFile(data, 'w')
+        archive.writestr('good.pdf', '%PDF-1.4 good')
+        archive.writestr('bad.pdf', '%PDF-1.4 damaged')
+        archive.writestr('encrypted.pdf', '%PDF-1.4 encrypted')
+        archive.writestr('large.pdf', '%PDF-1.4 ' + 'x' * 1000)
+        archive.writestr('extra.pdf', '%PDF-1.4 extra extra')
+        archive.close()
+        # Break the CRC of bad.pdf and flag encrypted.pdf as encrypted in
+        # the central directory, where the flags are 8 bytes into the 46
+        # bytes before the name.
+        content = data.getvalue().replace('damaged', 'DAMAGED')
+        i = content.rindex('encrypted.pdf') - 46 + 8
+        content = content[:i] + chr(ord(content[i]) | 1) + content[i + 1:]
+        archive = StringIO(content)
+        archive.name = 'archive.zip'
+        return archive
+
+    def test_unreadable_members(self):
+        files, failures = ingest.expand([], [self.archive()])
+        self.assertEqual([(result.name, result.error) for result in failures],
+                         [('large.pdf', ingest.MEMBER_TOO_LARGE % 100),
+                          ('extra.pdf', ingest.ARCHIVE_TOO_LARGE % 60)])
+        results = ingest.create_documents(self.user, files, '', None, False,
+                                          tagstats.Changes())
+        errors = dict((result.name, result.error) for result in results)
+        self.assertEqual(errors['good.pdf'], None)
+        self.assertTrue(errors['bad.pdf'].startswith('Unreadable'))
+        self.assertTrue(errors['encrypted.pdf'].startswith('Unreadable'))
+        self.assertEqual(Document.objects.count(), 1)
+        # Nothing is left of the partially stored bad.pdf.
+        pdfs = [name for dir, dirs, names in
+                os.walk(settings.DOCUMENTSTORE_PATH)
+                for name in names if name.endswith('.pdf')]
+        self.assertEqual(len(pdfs), 1)
+
+    def test_actual_size(self):
+        # Declared sizes aren't trusted.
+        files, failures = ingest.expand([], [self.archive()])
+        self.override(INGEST_MAX_MEMBER_BYTES=10)
+        self.assertRaises(ingest.UnreadableMember, list, files[0].chunks())
+
+class MappedFileTest(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, '%PDF-1.4 test')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_read_and_seek(self):
+        f = MappedFile(open(self.path, 'rb'))
+        data = f.read(4)
+        # Not a copy.
+        self.failUnless(isinstance(data, buffer))
+        self.assertEqual(str(data), '%PDF')
+        f.seek(-4, os.SEEK_END)
+        self.assertEqual(str(f.read()), 'test')
+        self.assertEqual(str(f.read()), '')
+        self.failIf(f.read())
+        f.seek(0)
+        self.assertEqual(str(f.read(100)), '%PDF-1.4 test')
+        f.seek(100)
+        self.assertEqual(str(f.read(1)), '')
+        f.close()
+
+    def test_streaming(self):
+        f = MappedFile(open(self.path, 'rb'))
+        # Chunks are used up before the next one is read, the map is
+        # closed at the end.
+        self.assertEqual(''.join(str(chunk) for chunk in
+                                 streaming.FileIterator(f, 4, 5,
+                                                        chunk_size=2)),
+                         '-1.4 ')
+
+class TagStatsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'test@example.com',
+                                             'secret')
+        cache.clear()
+        # The statistics are in the locmem cache of this process either
+        # way, which is all these tests need.
+        self.old_backend = settings.CACHE_BACKEND
+        settings.CACHE_BACKEND = 'memcached://127.0.0.1:11211/'
+
+    def tearDown(self):
+        settings.CACHE_BACKEND = self.old_backend
+        cache.clear()
+
+    def counts(self):
+        return dict((tag['name'], tag['count'])
+                    for tag in tagstats.cloud(self.user.id))
+
+    def test_incremental_updates(self):
+        changes = tagstats.Changes()
+        d = Document(user=self.user, store_path='test.pdf')
+        d.save()
+        changes.update_tags(d, 'a b')
+        changes.apply()
+        self.assertEqual(self.counts(), dict(a=1, b=1))
+        e = Document(user=self.user, store_path='test2.pdf')
+        e.save()
+        changes.update_tags(e, 'b c')
+        changes.apply()
+        self.assertEqual(self.counts(), dict(a=1, b=2, c=1))
+        changes.update_tags(d, 'c')
+        changes.apply()
+        self.assertEqual(self.counts(), dict(b=1, c=2))
+        changes.document_deleted(e)
+        e.delete()
+        changes.apply()
+        self.assertEqual(self.counts(), dict(c=1))
+        # The statistics agree with the database.
+        cache.clear()
+        self.assertEqual(self.counts(), dict(c=1))
+
+    def test_changes_applied_after_commit(self):
+        self.assertEqual(self.counts(), {})
+        changes = tagstats.Changes()
+        d = Document(user=self.user, store_path='test.pdf')
+        d.save()
+        changes.update_tags(d, 'a')
+        changes.tags_added(self.user.id, 'b', 2)
+        # Nothing changes until apply(), which is left out if the
+        # transaction is rolled back.
+        self.assertEqual(self.counts(), {})
+        changes.apply()
+        self.assertEqual(self.counts(), dict(a=1, b=2))
+        changes.apply()
+        self.assertEqual(self.counts(), dict(a=1, b=2))
+
+    def test_local_backend(self):
+        settings.CACHE_BACKEND = 'locmem://'
+        d = Document(user=self.user, store_path='test.pdf')
+        d.save()
+        Tag.objects.update_tags(d, 'a')
+        self.assertEqual(self.counts(), dict(a=1))
+        # Changes made by other processes show up right away.
+        Tag.objects.update_tags(d, 'b')
+        self.assertEqual(self.counts(), dict(b=1))
+        self.assertEqual(cache.get(tagstats._key(self.user.id)), None)
+
+class JobTest(TestCase):
+    def test_reset_running(self):
+        # A pid that is certainly dead: a child that has been reaped.
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        for worker in [jobs.worker_id(pid), jobs.worker_id(),
+                       'elsewhere:%d' % pid]:
+            Job(kind='test', status=Job.RUNNING, worker=worker).save()
+        self.assertEqual(jobs.reset_running(), 1)
+        self.assertEqual(
+            list(Job.objects.filter(status=Job.RUNNING)
+                 .values_list('worker', flat=True)),
+            [jobs.worker_id(), 'elsewhere:%d' % pid])
+
+class PageCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'test@example.com',
+                                             'secret')
+        self.client.login(username='test', password='secret')
+        pagecache.clear()
+        # The generations are in the locmem cache of this process either
+        # way, which is all these tests need.
+        self.old_backend = settings.CACHE_BACKEND
+        settings.CACHE_BACKEND = 'memcached://127.0.0.1:11211/'
+
+    def tearDown(self):
+        settings.CACHE_BACKEND = self.old_backend
+        pagecache.clear()
+
+    def create_document(self, title):
+        d = Document(user=self.user, store_path='test.pdf', title=title)
+        d.save()
+        return d
+
+    def test_invalidation(self):
+        self.create_document('first')
+        self.assertContains(self.client.get('/'), 'first')
+        # Not visible until the generation is bumped.
+        self.create_document('second')
+        self.assertNotContains(self.client.get('/'), 'second')
+        pagecache.bump(self.user.id)
+        self.assertContains(self.client.get('/'), 'second')
+
+    def test_keys(self):
+        self.create_document('first')
+        self.assertContains(self.client.get('/'), 'first')
+        self.create_document('second')
+        # Differently parametrized pages are cached separately.
+        self.assertContains(self.client.get('/', {'thumbs': ''}), 'second')
+        self.assertContains(self.client.get('/search/',
+                                            {'start_date': '2000-01-01'}),
+                            'second')
+
+    def test_invalid_search(self):
+        self.create_document('first')
+        response = self.client.get('/search/', {'start_date': 'invalid'})
+        self.assertNotContains(response, 'first')
+        # Not the listing of the invalid search.
+        self.assertContains(self.client.get('/'), 'first')
+
+    def test_local_backend(self):
+        settings.CACHE_BACKEND = 'locmem://'
+        self.create_document('first')
+        self.assertContains(self.client.get('/'), 'first')
+        self.create_document('second')
+        self.assertContains(self.client.get('/'), 'second')
+        self.assertEqual(pagecache._entries, {})
+
+    def test_lru(self):
+        render = lambda: 'fragment'
+        for params in 'abcdefghij':
+            pagecache.get(self.user.id, params, render, max_entries=10)
+        # Use a, so that b and c are evicted when the cache is full.
+        pagecache.get(self.user.id, 'a', render, max_entries=10)
+        pagecache.get(self.user.id, 'k', render, max_entries=10)
+        cached = sorted([key[2] for key in pagecache._entries])
+        self.assertEqual(''.join(cached), 'adefghijk')
+
+class NumberSequenceTest(TransactionTestCase):
+    def setUp(self):
+        self.db_path = None
+        if connection.settings_dict['ENGINE'].endswith('sqlite3'):
+            # Every thread would get its own in-memory database, use a
+            # file instead. The connection of this thread is kept aside,
+            # closing it would destroy the in-memory database.
+            fd, self.db_path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            self.saved_name = connection.settings_dict['NAME']
+            self.saved_connection = connection.connection
+            connection.connection = None
+            connection.settings_dict['NAME'] = self.db_path
+            call_command('syncdb', verbosity=0, interactive=False)
+        self.user = User.objects.create_user('test', 'test@example.com',
+                                             'secret')
+        NumberSequence(user=self.user).save()
+
+    def tearDown(self):
+        if self.db_path is not None:
+            connection.close()
+            connection.settings_dict['NAME'] = self.saved_name
+            connection.connection = self.saved_connection
+            os.remove(self.db_path)
+
+    def assertContiguous(self, ranges):
+        """
+        Tests that the (start, length) ranges cover the numbers from 1 up
+        without overlapping.
+        """
+        ranges.sort()
+        next = 1
+        for start, length in ranges:
+            self.assertEqual(start, next)
+            next += length
+        self.assertEqual(NumberSequence.objects.get(user=self.user)
+                         .next_free_number, next)
+
+    def test_stale_instances(self):
+        a = NumberSequence.objects.get(user=self.user)
+        b = NumberSequence.objects.get(user=self.user)
+        ranges = []
+        for sequence, n in [(a, 3), (b, 2), (a, 1), (b, 5)]:
+            ranges.append((sequence.reserve(n), n))
+        self.assertContiguous(ranges)
+
+    def test_concurrent_reservations(self):
+        ranges = []
+        errors = []
+        def reserve(n):
+            try:
+                try:
+                    for i in range(20):
+                        sequence = NumberSequence.objects.get(user=self.user)
+                        ranges.append((sequence.reserve(n), n))
+                except Exception as e:
+                    errors.append(e)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=reserve, args=(n,))
+                   for n in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(ranges), 20 * 8)
+        self.assertContiguous(ranges)
+
+class ChunkedUploadTest(StoreTestCase):
+    PDF = '%PDF-1.4 chunked upload test'
+
+    def initiate(self, size):
+        response = self.client.post('/upload/chunked/',
+                                    dict(name='scan.pdf', size=size))
+        self.assertEqual(response.status_code, 201)
+        return simplejson.loads(response.content)
+
+    def put(self, state, offset, data):
+        return self.client.put('%s?offset=%d' % (state['url'], offset), data,
+                               content_type='application/octet-stream')
+
+    def test_resumed_upload(self):
+        state = self.initiate(len(self.PDF))
+        self.assertEqual(self.put(state, 0, self.PDF[:10]).status_code, 200)
+        # A gap is refused with the offset to resume from.
+        response = self.put(state, 20, self.PDF[20:])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(simplejson.loads(response.content)['offset'], 10)
+        # Resending a chunk is harmless.
+        self.assertEqual(self.put(state, 0, self.PDF[:10]).status_code, 200)
+        self.assertEqual(self.put(state, 10, self.PDF[10:]).status_code, 200)
+        response = self.client.get(state['url'])
+        self.assertEqual(simplejson.loads(response.content)['offset'],
+                         len(self.PDF))
+
+        response = self.client.post(state['url'] + 'finalize/')
+        self.assertEqual(response.status_code, 201)
+        document = Document.objects.get(
+            id=simplejson.loads(response.content)['id'])
+        path = os.path.join(settings.DOCUMENTSTORE_PATH, document.store_path)
+        self.assertEqual(open(path, 'rb').read(), self.PDF)
+        self.assertEqual(Upload.objects.count(), 0)
+        self.assertEqual(os.listdir(settings.UPLOAD_TEMP_PATH), [])
+
+    def test_incomplete(self):
+        state = self.initiate(len(self.PDF))
+        self.put(state, 0, self.PDF[:10])
+        response = self.client.post(state['url'] + 'finalize/')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Document.objects.count(), 0)
+
+    def test_not_a_pdf(self):
+        state = self.initiate(100)
+        self.assertEqual(self.put(state, 0, 'GIF89a').status_code, 415)
+        self.assertEqual(Upload.objects.count(), 0)
+
+    def test_rejected_upload_keeps_tag_stats(self):
+        cache.clear()
+        self.assertEqual(tagstats.get(self.user.id), {})
+        upload = StringIO('GIF89a')
+        upload.name = 'scan.pdf'
+        response = self.client.post('/upload/', dict(file=upload,
+                                                     tags='rejected'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Document.objects.count(), 0)
+        self.assertEqual(tagstats.get(self.user.id), {})
+
+class MaintenanceTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test', 'test@example.com',
+                                             'secret')
+        self.dir = tempfile.mkdtemp()
+        for path in ('a/kept.pdf', 'a/orphan.pdf', 'a/orphan-thumb000.png',
+                     'b/c/new.pdf'):
+            self.write(path)
+        Document(user=self.user, store_path='a/kept.pdf').save()
+        # Only the new file was modified recently.
+        old = time.time() - 2 * 24 * 60 * 60
+        for path in ('a/kept.pdf', 'a/orphan.pdf', 'a/orphan-thumb000.png'):
+            os.utime(os.path.join(self.dir, path), (old, old))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path):
+        full_path = os.path.join(self.dir, path)
+        if not os.path.exists(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        f = open(full_path, 'wb')
+        f.write('%PDF-1.4')
+        f.close()
+
+    def test_orphans(self):
+        out = StringIO()
+        totals = maintenance.run(out, self.dir, verify=False, thumbs=False,
+                                 delete=True)
+        self.assertEqual(totals['orphans'], 2)
+        self.failUnless(os.path.exists(os.path.join(self.dir, 'a/kept.pdf')))
+        self.failUnless(os.path.exists(os.path.join(self.dir,
+                                                    'b/c/new.pdf')))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dir, 'a'))),
+                         ['kept.pdf'])
+
+    def test_missing_thumbs(self):
+        # Not generated, the thumbnails are rendered on demand.
+        self.failIf(maintenance.missing_thumbs('a/kept.pdf', self.dir))
+        thumbs = [os.path.join(self.dir, 'a/kept-thumb%03d.png' % n)
+                  for n in range(2)]
+        for thumb in thumbs:
+            self.write(thumb)
+        docstore._add_to_manifest(os.path.join(self.dir, 'a/kept.pdf'),
+                                  thumbs)
+        self.failIf(maintenance.missing_thumbs('a/kept.pdf', self.dir))
+        os.remove(thumbs[1])
+        self.failUnless(maintenance.missing_thumbs('a/kept.pdf', self.dir))
+        # Packed documents have no files in the store.
+        self.failIf(maintenance.missing_thumbs('a/packed.pdf', self.dir))
+
+    def test_resume(self):
+        walked = [path for path, names
+                  in maintenance.directories(self.dir)]
+        self.assertEqual(walked, ['.', 'a', 'b', 'b/c'])
+        for i, path in enumerate(walked):
+            self.assertEqual([p for p, names
+                              in maintenance.directories(self.dir, path)],
+                             walked[i + 1:])
+
+class PackTest(TestCase):
+    PDF = '%PDF-1.4 ' + 'packed document ' * 1000
+    THUMB = 'thumbnail ' * 100
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old_thumb_cache_path = settings.THUMB_CACHE_PATH
+        settings.THUMB_CACHE_PATH = os.path.join(self.dir, 'thumbcache')
+        self.store_path = os.path.join(self.dir, 'store')
+        self.path = 'test/20100101/20100101120000-1.pdf'
+        os.makedirs(os.path.join(self.store_path, 'test/20100101'))
+        self.write(self.path, self.PDF)
+        self.write(docstore._thumb_name(os.path.splitext(self.path)[0], 0),
+                   self.THUMB)
+
+    def tearDown(self):
+        settings.THUMB_CACHE_PATH = self.old_thumb_cache_path
+        shutil.rmtree(self.dir)
+
+    def write(self, path, data):
+        f = open(os.path.join(self.store_path, path), 'wb')
+        f.write(data)
+        f.close()
+
+    def test_transparent_reads(self):
+        self.assertEqual(docstore.pack_documents([self.path], self.store_path),
+                         1)
+        self.assertEqual(os.listdir(os.path.join(self.store_path,
+                                                 'test/20100101')), [])
+        self.assertEqual(docstore.verify(self.path, self.store_path), [])
+
+        f = docstore.get(self.path, self.store_path)
+        self.assertEqual(f.read(), self.PDF)
+        f.seek(9)
+        self.assertEqual(f.read(6), 'packed')
+        f.close()
+        self.assertEqual(docstore.stat(self.path, self.store_path).st_size,
+                         len(self.PDF))
+        thumb = docstore.get_thumb(self.path, 0, self.store_path)
+        self.assertEqual(thumb.read(), self.THUMB)
+        thumb.close()
+
+        docstore.delete(self.path, self.store_path)
+        self.assertEqual(docstore.get(self.path, self.store_path), None)
+        self.assertEqual(os.listdir(os.path.join(self.store_path,
+                                                 packs.PACK_DIR)), [])
+
+    def add_document(self, path):
+        # A document whose manifest lists a thumbnail.
+        self.write(path, self.PDF)
+        thumb = docstore._thumb_name(os.path.splitext(path)[0], 0)
+        self.write(thumb, self.THUMB)
+        full_path = os.path.join(self.store_path, path)
+        docstore._add_to_manifest(full_path,
+                                  [full_path,
+                                   os.path.join(self.store_path, thumb)])
+        return os.path.join(self.store_path, thumb)
+
+    def test_deleted_file(self):
+        path = 'test/20100101/20100101120000-2.pdf'
+        os.remove(self.add_document(path))
+        self.assertEqual(docstore.pack_documents([self.path, path],
+                                                 self.store_path), 1)
+        self.failUnless(packs.is_packed(self.path))
+        self.failIf(packs.is_packed(path))
+        # Left in place.
+        self.failUnless(os.path.exists(os.path.join(self.store_path, path)))
+        f = docstore.get(path, self.store_path)
+        self.assertEqual(f.read(), self.PDF)
+        f.close()
+
+    def test_unreadable_file(self):
+        path = 'test/20100101/20100101120000-2.pdf'
+        thumb = self.add_document(path)
+        # Can't be read as a file.
+        os.remove(thumb)
+        os.mkdir(thumb)
+        self.assertRaises(IOError, docstore.pack_documents, [path],
+                          self.store_path)
+        self.failIf(packs.is_packed(path))
+        self.failUnless(os.path.exists(os.path.join(self.store_path, path)))
+        self.assertEqual(os.listdir(os.path.join(self.store_path,
+                                                 packs.PACK_DIR)), [])
+
+class ManifestTest(StoreTestCase):
+    PDF = '%PDF-1.4 manifest test'
+
+    def store(self, id):
+        return docstore.store(
+            SimpleUploadedFile('test.pdf', self.PDF), 'test', id,
+            datetime.datetime(2010, 1, 1, 12).timetuple())
+
+    def full_path(self, path):
+        return os.path.join(settings.DOCUMENTSTORE_PATH, path)
+
+    def add_thumb(self, path, data):
+        thumb = docstore._thumb_name(os.path.splitext(self.full_path(path))[0],
+                                     0)
+        f = open(thumb, 'wb')
+        f.write(data)
+        f.close()
+        docstore._add_to_manifest(self.full_path(path), [thumb])
+        return thumb
+
+    def test_size_and_verify(self):
+        path = self.store(1)
+        self.assertEqual(sorted(docstore.files(path)),
+                         ['20100101120000-1.manifest',
+                          '20100101120000-1.pdf'])
+        self.assertEqual(docstore.size(path), len(self.PDF))
+        self.assertEqual(docstore.verify(path), [])
+        thumb = self.add_thumb(path, 'thumbnail')
+        self.assertEqual(docstore.size(path), len(self.PDF) + 9)
+        self.assertEqual(docstore.verify(path), [])
+        f = open(thumb, 'wb')
+        f.write('short')
+        f.close()
+        self.assertEqual(docstore.verify(path),
+                         ['20100101120000-1-thumb000.png: '
+                          'size is 5, expected 9'])
+        os.remove(thumb)
+        self.assertEqual(docstore.verify(path),
+                         ['20100101120000-1-thumb000.png: missing'])
+
+    def test_delete(self):
+        path = self.store(1)
+        self.add_thumb(path, 'thumbnail')
+        # Shares the prefix of the first document's file names.
+        other = self.store(10)
+        docstore.delete(path)
+        dir = os.path.dirname(self.full_path(path))
+        self.assertEqual(sorted(os.listdir(dir)),
+                         ['20100101120000-10.manifest',
+                          '20100101120000-10.pdf'])
+        self.assertEqual(docstore.verify(other), [])
+        docstore.delete_many([other])
+        self.assertEqual(os.listdir(dir), [])
+
+    def test_legacy_documents(self):
+        # Stored before manifests were written.
+        path = self.store(1)
+        self.add_thumb(path, 'thumbnail')
+        os.remove(os.path.splitext(self.full_path(path))[0]
+                  + docstore.MANIFEST_EXT)
+        self.assertEqual(docstore.size(path), len(self.PDF) + 9)
+        docstore.delete(path)
+        self.assertEqual(os.listdir(os.path.dirname(self.full_path(path))),
+                         [])
+
+class TimingTest(StoreTestCase):
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        instrument._stats.clear()
+
+    def tearDown(self):
+        instrument._stats.clear()
+        StoreTestCase.tearDown(self)
+
+    def test_server_timing(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        metrics = [metric.split(';')[0] for metric in
+                   response['Server-Timing'].split(', ')]
+        self.failUnless('db' in metrics)
+        self.failUnless('template' in metrics)
+        self.assertEqual(metrics[-1], 'total')
+        self.client.get('/')
+        stats = dict((pattern, (samples, metrics)) for pattern, samples, metrics
+                     in instrument.stats())
+        samples, metrics = stats['^$']
+        self.assertEqual(samples, 2)
+        self.failUnless(metrics['db_count'][0] > 0)
+        # Outside of requests nothing is recorded.
+        instrument.record('db', 1.0)
+        self.assertEqual(instrument.finish_request(), {})
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(instrument.percentile(values, 50), 50)
+        self.assertEqual(instrument.percentile(values, 99), 99)
+        self.assertEqual(instrument.percentile([], 50), 0)
+
+    def test_stats_view(self):
+        self.client.get('/')
+        # Staff only.
+        self.assertNotContains(self.client.get('/stats/'), '^$')
+        self.user.is_staff = True
+        self.user.save()
+        self.assertContains(self.client.get('/stats/'), '^$')
+
+class PageTest(StoreTestCase):
+    PDF = '%PDF-1.4 document'
+
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.path = 'test/20100101/20100101120000-1.pdf'
+        os.makedirs(os.path.join(settings.DOCUMENTSTORE_PATH,
+                                 'test/20100101'))
+        f = open(os.path.join(settings.DOCUMENTSTORE_PATH, self.path), 'wb')
+        f.write(self.PDF)
+        f.close()
+        self.document = Document(user=self.user, store_path=self.path)
+        self.document.save()
+
+    def cache(self, name, data):
+        # Put a rendering in the cache, so that it isn't rendered.
+        path = thumbcache.entry_path(
+            os.path.join('test/20100101/20100101120000-1', name))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+
+    def render(self, pdf, n, width, out, quality=None, density=None):
+        # Stands in for docstore.render_page, writes the format.
+        format = os.path.splitext(out)[1][1:]
+        self.rendered.append(format)
+        if format in self.unsupported:
+            docstore.unsupported_formats.add(format)
+            raise docstore.UnsupportedFormat('no encode delegate')
+        f = open(out, 'wb')
+        f.write(format)
+        f.close()
+
+    def patch_render(self, unsupported=()):
+        self.rendered = []
+        self.unsupported = unsupported
+        self.saved_render_page = docstore.render_page
+        docstore.render_page = self.render
+
+    def tearDown(self):
+        if hasattr(self, 'saved_render_page'):
+            docstore.render_page = self.saved_render_page
+        docstore.unsupported_formats.clear()
+        StoreTestCase.tearDown(self)
+
+    def get_thumb(self, accept):
+        return self.client.get('/thumb/%d/' % self.document.id,
+                               HTTP_ACCEPT=accept)
+
+    def test_thumbnail_formats(self):
+        self.patch_render()
+        for accept, format in [('image/webp,*/*', 'webp'),
+                               ('*/*', 'jpeg'),
+                               ('image/png', 'png'),
+                               ('text/html', 'png')]:
+            response = self.get_thumb(accept)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'image/' + format)
+            self.assertEqual(''.join(response), format)
+            self.failUnless('Accept' in response['Vary'])
+
+    def test_unsupported_format(self):
+        self.patch_render(unsupported=('webp',))
+        response = self.get_thumb('image/webp,*/*')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(''.join(response), 'jpeg')
+        self.assertEqual(self.rendered, ['webp', 'jpeg'])
+
+        # WebP isn't tried again.
+        response = self.client.get('/page/%d/' % self.document.id,
+                                   dict(n=1), HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(self.rendered, ['webp', 'jpeg', 'jpeg'])
+
+    def test_density(self):
+        self.assertEqual(docstore.page_density(120), 72)
+        self.assertEqual(docstore.page_density(1190), 144)
+
+    def test_page(self):
+        self.cache('page002-800.png', 'page 2')
+        # Widths are rounded up to PAGE_WIDTHS.
+        response = self.client.get('/page/%d/' % self.document.id,
+                                   dict(n=2, width=700),
+                                   HTTP_ACCEPT='image/png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(''.join(response), 'page 2')
+
+        response = self.client.get('/page/%d/' % self.document.id,
+                                   dict(n=-1))
+        self.assertEqual(response.status_code, 404)
+
+    def test_pages(self):
+        self.cache('pages001-003.pdf', '%PDF-1.4 pages 1 to 3')
+        response = self.client.get('/pages/%d/' % self.document.id,
+                                   dict(first=1, last=3))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response), '%PDF-1.4 pages 1 to 3')
+
+        for query in [dict(), dict(first='x'), dict(first=3, last=1),
+                      dict(first=-1, last=1),
+                      dict(first=0, last=settings.PAGE_RANGE_MAX_PAGES)]:
+            response = self.client.get('/pages/%d/' % self.document.id,
+                                       query)
+            self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(docstore.get_pages('test/missing.pdf', 0, 0), None)
+
+class ApiTest(StoreTestCase):
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        self.documents = []
+        for i in range(3):
+            d = Document(user=self.user, store_path='test-%d.pdf' % i,
+                         title='Document %d' % i)
+            d.save()
+            Tag.objects.update_tags(d, 'tag%d common' % i)
+            self.documents.append(d)
+        other = User.objects.create_user('other', 'other@example.com',
+                                         'secret')
+        self.other = Document(user=other, store_path='other.pdf')
+        self.other.save()
+
+    def get(self, **params):
+        response = self.client.get('/api/documents/', params)
+        return response.status_code, simplejson.loads(response.content)
+
+    def bulk(self, data):
+        response = self.client.post('/api/documents/bulk/',
+                                    simplejson.dumps(data),
+                                    content_type='application/json')
+        return response.status_code, simplejson.loads(response.content)
+
+    def test_list(self):
+        status, data = self.get(fields='id,tags', per_page=2)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['documents'],
+                         [dict(id=self.documents[2].id, tags='common tag2'),
+                          dict(id=self.documents[1].id, tags='common tag1')])
+        status, data = self.get(fields='title', after=data['next'])
+        self.assertEqual(data['documents'], [dict(title='Document 0')])
+        self.assertEqual(data['next'], None)
+
+        status, data = self.get(tags='tag1')
+        self.assertEqual(len(data['documents']), 1)
+        self.assertEqual(sorted(data['documents'][0].keys()),
+                         sorted(api.FIELDS.keys()))
+
+        self.assertEqual(self.get(fields='id,secret')[0], 400)
+        self.assertEqual(self.get(per_page=0)[0], 400)
+        self.assertEqual(self.get(after='bogus')[0], 400)
+
+    def test_old_dates(self):
+        Document.objects.filter(id=self.documents[0].id).update(
+            creation_time=datetime.datetime(1850, 1, 2, 3, 4, 5))
+        status, data = self.get(fields='creation_time')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['documents'][-1],
+                         dict(creation_time='1850-01-02 03:04:05'))
+
+    def test_bulk(self):
+        d0, d1, d2 = [d.id for d in self.documents]
+        cache.clear()
+        tagstats.get(self.user.id)
+        status, data = self.bulk(dict(
+                update=[dict(ids=[d0, d1], add_tags='paid',
+                             remove_tags='common'),
+                        dict(ids=[d0], title='Invoice',
+                             creation_time='2010-01-01 12:00:00')],
+                delete=[d2]))
+        self.assertEqual(status, 200)
+        self.assertEqual(sorted(data['updated']), [d0, d1])
+        self.assertEqual(data['deleted'], [d2])
+
+        document = Document.objects.get(id=d0)
+        self.assertEqual(document.title, 'Invoice')
+        self.assertEqual(document.creation_time.year, 2010)
+        self.assertEqual(sorted([tag.name for tag in document.tags()]),
+                         ['paid', 'tag0'])
+        self.assertEqual(Document.objects.filter(id=d2).count(), 0)
+        stats = tagstats.get(self.user.id)
+        self.assertEqual(stats['paid'][0], 2)
+        self.assertFalse('common' in stats)
+
+    def test_bulk_delete_deduplicated(self):
+        self.override(DOCUMENTSTORE_DEDUPLICATE=True)
+        ids = []
+        for i in range(2):
+            d = Document(user=self.user, store_path='NOT SET')
+            d.save()
+            d.store_path = docstore.store(
+                SimpleUploadedFile('test.pdf', '%PDF-1.4 shared'), 'test',
+                d.id, d.creation_time.timetuple())
+            d.save()
+            ids.append(d.id)
+        path = Document.objects.get(id=ids[0]).store_path
+        full_path = os.path.join(settings.DOCUMENTSTORE_PATH, path)
+        digest = docstore.blob_digest(path)
+        self.assertEqual(Blob.objects.get(digest=digest).references, 2)
+
+        status, data = self.bulk(dict(delete=[ids[0]]))
+        self.assertEqual(status, 200)
+        self.assertEqual(Blob.objects.get(digest=digest).references, 1)
+        self.failUnless(os.path.exists(full_path))
+
+        status, data = self.bulk(dict(delete=[ids[1]]))
+        self.assertEqual(status, 200)
+        self.assertEqual(Blob.objects.filter(digest=digest).count(), 0)
+        self.failIf(os.path.exists(full_path))
+
+    def test_bulk_is_atomic(self):
+        d0 = self.documents[0].id
+        status, data = self.bulk(dict(update=[dict(ids=[d0], title='x')],
+                                      delete=[self.other.id]))
+        self.assertEqual(status, 404)
+        self.assertEqual(data['missing'], [self.other.id])
+        self.assertEqual(Document.objects.get(id=d0).title, 'Document 0')
+        self.assertEqual(Document.objects.filter(id=self.other.id).count(),
+                         1)
+
+        for data in [[d0], dict(update=[dict(ids=[d0], owner='x')]),
+                     dict(delete=['1']),
+                     dict(update=[dict(ids=[d0], creation_time='')])]:
+            self.assertEqual(self.bulk(data)[0], 400)
+
+class ExportTest(StoreTestCase):
+    def setUp(self):
+        StoreTestCase.setUp(self)
+        os.makedirs(settings.DOCUMENTSTORE_PATH)
+        for i in range(3):
+            path = 'test-%d.pdf' % i
+            f = open(os.path.join(settings.DOCUMENTSTORE_PATH, path), 'wb')
+            f.write('%%PDF-1.4 document %d' % i)
+            f.close()
+            d = Document(user=self.user, store_path=path, title='Same title')
+            d.save()
+            Tag.objects.update_tags(d, 'export tag%d' % i)
+        Tag.objects.update_tags(d, 'tag%d' % i)
+
+    def test_export(self):
+        # The last document isn't tagged export.
+        response = self.client.get('/export/', {'tags': 'export',
+                                                'manifest': '1'})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        archive = zipfile.ZipFile(StringIO(response.content))
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(archive.namelist(), ['same_title.pdf',
+                                              'same_title-2.pdf',
+                                              'manifest.csv'])
+        # Newest first.
+        self.assertEqual(archive.read('same_title.pdf'),
+                         '%PDF-1.4 document 1')
+        rows = list(csv.reader(StringIO(archive.read('manifest.csv'))))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[1][:3], ['same_title.pdf', 'Same title',
+                                       'export tag1'])
+
+    def test_old_dates(self):
+        Document.objects.filter(user=self.user).update(
+            creation_time=datetime.datetime(1850, 1, 2, 3, 4, 5))
+        response = self.client.get('/export/', {'manifest': '1'})
+        archive = zipfile.ZipFile(StringIO(response.content))
+        rows = list(csv.reader(StringIO(archive.read('manifest.csv'))))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1][4], '1850-01-02 03:04:05')
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
@@ -0,0 +1,194 @@
+'''
+A size bounded disk cache for rendered images. Entries are files below
+settings.THUMB_CACHE_PATH named by a relative key. When the cache grows
+beyond settings.THUMB_CACHE_MAX_BYTES the least recently used entries are
+evicted. Concurrent requests for the same missing entry are serialized by
+a lock file so that the entry is only rendered once. The total size of
+the entries is kept in a file, so that the cache is only walked when it
+has grown beyond its maximum size.
+'''
+
+from __future__ import with_statement
+
+from django.conf import settings
+
+import fcntl
+import os
+import tempfile
+import time
+
+# Evict down to this fraction of the maximum size to avoid evicting on
+# every new entry once the cache is full.
+EVICT_TO = 0.9
+
+LOCK_SUFFIX = '.lock'
+TMP_PREFIX = '.tmp-'
+
+# Holds the total size of the entries in bytes.
+SIZE_FILE = '.size'
+
+def entry_path(key, cache_path=None):
+    if cache_path is None:
+        cache_path = settings.THUMB_CACHE_PATH
+    return os.path.join(cache_path, key)
+
+def _touch(path, st):
+    # atime is the last access time of an entry. It is set explicitly,
+    # which works on noatime mounts too. mtime is left alone, it is the
+    # time the entry was rendered and ETags and Last-Modified depend on
+    # it.
+    try:
+        os.utime(path, (time.time(), st.st_mtime))
+    except OSError:
+        pass
+
+def lookup(key, cache_path=None):
+    '''
+    Return an open file for the entry key or None if it is not cached.
+    '''
+    path = entry_path(key, cache_path)
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return None
+    _touch(path, os.fstat(f.fileno()))
+    return f
+
+def get(key, render, cache_path=None, max_bytes=None):
+    '''
+    Return an open file for the entry key, calling render(path) to create
+    it if it is not cached. render must write the entry to path and return
+    True, or return False if the entry can't be rendered in which case
+    None is returned.
+    '''
+    if cache_path is None:
+        cache_path = settings.THUMB_CACHE_PATH
+    if max_bytes is None:
+        max_bytes = settings.THUMB_CACHE_MAX_BYTES
+
+    f = lookup(key, cache_path)
+    if f is not None:
+        return f
+
+    path = entry_path(key, cache_path)
+    dir = os.path.dirname(path)
+    if not os.path.exists(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            # Somebody else created it.
+            pass
+
+    with open(path + LOCK_SUFFIX, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Somebody else may have rendered the entry while we waited
+            # for the lock.
+            f = lookup(key, cache_path)
+            if f is not None:
+                return f
+            # Keep the extension of key, renderers may use it to pick a
+            # file format.
+            fd, tmp_path = tempfile.mkstemp(dir=dir, prefix=TMP_PREFIX,
+                                            suffix=os.path.splitext(key)[1])
+            os.close(fd)
+            try:
+                if not render(tmp_path):
+                    return None
+                size = os.path.getsize(tmp_path)
+                os.rename(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            try:
+                os.remove(path + LOCK_SUFFIX)
+            except OSError:
+                pass
+
+    total = _add_size(size, cache_path)
+    if total is None or total > max_bytes:
+        evict(max_bytes, cache_path)
+    return lookup(key, cache_path)
+
+def _update_size(cache_path, update):
+    # Replace the total in SIZE_FILE by update(total), where total is None
+    # if it isn't known yet, and return the new total.
+    fd = os.open(os.path.join(cache_path, SIZE_FILE),
+                 os.O_RDWR | os.O_CREAT, 0o644)
+    with os.fdopen(fd, 'r+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            total = int(f.read())
+        except ValueError:
+            total = None
+        total = update(total)
+        f.seek(0)
+        f.truncate()
+        if total is not None:
+            f.write('%d' % total)
+        return total
+
+def _add_size(n, cache_path):
+    '''
+    Add n bytes to the total size of the cache and return the new total,
+    or None if the total isn't known. The total can be too large, entries
+    removed by remove() or by deleting their directories are still
+    counted until evict() counts them again.
+    '''
+    def add(total):
+        if total is None:
+            return None
+        return total + n
+    return _update_size(cache_path, add)
+
+def _entries(cache_path):
+    for dir, dirs, files in os.walk(cache_path):
+        for name in files:
+            if (name.endswith(LOCK_SUFFIX) or name.startswith(TMP_PREFIX)
+                or name == SIZE_FILE):
+                continue
+            path = os.path.join(dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            yield st.st_atime, st.st_size, path
+
+def evict(max_bytes, cache_path=None):
+    '''
+    Remove least recently used entries until the cache is smaller than
+    max_bytes. Returns the number of bytes removed.
+    '''
+    if cache_path is None:
+        cache_path = settings.THUMB_CACHE_PATH
+    if not os.path.exists(cache_path):
+        return 0
+
+    entries = list(_entries(cache_path))
+    total = sum([size for atime, size, path in entries])
+    removed = 0
+    if total > max_bytes:
+        entries.sort()
+        for atime, size, path in entries:
+            if total - removed <= max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            removed += size
+    # Entries added during the walk are forgotten, which is fine for an
+    # estimate.
+    _update_size(cache_path, lambda old_total: total - removed)
+    return removed
+
+def remove(key, cache_path=None):
+    '''
+    Remove the entry key from the cache if it is there.
+    '''
+    try:
+        os.remove(entry_path(key, cache_path))
+    except OSError:
+        pass
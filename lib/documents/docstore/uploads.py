@@ -0,0 +1,123 @@
+'''
+Chunked, resumable uploads. An upload is initiated, its data is then sent
+in chunks at given offsets (a chunk can be resent after a failure) and
+finally the upload is finalized into a document. The data is appended to a
+temporary file in settings.UPLOAD_TEMP_PATH, which is moved into the store
+on finalization. Uploads that don't start with the PDF magic are rejected
+with the first chunk.
+'''
+
+from __future__ import with_statement
+
+from documents.docstore.ingest import PDF_MAGIC
+from documents.docstore.models import Upload
+
+from django.conf import settings
+
+import datetime
+import os
+
+class Error(Exception):
+    pass
+
+class OffsetMismatch(Error):
+    '''
+    A chunk was sent at an offset beyond the data received so far.
+    '''
+    def __init__(self, received):
+        Error.__init__(self, 'Expected offset %d or less.' % received)
+        self.received = received
+
+class NotAPdf(Error):
+    pass
+
+class Incomplete(Error):
+    pass
+
+class UploadedFile(object):
+    '''
+    The assembled data of an upload, with the name, chunks() and
+    temporary_file_path() of an uploaded file, so that store() moves it
+    instead of copying it.
+    '''
+    def __init__(self, upload):
+        self.name = upload.name
+        self.path = temp_path(upload)
+
+    def temporary_file_path(self):
+        return self.path
+
+    def chunks(self, chunk_size=64 * 1024):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+def temp_path(upload):
+    return os.path.join(settings.UPLOAD_TEMP_PATH, '%d.part' % upload.id)
+
+def initiate(user, name, size=None, title=None, tags='',
+             archive_numbers=None):
+    '''
+    Start an upload and return its Upload.
+    '''
+    expire()
+    upload = Upload(user=user, name=name, size=size, title=title,
+                    tags=tags or '', archive_numbers=archive_numbers)
+    upload.save()
+    if not os.path.exists(settings.UPLOAD_TEMP_PATH):
+        os.makedirs(settings.UPLOAD_TEMP_PATH)
+    open(temp_path(upload), 'wb').close()
+    return upload
+
+def write_chunk(upload, offset, data):
+    '''
+    Write the string data at offset of upload. Chunks may be resent, but
+    offset must not be beyond the data received so far.
+    '''
+    if offset > upload.received:
+        raise OffsetMismatch(upload.received)
+    if offset == 0 and not data.startswith(PDF_MAGIC[:len(data)]):
+        abort(upload)
+        raise NotAPdf('Not a PDF document.')
+    if upload.size is not None and offset + len(data) > upload.size:
+        raise Error('Data beyond the size of the upload.')
+    with open(temp_path(upload), 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+    upload.received = max(upload.received, offset + len(data))
+    upload.save()
+
+def finalize(upload):
+    '''
+    Return an UploadedFile with the data of the complete upload, to be
+    passed to the store() of a storage backend. Call abort() afterwards to
+    clean up.
+    '''
+    if upload.size is not None and upload.received != upload.size:
+        raise Incomplete('Received %d of %d bytes.'
+                         % (upload.received, upload.size))
+    if upload.received < len(PDF_MAGIC):
+        raise Incomplete('Received %d bytes.' % upload.received)
+    return UploadedFile(upload)
+
+def abort(upload):
+    '''
+    Delete upload and its data.
+    '''
+    path = temp_path(upload)
+    if os.path.exists(path):
+        os.remove(path)
+    upload.delete()
+
+def expire():
+    '''
+    Abort the uploads that haven't received data for
+    settings.UPLOAD_EXPIRY seconds.
+    '''
+    limit = (datetime.datetime.now()
+             - datetime.timedelta(seconds=settings.UPLOAD_EXPIRY))
+    for upload in Upload.objects.filter(updated_time__lt=limit):
+        abort(upload)
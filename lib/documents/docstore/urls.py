@@ -11,6 +11,10 @@ urlpatterns = patterns('django.contrib.auth.views',
 urlpatterns += patterns('documents.docstore.views',
     (r'^$', 'index'),
     (r'^upload/$', 'document_upload'),
+    (r'^upload/batch/$', 'document_batch_upload'),
+    (r'^upload/chunked/$', 'chunked_upload_initiate'),
+    (r'^upload/chunked/(\d+)/$', 'chunked_upload'),
+    (r'^upload/chunked/(\d+)/finalize/$', 'chunked_upload_finalize'),
     (r'^confirmation/$', 'upload_confirmation'),
     url(r'^download/(\d+)/$', 'document_download', name='download'),
     url(r'^download/(\d+)/(.+)$', 'document_download', name='download-named'),
@@ -18,7 +22,14 @@ urlpatterns += patterns('documents.docstore.views',
     (r'^delete/(\d+)/$', 'document_delete'),
     (r'^delete_confirmation/$', 'delete_confirmation'),
     (r'^thumb/(\d+)/$', 'document_thumbnail'),
+    (r'^page/(\d+)/$', 'document_page'),
+    (r'^pages/(\d+)/$', 'document_pages'),
+    (r'^sprite/$', 'document_sprite'),
     (r'^search/$', 'document_search'),
+    (r'^export/$', 'document_export'),
+    (r'^api/documents/$', 'api_documents'),
+    (r'^api/documents/bulk/$', 'api_documents_bulk'),
+    (r'^stats/$', 'timing_stats'),
 )
 
 if settings.DEBUG:
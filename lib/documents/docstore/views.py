@@ -1,7 +1,11 @@
 from __future__ import with_statement
 
-from documents.docstore.models import Document, NumberSequence
-from documents.docstore import docstore
+from documents.docstore.backends import get_storage
+from documents.docstore.models import (Document, NumberSequence, Upload,
+                                       prefetch_tags)
+from documents.docstore import (api, docstore, export, fulltext, ingest,
+                                 instrument, jobs, pagecache, paging,
+                                 streaming, tagstats, uploads)
 
 from tagging.forms import TagField
 from tagging.models import Tag, TaggedItem
@@ -9,20 +13,26 @@ from tagging.utils import edit_string_for_tags
 
 from django import forms
 from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import ObjectDoesNotExist
-from django.core.paginator import Paginator
 from django.core.urlresolvers import reverse
 from django.db import transaction
-from django.http import HttpResponse, Http404
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseNotAllowed)
 from django.shortcuts import get_object_or_404, redirect, render_to_response
-from django.template import RequestContext
+from django.template import RequestContext, loader
+from django.utils import simplejson
+from django.utils.cache import patch_vary_headers
 
+import functools
 import os
 from urllib import urlencode
 
 class SearchForm(forms.Form):
-    tags = TagField(required=False)
+    q = forms.CharField(required=False, label='Text')
+    tags = TagField(required=False, 
+                    widget=forms.TextInput(attrs={'list': 'tag-names'}))
     start_date = forms.DateField(required=False, help_text="YYYY-MM-DD")
     end_date = forms.DateField(required=False, help_text="YYYY-MM-DD")
 
@@ -33,28 +43,53 @@ class DocumentUploadForm(forms.Form):
     file = forms.FileField()
     archive_numbers = forms.IntegerField(required=False)
 
+class BatchUploadForm(forms.Form):
+    title_from_file_name = forms.BooleanField(required=False, initial=True)
+    tags = TagField(required=False)
+    archive_numbers = forms.IntegerField(
+        required=False, help_text='Archive numbers per document.')
+
+class ChunkedUploadForm(forms.Form):
+    name = forms.CharField(max_length=200)
+    size = forms.IntegerField(required=False, min_value=0)
+    title_from_file_name = forms.BooleanField(required=False, initial=False)
+    title = forms.CharField(required=False)
+    tags = TagField(required=False)
+    archive_numbers = forms.IntegerField(required=False)
+
+class BulkChangeForm(forms.Form):
+    # Only the fields present in a change are applied, see api.apply().
+    title = forms.CharField(max_length=200, required=False)
+    creation_time = forms.DateTimeField(required=False)
+    tags = TagField(required=False)
+    add_tags = TagField(required=False)
+    remove_tags = TagField(required=False)
+
 class DocumentPropertiesForm(forms.Form):
     title = forms.CharField(max_length=200, required=False)
     tags = TagField(required=False)
     creation_time = forms.DateTimeField()
 
-def create_document(user, uploaded_file, title, tags, archive_numbers):
-    if archive_numbers is not None:
-        archive_numbers_start = user.numbersequence.reserve(archive_numbers)
-    else:
-        archive_numbers_start = None
+def create_document(user, uploaded_file, title, tags, archive_numbers,
+                    tag_changes):
+    # Must be called inside a transaction, tag_changes (a
+    # tagstats.Changes) is applied after the commit.
     d = Document(user=user, store_path='NOT SET', 
-                 archive_numbers_start=archive_numbers_start,
                  archive_numbers_length=archive_numbers, 
                  title=title)
     d.save()
-    Tag.objects.update_tags(d, tags)
+    tag_changes.update_tags(d, tags)
+    fulltext.index_metadata(d.id, user.id, d.creation_time, title, tags)
 
-    relative_path = docstore.store(uploaded_file, user.username, d.id,  
-                                   d.creation_time.timetuple())
+    relative_path = get_storage().store(uploaded_file, user.username, d.id,
+                                        d.creation_time.timetuple())
 
     d.store_path = relative_path
+    if archive_numbers is not None:
+        # Reserved last, the sequence is locked until the commit.
+        d.archive_numbers_start = user.numbersequence.reserve(archive_numbers)
     d.save()
+    return d
 
 @login_required
 def delete_confirmation(request):
@@ -62,10 +97,23 @@ def delete_confirmation(request):
                               context_instance=RequestContext(request))
 
 @login_required
+@transaction.commit_manually
 def document_delete(request, id):
-    document = get_object_or_404(Document, user=request.user, id=id)
-    docstore.delete(document.store_path)
-    document.delete()
+    try:
+        document = get_object_or_404(Document, user=request.user, id=id)
+        storage = get_storage()
+        released = storage.release([document.store_path])
+        fulltext.remove(document.id)
+        tag_changes = tagstats.Changes()
+        tag_changes.document_deleted(document)
+        document.delete()
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    storage.remove(released)
+    tag_changes.apply()
+    pagecache.bump(request.user.id)
     return redirect(reverse(delete_confirmation))
 
 def number_sequence(user):
@@ -76,77 +124,133 @@ def number_sequence(user):
         seq.user = user
         seq.save()
 
-def _render_index_page(request, document_list, form, search_terms=[]):
-    paginator = Paginator(document_list, 
-                          settings.THUMB_COLUMNS * settings.THUMB_ROWS)
-
-    # Make sure page request is an int. If not, deliver first page.
+def _render_document_page(document_list, search_terms, cursor, use_thumbs):
+    per_page = settings.THUMB_COLUMNS * settings.THUMB_ROWS
     try:
-        page = int(request.GET.get('page', 1))
+        documents = paging.page(document_list, per_page, **dict(cursor))
     except ValueError:
-        page = 1
-
-    # If page request is out of range, deliver last page of results.
-    if page > paginator.num_pages:
-        page = paginator.num_pages
-
-    documents = paginator.page(page)
-    use_thumbs = 'thumbs' in request.GET    
+        # Malformed cursor, deliver first page.
+        cursor = []
+        documents = paging.page(document_list, per_page)
+    documents.object_list = prefetch_tags(documents.object_list)
+    if use_thumbs:
+        for i, document in enumerate(documents.object_list):
+            document.sprite_offset = i * settings.THUMB_WIDTH
+        sprite_query = urlencode([('ids', ','.join([
+            str(document.id) for document in documents.object_list]))])
+    else:
+        sprite_query = None
 
-    def get_query(to_page, use_thumbs=use_thumbs):
+    def get_query(cursor, use_thumbs=use_thumbs):
         query = search_terms[:]
-        if to_page:
-            query.append(('page', to_page))
+        query.extend(cursor)
         if use_thumbs:
             query.append(('thumbs', ''))
         return urlencode(query)
-    next_query = get_query(documents.next_page_number() 
-                           if documents.has_next() 
-                           else None)
-    prev_query = get_query(documents.previous_page_number()
-                           if documents.has_previous() 
-                           else None)
-    thumbs_query = get_query(page, True)
-    list_query = get_query(page, False)
+    next_query = get_query([('after', documents.next_cursor)])
+    prev_query = get_query([('before', documents.previous_cursor)])
+    thumbs_query = get_query(cursor, True)
+    list_query = get_query(cursor, False)
+
+    return loader.render_to_string('doc_page.html',
+                                   dict(documents=documents, 
+                                        list_query=list_query,
+                                        thumbs_query=thumbs_query,
+                                        prev_query=prev_query,
+                                        next_query=next_query,
+                                        use_thumbs=use_thumbs,
+                                        sprite_query=sprite_query,
+                                        thumb_width=settings.THUMB_WIDTH,
+                                        thumb_height=
+                                            settings.THUMB_SPRITE_HEIGHT,
+                                        columns=settings.THUMB_COLUMNS))
+
+def _render_index_page(request, listing, get_documents, form,
+                       search_terms=[]):
+    '''
+    listing names the kind of page (index, search or invalid-search) for
+    the page cache. get_documents() returns the documents to list, it is
+    only called when the page isn't cached.
+    '''
+    cursor = [(name, request.GET[name]) for name in ('after', 'before')
+              if name in request.GET]
+    use_thumbs = 'thumbs' in request.GET    
+    params = (listing, urlencode(search_terms), tuple(cursor), use_thumbs)
+    document_page = pagecache.get(
+        request.user.id, params,
+        lambda: _render_document_page(get_documents(), search_terms, cursor,
+                                      use_thumbs))
 
     return render_to_response('index.html', 
-                              dict(documents=documents, 
-                                   list_query=list_query,
-                                   thumbs_query=thumbs_query,
-                                   prev_query=prev_query,
-                                   next_query=next_query,
-                                   form=form, use_thumbs=use_thumbs,
-                                   columns=settings.THUMB_COLUMNS),
+                              dict(document_page=document_page,
+                                   export_query=urlencode(search_terms),
+                                   form=form,
+                                   tag_cloud=tagstats.cloud(request.user.id),
+                                   tag_names=tagstats.names(request.user.id)),
                               context_instance=RequestContext(request))
 
 @login_required
 def index(request):
-    documents = Document.objects.filter(user=request.user)
     form = SearchForm()
-    return _render_index_page(request, documents, form)
+    return _render_index_page(
+        request, 'index', lambda: Document.objects.filter(user=request.user),
+        form)
 
-@login_required
-def document_search(request):
-    form = SearchForm(request.GET)
-    if form.is_valid():
-        search_terms = []
-        filter = dict(user=request.user)
-        start_date = form.cleaned_data['start_date']
-        if not start_date is None:
-            filter['creation_time__gte'] = start_date
-            search_terms.append(('start_date', start_date))
-        end_date = form.cleaned_data['end_date']
-        if not end_date is None:
-            filter['creation_time__lte'] = end_date
-            search_terms.append(('end_date', end_date))
+def _search(request, form):
+    '''
+    Return the search terms of the valid SearchForm form and a function
+    that returns the matching documents.
+    '''
+    search_terms = []
+    filter = dict(user=request.user)
+    start_date = form.cleaned_data['start_date']
+    if not start_date is None:
+        filter['creation_time__gte'] = start_date
+        search_terms.append(('start_date', start_date))
+    end_date = form.cleaned_data['end_date']
+    if not end_date is None:
+        filter['creation_time__lte'] = end_date
+        search_terms.append(('end_date', end_date))
+    q = form.cleaned_data['q']
+    if q:
+        search_terms.append(('q', q.encode('utf-8')))
+    tags = form.cleaned_data['tags']
+    if tags:
+        search_terms.append(('tags', tags))
+
+    def get_documents():
         documents = Document.objects.filter(**filter)
-        tags = form.cleaned_data['tags']
         if tags:
             documents = TaggedItem.objects.get_by_model(documents, tags)
-            search_terms.append(('tags', tags))
-    else:
-        documents = []
-    return _render_index_page(request, documents, form, search_terms)
+        if q:
+            # All matches, the other filters and paging apply to them.
+            documents = paging.Restricted(
+                documents, functools.partial(fulltext.search_keys,
+                                             request.user.id, q))
+        return documents
+    return search_terms, get_documents
+
+@login_required
+def document_search(request):
+    form = SearchForm(request.GET)
+    if not form.is_valid():
+        return _render_index_page(request, 'invalid-search', lambda: [],
+                                  form)
+    search_terms, get_documents = _search(request, form)
+    return _render_index_page(request, 'search', get_documents, form,
+                              search_terms)
+
+@login_required
+def document_export(request):
+    form = SearchForm(request.GET)
+    if not form.is_valid():
+        return HttpResponseBadRequest('Invalid search.')
+    get_documents = _search(request, form)[1]
+    response = HttpResponse(export.archive(get_documents(), get_storage(),
+                                           'manifest' in request.GET),
+                            mimetype='application/zip')
+    response['Content-Disposition'] = 'attachment; filename=documents.zip'
+    return response
 
 @login_required
 def upload_confirmation(request):
@@ -170,10 +274,14 @@ def document_upload(request):
                 title = form.cleaned_data['title']
             else:
                 title = None
+            tag_changes = tagstats.Changes()
             try:
                 create_document(request.user, file, title, 
-                                form.cleaned_data['tags'], archive_numbers)
+                                form.cleaned_data['tags'], archive_numbers,
+                                tag_changes)
                 transaction.commit()
+                tag_changes.apply()
+                pagecache.bump(request.user.id)
                 return redirect(reverse(upload_confirmation))
             except docstore.NotAPdf:
                 transaction.rollback()
@@ -186,28 +294,254 @@ def document_upload(request):
     return render_to_response('upload.html', dict(form=form),
                               context_instance=RequestContext(request))
 
+@login_required
+@transaction.commit_manually
+def document_batch_upload(request):
+    results = None
+    if request.method == 'POST':
+        # Make sure that this user has a NumberSequence instance.
+        number_sequence(request.user)
+
+        form = BatchUploadForm(request.POST)
+        if form.is_valid():
+            files, results = ingest.expand(request.FILES.getlist('files'),
+                                           request.FILES.getlist('archives'))
+            tag_changes = tagstats.Changes()
+            try:
+                results += ingest.create_documents(
+                    request.user, files, form.cleaned_data['tags'],
+                    form.cleaned_data['archive_numbers'],
+                    form.cleaned_data['title_from_file_name'], tag_changes)
+                transaction.commit()
+                tag_changes.apply()
+                pagecache.bump(request.user.id)
+            except:
+                transaction.rollback()
+                raise
+    else:
+        form = BatchUploadForm()
+    response = render_to_response('batch_upload.html',
+                                  dict(form=form, results=results),
+                                  context_instance=RequestContext(request))
+    # number_sequence() may have created a NumberSequence.
+    transaction.commit()
+    return response
+
+def _json_response(data, status=200):
+    response = HttpResponse(simplejson.dumps(data),
+                            mimetype='application/json')
+    response.status_code = status
+    return response
+
+def _form_errors(form):
+    return dict((name, [unicode(error) for error in field_errors])
+                for name, field_errors in form.errors.items())
+
+def _upload_state(upload):
+    return dict(id=upload.id, name=upload.name, size=upload.size,
+                offset=upload.received,
+                url=reverse(chunked_upload, args=[upload.id]))
+
+@login_required
+def chunked_upload_initiate(request):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    form = ChunkedUploadForm(request.POST)
+    if not form.is_valid():
+        return _json_response(dict(errors=_form_errors(form)), 400)
+    name = form.cleaned_data['name']
+    if form.cleaned_data['title_from_file_name']:
+        title = os.path.splitext(name)[0]
+    else:
+        title = form.cleaned_data['title'] or None
+    upload = uploads.initiate(request.user, name, form.cleaned_data['size'],
+                              title, form.cleaned_data['tags'],
+                              form.cleaned_data['archive_numbers'])
+    return _json_response(_upload_state(upload), 201)
+
+@login_required
+def chunked_upload(request, id):
+    upload = get_object_or_404(Upload, user=request.user, id=id)
+    if request.method == 'GET':
+        return _json_response(_upload_state(upload))
+    elif request.method == 'DELETE':
+        uploads.abort(upload)
+        return _json_response(dict(id=int(id)))
+    elif request.method != 'PUT':
+        return HttpResponseNotAllowed(['GET', 'PUT', 'DELETE'])
+
+    try:
+        offset = int(request.GET['offset'])
+    except (KeyError, ValueError):
+        return _json_response(dict(error='Missing or bad offset.'), 400)
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > settings.UPLOAD_CHUNK_MAX_BYTES:
+        return _json_response(
+            dict(error='Chunks must not exceed %d bytes.'
+                 % settings.UPLOAD_CHUNK_MAX_BYTES), 413)
+    try:
+        uploads.write_chunk(upload, offset, request.raw_post_data)
+    except uploads.OffsetMismatch as e:
+        return _json_response(dict(_upload_state(upload), error=str(e)), 409)
+    except uploads.NotAPdf as e:
+        return _json_response(dict(error=str(e)), 415)
+    except uploads.Error as e:
+        return _json_response(dict(_upload_state(upload), error=str(e)), 400)
+    return _json_response(_upload_state(upload))
+
+@login_required
+@transaction.commit_manually
+def chunked_upload_finalize(request, id):
+    upload = get_object_or_404(Upload, user=request.user, id=id)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        file = uploads.finalize(upload)
+    except uploads.Incomplete as e:
+        transaction.rollback()
+        return _json_response(dict(_upload_state(upload), error=str(e)), 400)
+
+    # Make sure that this user has a NumberSequence instance.
+    number_sequence(request.user)
+    tag_changes = tagstats.Changes()
+    try:
+        document = create_document(request.user, file, upload.title,
+                                   upload.tags, upload.archive_numbers,
+                                   tag_changes)
+        uploads.abort(upload)
+        transaction.commit()
+    except docstore.NotAPdf:
+        transaction.rollback()
+        uploads.abort(upload)
+        transaction.commit()
+        return _json_response(dict(error='Not a PDF document.'), 415)
+    except:
+        transaction.rollback()
+        raise
+    tag_changes.apply()
+    pagecache.bump(request.user.id)
+    return _json_response(
+        dict(id=document.id, url=reverse('download', args=[document.id])),
+        201)
+
+@login_required
+def api_documents(request):
+    # A page of the documents matching the search form parameters, with
+    # the fields (all by default) of the fields parameter. Pages are
+    # followed with the next and previous cursors in after and before.
+    form = SearchForm(request.GET)
+    if not form.is_valid():
+        return _json_response(dict(errors=_form_errors(form)), 400)
+    try:
+        fields = api.parse_fields(request.GET.get('fields'))
+    except api.Error as e:
+        return _json_response(dict(error=str(e)), 400)
+    try:
+        per_page = int(request.GET.get('per_page', settings.API_PAGE_SIZE))
+    except ValueError:
+        per_page = 0
+    if not 0 < per_page <= settings.API_MAX_PAGE_SIZE:
+        return _json_response(
+            dict(error='per_page must be between 1 and %d.'
+                 % settings.API_MAX_PAGE_SIZE), 400)
+    search_terms, get_documents = _search(request, form)
+    documents = get_documents().only(*api.columns(fields))
+    cursor = dict([(name, request.GET[name])
+                   for name in ('after', 'before') if name in request.GET])
+    try:
+        page = paging.page(documents, per_page, **cursor)
+    except ValueError:
+        return _json_response(dict(error='Malformed cursor.'), 400)
+    return _json_response(dict(documents=api.serialize(page.object_list,
+                                                       fields),
+                               next=page.next_cursor,
+                               previous=page.previous_cursor))
+
+def _parse_bulk(data):
+    # Return the changes and deletions for api.apply() of the JSON object
+    # data, or raise api.Error.
+    def ids(value):
+        if (not isinstance(value, list)
+            or [id for id in value if type(id) is not int]):
+            raise api.Error('Expected a list of document ids.')
+        return value
+
+    if not isinstance(data, dict):
+        raise api.Error('Expected an object.')
+    changes = []
+    count = 0
+    for change in data.get('update', []):
+        if not isinstance(change, dict):
+            raise api.Error('Expected an object for each update.')
+        change_ids = ids(change.get('ids'))
+        unknown = [name for name in change
+                   if name != 'ids' and name not in api.CHANGES]
+        if unknown:
+            raise api.Error('Unknown changes: %s.' % ', '.join(unknown))
+        form = BulkChangeForm(change)
+        if not form.is_valid():
+            raise api.Error('; '.join(['%s: %s' % (name, ' '.join(errors))
+                                       for name, errors in
+                                       _form_errors(form).items()]))
+        values = dict([(name, form.cleaned_data[name])
+                       for name in api.CHANGES if name in change])
+        if 'creation_time' in values and values['creation_time'] is None:
+            raise api.Error('creation_time must not be empty.')
+        changes.append((change_ids, values))
+        count += len(change_ids)
+    delete = ids(data.get('delete', []))
+    if count + len(delete) > settings.API_BULK_MAX_DOCUMENTS:
+        raise api.Error('At most %d documents can be changed at once.'
+                        % settings.API_BULK_MAX_DOCUMENTS)
+    return changes, delete
+
+@login_required
+@transaction.commit_manually
+def api_documents_bulk(request):
+    # Changes to and deletion of many documents, a JSON object like
+    # {"update": [{"ids": [1, 2], "add_tags": "paid"}], "delete": [3]}.
+    # Either all of it is applied or nothing.
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        changes, delete = _parse_bulk(simplejson.loads(request.raw_post_data))
+    except ValueError:
+        return _json_response(dict(error='Malformed JSON.'), 400)
+    except api.Error as e:
+        return _json_response(dict(error=str(e)), 400)
+    try:
+        result = api.apply(request.user, changes, delete)
+        transaction.commit()
+    except api.MissingDocuments as e:
+        transaction.rollback()
+        return _json_response(dict(error=str(e), missing=e.ids), 404)
+    except:
+        transaction.rollback()
+        raise
+    api.finish(result)
+    return _json_response(dict(updated=result.updated_ids(),
+                               deleted=result.deleted_ids()))
+
 @login_required
 def document_download(request, id, name=None):
     document = get_object_or_404(Document, user=request.user, id=id)
     if name is None:
         # Redirect this to an url with a decent file name.
-        if document.title is None:
-            file_name = os.path.basename(document.store_path)
-        else:
-            # Translate document title to a safe(?) file name.
-            # This need more thought. How can we derive a portable file
-            # name from the document title?
-            table = {ord(' ') : u'_', ord("'") : u'_'}
-            file_name = '%s.pdf' % document.title.translate(table).lower()
-        return redirect(reverse('download-named', args=[id, file_name]))
+        return redirect(reverse('download-named',
+                                args=[id, document.download_name()]))
     else:
-        doc = docstore.get(document.store_path)
+        storage = get_storage()
+        doc = storage.get(document.store_path)
         if doc is None:
             raise Http404
-        with doc:
-            return HttpResponse(doc.read(), mimetype='application/pdf')
+        return streaming.serve(request, doc, 'application/pdf',
+                               storage.stat(document.store_path))
 
 @login_required
+@transaction.commit_manually
 def document_properties(request, id):
     document = get_object_or_404(Document, user=request.user, id=id)
     if request.method == 'POST':
@@ -218,19 +552,77 @@ def document_properties(request, id):
             else:
                 document.title = None
             document.creation_time = form.cleaned_data['creation_time']
-            document.save()
-            Tag.objects.update_tags(document, form.cleaned_data['tags'])
-            request.user.message_set.create(message='Updated properties.')
+            tag_changes = tagstats.Changes()
+            try:
+                document.save()
+                tag_changes.update_tags(document, form.cleaned_data['tags'])
+                fulltext.index_metadata(document.id, document.user_id,
+                                        document.creation_time,
+                                        document.title,
+                                        form.cleaned_data['tags'])
+                request.user.message_set.create(
+                    message='Updated properties.')
+                transaction.commit()
+            except:
+                transaction.rollback()
+                raise
+            tag_changes.apply()
+            pagecache.bump(request.user.id)
             return redirect(reverse(document_properties, args=[id]))
     else:
         tag_string = edit_string_for_tags(Tag.objects.get_for_object(document))
         form = DocumentPropertiesForm(dict(title=document.title, 
                                            tags=tag_string,
                                            creation_time=document.creation_time))
-    return render_to_response('properties.html', 
-                              dict(document=document,
-                                   form=form),
-                              context_instance=RequestContext(request))
+    response = render_to_response('properties.html', 
+                                  dict(document=document,
+                                       form=form),
+                                  context_instance=RequestContext(request))
+    transaction.commit()
+    return response
+
+def _accepted_types(request):
+    # The media types in the Accept header with a non-zero quality.
+    types = set()
+    for item in request.META.get('HTTP_ACCEPT', '*/*').split(','):
+        params = item.split(';')
+        q = 1.0
+        for param in params[1:]:
+            name, sep, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            types.add(params[0].strip().lower())
+    return types
+
+def _thumb_profiles(request):
+    # The profiles of the formats in THUMB_FORMATS that the client accepts,
+    # in order of preference and in the hi-DPI variant if size=2x is asked
+    # for, followed by THUMB_DEFAULT_PROFILE. Formats that are not
+    # supported everywhere must be asked for explicitly, wildcards only
+    # match THUMB_WILDCARD_FORMATS. Formats ImageMagick can't write here
+    # are left out.
+    accepted = _accepted_types(request)
+    wildcard = 'image/*' in accepted or '*/*' in accepted
+    if request.GET.get('size') == '2x':
+        suffix = '-2x'
+    else:
+        suffix = ''
+    profiles = []
+    for format in settings.THUMB_FORMATS:
+        if format in docstore.unsupported_formats:
+            continue
+        if ('image/%s' % format in accepted or 
+            (wildcard and format in settings.THUMB_WILDCARD_FORMATS)):
+            profile = format + suffix
+            if profile in settings.THUMB_PROFILES:
+                profiles.append(profile)
+    if settings.THUMB_DEFAULT_PROFILE not in profiles:
+        profiles.append(settings.THUMB_DEFAULT_PROFILE)
+    return profiles
 
 @login_required
 def document_thumbnail(request, id):
@@ -239,8 +631,110 @@ def document_thumbnail(request, id):
         n = int(request.GET.get('n', 0))
     except:
         n = 0
-    thumb = docstore.get_thumb(document.store_path, n)
+    storage = get_storage()
+    thumb = None
+    for profile in _thumb_profiles(request):
+        thumb = storage.get_thumb(document.store_path, n, profile,
+                                  render=False)
+        if thumb is None:
+            if jobs.is_pending(document.id, docstore.GENERATE_THUMBS_JOB):
+                return redirect(settings.THUMB_PENDING_URL)
+            try:
+                thumb = storage.get_thumb(document.store_path, n, profile)
+            except docstore.UnsupportedFormat:
+                # Try the next format.
+                continue
+        break
     if thumb is None:
         raise Http404
-    with thumb:
-        return HttpResponse(thumb.read(), mimetype='image/png')
+    response = streaming.serve(
+        request, thumb, 'image/%s' % settings.THUMB_PROFILES[profile]['format'])
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+def _page_width(request):
+    # Widths are rounded up to one of PAGE_WIDTHS so that the cache
+    # doesn't fill up with renderings for every width asked for.
+    try:
+        width = int(request.GET.get('width', 0))
+    except ValueError:
+        width = 0
+    for page_width in settings.PAGE_WIDTHS:
+        if page_width >= width:
+            return page_width
+    return settings.PAGE_WIDTHS[-1]
+
+@login_required
+def document_page(request, id):
+    # Page n of the document rendered at the width parameter, for
+    # previewing pages without downloading the whole document. The image
+    # format is negotiated like for thumbnails.
+    document = get_object_or_404(Document, user=request.user, id=id)
+    try:
+        n = int(request.GET.get('n', 0))
+    except ValueError:
+        raise Http404
+    page = None
+    for name in _thumb_profiles(request):
+        profile = settings.THUMB_PROFILES[name]
+        try:
+            page = get_storage().get_page(document.store_path, n,
+                                          _page_width(request),
+                                          profile['format'],
+                                          profile.get('quality'))
+        except docstore.UnsupportedFormat:
+            continue
+        break
+    if page is None:
+        raise Http404
+    response = streaming.serve(request, page, 'image/%s' % profile['format'])
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+@login_required
+def document_pages(request, id):
+    # A PDF of pages first to last (counted from 0, like thumbnails).
+    document = get_object_or_404(Document, user=request.user, id=id)
+    try:
+        first = int(request.GET['first'])
+        last = int(request.GET.get('last', first))
+    except (KeyError, ValueError):
+        return HttpResponseBadRequest('Expected first (and last) page.')
+    if (first < 0 or last < first
+        or last - first >= settings.PAGE_RANGE_MAX_PAGES):
+        return HttpResponseBadRequest('Invalid range of pages.')
+    pages = get_storage().get_pages(document.store_path, first, last)
+    if pages is None:
+        raise Http404
+    return streaming.serve(request, pages, 'application/pdf')
+
+@login_required
+def document_sprite(request):
+    # A sprite sheet of the first thumbnails of the documents in the ids
+    # parameter, so that a page of thumbnails costs a single request.
+    try:
+        ids = [int(id) for id in request.GET.get('ids', '').split(',')]
+    except ValueError:
+        raise Http404
+    ids = ids[:settings.THUMB_COLUMNS * settings.THUMB_ROWS]
+    paths = dict(Document.objects.filter(user=request.user, id__in=ids)
+                 .values_list('id', 'store_path'))
+    sprite = get_storage().get_sprite([paths.get(id) for id in ids])
+    if sprite is None:
+        raise Http404
+    return streaming.serve(request, sprite, 'image/png')
+
+def _format_metric(metric, values):
+    if metric.endswith('_count') or metric.endswith('_bytes'):
+        return tuple(['%d' % value for value in values])
+    # Seconds to milliseconds.
+    return tuple(['%.1f' % (value * 1000) for value in values])
+
+@staff_member_required
+def timing_stats(request):
+    rows = [dict(pattern=pattern, samples=samples,
+                 metrics=[_format_metric(metric, metrics[metric])
+                          for metric in instrument.METRICS])
+            for pattern, samples, metrics in instrument.stats()]
+    return render_to_response('stats.html', dict(rows=rows),
+                              context_instance=RequestContext(request))
@@ -0,0 +1,150 @@
+'''
+A zip archive writer that produces the archive as a sequence of strings,
+for streaming it in a response as it is built. Nothing is seeked back to:
+the CRC and sizes of each member follow its data in a data descriptor.
+Members are stored uncompressed (PDFs are compressed already). Only the
+central directory, a few dozen bytes per member, is kept in memory. ZIP64
+records are used where sizes or offsets need them.
+'''
+
+import struct
+import time
+import zlib
+
+ZIP64_LIMIT = 0xffffffff
+ZIP64_COUNT_LIMIT = 0xffff
+
+# General purpose flags: sizes in a data descriptor and UTF-8 names.
+FLAGS = 0x08 | 0x800
+VERSION = 20
+VERSION_ZIP64 = 45
+# Made by Unix, so external attributes are permissions.
+MADE_BY = 3 << 8
+
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+DATA_DESCRIPTOR = struct.Struct('<4s3L')
+DATA_DESCRIPTOR_ZIP64 = struct.Struct('<4sL2Q')
+CENTRAL_HEADER = struct.Struct('<4s6H3L5H2L')
+ZIP64_END = struct.Struct('<4sQ2H2L4Q')
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+END = struct.Struct('<4s4H2LH')
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+class _Member(object):
+    def __init__(self, name, mtime, offset, zip64):
+        self.name = name
+        self.mtime = mtime
+        self.offset = offset
+        self.zip64 = zip64
+        self.crc = 0
+        self.size = 0
+
+class ZipStream(object):
+    '''
+    Call add() for each member and close() at the end, and pass on the
+    strings the generators they return yield.
+    '''
+    def __init__(self):
+        self.offset = 0
+        self.members = []
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def add(self, name, chunks, mtime=None, size=None):
+        '''
+        Yield the strings of a member named name (a unicode string) with
+        the data in the iterable chunks. size is the expected size; if it
+        isn't given ZIP64 sizes are used in case it is large.
+        '''
+        if mtime is None:
+            mtime = time.time()
+        zip64 = size is None or size >= ZIP64_LIMIT
+        member = _Member(name.encode('utf-8'), mtime, self.offset, zip64)
+        dos_time, dos_date = _dos_time(mtime)
+        if zip64:
+            extra = struct.pack('<2H2Q', 1, 16, 0, 0)
+            version = VERSION_ZIP64
+            sizes = ZIP64_LIMIT
+        else:
+            extra = ''
+            version = VERSION
+            sizes = 0
+        yield self._emit(LOCAL_HEADER.pack(
+                'PK\x03\x04', version, FLAGS, 0, dos_time, dos_date, 0,
+                sizes, sizes, len(member.name), len(extra))
+                         + member.name + extra)
+        crc = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            member.size += len(chunk)
+            yield self._emit(chunk)
+        member.crc = crc & 0xffffffff
+        if zip64:
+            descriptor = DATA_DESCRIPTOR_ZIP64.pack(
+                'PK\x07\x08', member.crc, member.size, member.size)
+        elif member.size >= ZIP64_LIMIT:
+            raise ValueError('%s is larger than its given size' % name)
+        else:
+            descriptor = DATA_DESCRIPTOR.pack(
+                'PK\x07\x08', member.crc, member.size, member.size)
+        yield self._emit(descriptor)
+        self.members.append(member)
+
+    def _central_header(self, member):
+        values = []
+        size = member.size
+        if size >= ZIP64_LIMIT:
+            values.extend([size, size])
+            size = ZIP64_LIMIT
+        offset = member.offset
+        if offset >= ZIP64_LIMIT:
+            values.append(offset)
+            offset = ZIP64_LIMIT
+        if values:
+            extra = struct.pack('<2H%dQ' % len(values), 1, 8 * len(values),
+                                *values)
+        else:
+            extra = ''
+        if member.zip64 or values:
+            version = VERSION_ZIP64
+        else:
+            version = VERSION
+        dos_time, dos_date = _dos_time(member.mtime)
+        return (CENTRAL_HEADER.pack(
+                'PK\x01\x02', MADE_BY | version, version, FLAGS, 0,
+                dos_time, dos_date, member.crc, size, size, len(member.name),
+                len(extra), 0, 0, 0, 0o100644 << 16, offset)
+                + member.name + extra)
+
+    def close(self):
+        '''
+        Yield the strings of the central directory, which ends the
+        archive.
+        '''
+        start = self.offset
+        for member in self.members:
+            yield self._emit(self._central_header(member))
+        count = len(self.members)
+        size = self.offset - start
+        if (count >= ZIP64_COUNT_LIMIT or size >= ZIP64_LIMIT
+            or start >= ZIP64_LIMIT):
+            zip64_end = self.offset
+            yield self._emit(ZIP64_END.pack(
+                    'PK\x06\x06', ZIP64_END.size - 12,
+                    MADE_BY | VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+                    count, count, size, start))
+            yield self._emit(ZIP64_LOCATOR.pack('PK\x06\x07', 0, zip64_end,
+                                                1))
+        yield self._emit(END.pack('PK\x05\x06', 0, 0,
+                                  min(count, ZIP64_COUNT_LIMIT),
+                                  min(count, ZIP64_COUNT_LIMIT),
+                                  min(size, ZIP64_LIMIT),
+                                  min(start, ZIP64_LIMIT), 0))
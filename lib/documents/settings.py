@@ -62,6 +62,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'documents.docstore.middleware.TimingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -85,9 +86,96 @@ FORCE_LOWERCASE_TAGS = True
 
 # docstore settings
 DOCUMENTSTORE_PATH = here('..', '..', 'thedocuments')
+# Storage backend used by the views. MmapStorage in
+# documents.docstore.backends.memorymapped reads files through mmap.
+DOCUMENTSTORE_BACKEND = \
+    'documents.docstore.backends.filesystem.FileSystemStorage'
+# Store identical uploads only once (under the SHA-1 of their content).
+DOCUMENTSTORE_DEDUPLICATE = False
+# Set to e.g. 'X-Sendfile' to let the web server send documents (see
+# apache/docstore.conf). If None documents are streamed by Django.
+DOCUMENTSTORE_SENDFILE_HEADER = None
+# Batch uploads extract at most this many bytes from a member of a zip
+# archive and from a whole archive.
+INGEST_MAX_MEMBER_BYTES = 256 * 1024 * 1024
+INGEST_MAX_ARCHIVE_BYTES = 1024 * 1024 * 1024
+# Chunked uploads (see docstore.uploads) are assembled in this directory,
+# which should be on the same file system as DOCUMENTSTORE_PATH so that
+# finished uploads are moved rather than copied into the store.
+UPLOAD_TEMP_PATH = here('..', '..', 'uploads')
+UPLOAD_CHUNK_MAX_BYTES = 8 * 1024 * 1024
+# Uploads that receive no data for this many seconds are deleted.
+UPLOAD_EXPIRY = 24 * 60 * 60
+# Progress of manage.py maintain_store, so interrupted runs can resume.
+MAINTENANCE_CHECKPOINT_PATH = here('..', '..', 'maintenance.checkpoint')
+# manage.py pack_documents moves documents older than this many days into
+# compressed pack files of about PACK_MAX_BYTES (see docstore.packs).
+PACK_MIN_AGE_DAYS = 30
+PACK_MAX_BYTES = 1024 * 1024 * 1024
+PACK_COMPRESSION_LEVEL = 6
 THUMB_WIDTH = 120
+# Thumbnail profiles by name: image format, width and quality (for lossy
+# formats). Profiles named <format>-2x are the hi-DPI variants.
+THUMB_PROFILES = {
+    'png': dict(format='png', width=THUMB_WIDTH),
+    'png-2x': dict(format='png', width=2 * THUMB_WIDTH),
+    'jpeg': dict(format='jpeg', width=THUMB_WIDTH, quality=80),
+    'jpeg-2x': dict(format='jpeg', width=2 * THUMB_WIDTH, quality=70),
+    'webp': dict(format='webp', width=THUMB_WIDTH, quality=75),
+    'webp-2x': dict(format='webp', width=2 * THUMB_WIDTH, quality=65),
+}
+# Used when nothing else is acceptable. Thumbnails written by
+# generate_thumbs are in this profile.
+THUMB_DEFAULT_PROFILE = 'png'
+# Formats document_thumbnail serves, in order of preference, and the ones
+# that clients accepting image/* or */* are assumed to support.
+THUMB_FORMATS = ('webp', 'jpeg', 'png')
+THUMB_WILDCARD_FORMATS = ('jpeg', 'png')
+# Number of processes generate_thumbs renders pages with.
+THUMB_WORKERS = 4
+# Height of the cells of the thumbnail sprite sheets.
+THUMB_SPRITE_HEIGHT = 170
 THUMB_COLUMNS = 3
 THUMB_ROWS = 2
+# Thumbnails are rendered on demand into this size bounded cache.
+THUMB_CACHE_PATH = here('..', '..', 'thumbcache')
+THUMB_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Default and maximum number of documents in a page of the JSON API, and
+# the maximum number of documents a bulk request may change.
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+API_BULK_MAX_DOCUMENTS = 500
+# document_page renders pages at the first of these widths (in pixels)
+# that is at least the width asked for.
+PAGE_WIDTHS = (400, 800, 1200, 1600, 2400)
+# document_pages extracts at most this many pages at a time.
+PAGE_RANGE_MAX_PAGES = 100
+# Served by document_thumbnail while thumbnails are being generated.
+THUMB_PENDING_URL = '/site_media/images/thumb-pending.svg'
+
+# background job settings (see manage.py process_jobs)
+JOB_WORKERS = 2
+JOB_POLL_INTERVAL = 2          # Seconds between polls of an empty queue.
+
+GHOSTSCRIPT_PATH = 'gs'
+
+# Number of requests per URL pattern the stats view aggregates.
+TIMING_SAMPLES = 1000
+
+CACHE_BACKEND = 'locmem://'
+
+# Tag statistics are cached this many seconds (see docstore.tagstats). They
+# are only cached if CACHE_BACKEND is shared between processes.
+TAGSTATS_TIMEOUT = 24 * 60 * 60
+# Number of tags in the tag cloud on the index and search pages.
+TAG_CLOUD_SIZE = 50
+# Number of rendered document listings cached per process (see
+# docstore.pagecache). Listings are only cached if CACHE_BACKEND is shared
+# between processes (e.g. memcached:// or file://), not with locmem://.
+PAGE_CACHE_SIZE = 1000
+
+# full-text search settings
+FULLTEXT_INDEX_PATH = here('..', '..', 'fulltext.db')
 
 DEBUG_SITE_MEDIA = here('..', '..', 'doc-root', 'site_media')
 